@@ -0,0 +1,238 @@
+# app/compression.py
+"""
+Response compression (Brotli or gzip).
+
+Movement lists, amortization schedules and analytics payloads are very
+repetitive JSON that compresses 5-10x. CompressionMiddleware picks the
+encoding from the request's Accept-Encoding (q-values honoured, Brotli
+preferred when the `brotli` package is installed, gzip otherwise) and
+compresses text-like responses of at least `minimum_size` bytes:
+
+- complete bodies are compressed in one go (in a worker thread when large);
+- streamed bodies (NDJSON, CSV exports) are compressed chunk by chunk and
+  flushed after each one, so the client keeps receiving data as it is
+  produced;
+- event streams, binary formats, partial (Range) responses and responses
+  that already carry a Content-Encoding are passed through untouched.
+
+Routes tune it with a dependency: `Depends(no_compression)` turns it off
+(e.g. responses carrying secrets, see BREACH) and
+`Depends(compression(minimum_size=...))` changes the threshold.
+"""
+import zlib
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+from fastapi import Request
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:  # Sin brotli se negocia solo gzip
+    brotli = None
+
+# Clave del scope ASGI con la política de compresión de la ruta
+COMPRESSION_SCOPE_KEY = "app.compression"
+
+# Tipos que merece la pena comprimir (los binarios ya van comprimidos)
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+)
+# Los eventos SSE deben llegar en cuanto se emiten, sin buffer del compresor
+NEVER_COMPRESS_TYPES = ("text/event-stream",)
+
+# Cuerpos a partir de este tamaño se comprimen fuera del bucle de eventos
+THREAD_MINIMUM_SIZE = 256 * 1024
+
+
+@dataclass(frozen=True)
+class CompressionPolicy:
+    enabled: bool = True
+    minimum_size: Optional[int] = None  # None: el umbral global del middleware
+
+
+def compression(enabled: bool = True, minimum_size: Optional[int] = None) -> Callable[[Request], None]:
+    """Route dependency that overrides the middleware's settings for that route"""
+    policy = CompressionPolicy(enabled, minimum_size)
+
+    def apply(request: Request) -> None:
+        request.scope[COMPRESSION_SCOPE_KEY] = policy
+
+    return apply
+
+
+no_compression = compression(enabled=False)
+
+
+def _accepted_encodings(accept_encoding: str) -> Dict[str, float]:
+    """Accept-Encoding as {coding: q}"""
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """'br', 'gzip' or None (identity) for an Accept-Encoding header"""
+    if not accept_encoding:
+        return None
+    accepted = _accepted_encodings(accept_encoding)
+    wildcard = accepted.get("*", 0.0)
+    available = ["br", "gzip"] if brotli is not None else ["gzip"]
+    best, best_q = None, 0.0
+    # En empate gana el primero (br antes que gzip)
+    for coding in available:
+        q = accepted.get(coding, wildcard)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+class _Compressor:
+    """Incremental compressor with the same interface for both encodings"""
+
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=brotli_quality)
+            self._zlib = None
+        else:
+            self._brotli = None
+            # wbits 16+: cabecera y cola gzip
+            self._zlib = zlib.compressobj(gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def chunk(self, data: bytes) -> bytes:
+        """Compress `data` and flush it so the client can decode it right away"""
+        if self._brotli is not None:
+            return self._brotli.process(data) + self._brotli.flush()
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        if self._brotli is not None:
+            return self._brotli.process(data) + self._brotli.finish()
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_FINISH)
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding"))
+        if encoding is None or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        await _CompressionResponder(self, scope, encoding)(receive, send)
+
+
+class _CompressionResponder:
+    def __init__(self, middleware: CompressionMiddleware, scope: Scope, encoding: str):
+        self.middleware = middleware
+        self.scope = scope
+        self.encoding = encoding
+        self.start_message: Optional[Message] = None
+        self.compressor: Optional[_Compressor] = None
+        self.passthrough = False
+
+    async def __call__(self, receive: Receive, send: Send) -> None:
+        self.send = send
+        await self.middleware.app(self.scope, receive, self.send_compressed)
+
+    def _wants_compression(self, message: Message) -> bool:
+        policy = self.scope.get(COMPRESSION_SCOPE_KEY, CompressionPolicy())
+        headers = Headers(raw=message["headers"])
+        content_type = headers.get("content-type", "").lower()
+        return (
+            policy.enabled
+            and message["status"] not in (204, 206, 304)
+            and "content-encoding" not in headers
+            and "content-range" not in headers
+            and content_type.startswith(COMPRESSIBLE_TYPES)
+            and not content_type.startswith(NEVER_COMPRESS_TYPES)
+        )
+
+    def _minimum_size(self) -> int:
+        policy = self.scope.get(COMPRESSION_SCOPE_KEY, CompressionPolicy())
+        return self.middleware.minimum_size if policy.minimum_size is None else policy.minimum_size
+
+    def _compressed_headers(self, content_length: Optional[int]) -> Message:
+        headers = MutableHeaders(raw=list(self.start_message["headers"]))
+        headers["Content-Encoding"] = self.encoding
+        headers.add_vary_header("Accept-Encoding")
+        # Los rangos se refieren a los bytes sin comprimir
+        if "accept-ranges" in headers:
+            del headers["Accept-Ranges"]
+        etag = headers.get("etag")
+        if etag and not etag.startswith("W/"):
+            headers["ETag"] = f"W/{etag}"
+        if content_length is None:
+            del headers["Content-Length"]
+        else:
+            headers["Content-Length"] = str(content_length)
+        return {**self.start_message, "headers": headers.raw}
+
+    async def send_compressed(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            if self._wants_compression(message):
+                # Se espera al primer trozo del cuerpo para decidir
+                self.start_message = message
+            else:
+                self.passthrough = True
+                await self.send(message)
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.compressor is None:
+            if not more_body:
+                # Cuerpo completo: solo si supera el umbral
+                if len(body) < self._minimum_size():
+                    self.passthrough = True
+                    await self.send(self.start_message)
+                    await self.send(message)
+                    return
+                compressor = _Compressor(self.encoding, self.middleware.gzip_level, self.middleware.brotli_quality)
+                if len(body) >= THREAD_MINIMUM_SIZE:
+                    compressed = await run_in_threadpool(compressor.finish, body)
+                else:
+                    compressed = compressor.finish(body)
+                await self.send(self._compressed_headers(len(compressed)))
+                await self.send({"type": "http.response.body", "body": compressed})
+                return
+            # Respuesta en streaming: longitud desconocida
+            self.compressor = _Compressor(self.encoding, self.middleware.gzip_level, self.middleware.brotli_quality)
+            await self.send(self._compressed_headers(None))
+
+        if more_body:
+            if body:
+                await self.send({"type": "http.response.body", "body": self.compressor.chunk(body), "more_body": True})
+        else:
+            await self.send({"type": "http.response.body", "body": self.compressor.finish(body)})
@@ -3,10 +3,36 @@ import os
 
 class Settings:
     database_url: str = os.getenv("DATABASE_URL", "sqlite:///./data/dev.db")
+    # Rutas async: por defecto la misma base con su driver asyncio (aiosqlite/asyncpg)
+    async_database_url: str = os.getenv("ASYNC_DATABASE_URL", "")
     app_data_dir: str = os.getenv("APP_DATA_DIR", "./data")
+    # PostgreSQL: pool de conexiones (por proceso); reciclar antes de que el servidor/proxy corte las inactivas
+    db_pool_size: int = int(os.getenv("DB_POOL_SIZE", "10"))
+    db_max_overflow: int = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+    db_pool_recycle: int = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # segundos
+    db_pool_timeout: int = int(os.getenv("DB_POOL_TIMEOUT", "30"))  # segundos esperando conexión libre
+    db_pool_pre_ping: bool = os.getenv("DB_POOL_PRE_PING", "false").lower() in ("1", "true", "yes")
+    # SQLite: PRAGMAs aplicados a cada conexión (WAL: lectores y un escritor a la vez)
+    sqlite_busy_timeout_ms: int = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+    sqlite_cache_size_kb: int = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+    sqlite_mmap_size: int = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
     jwt_secret: str = os.getenv("JWT_SECRET", "change-me")
     jwt_algorithm: str = "HS256"
     jwt_expires_minutes: int = 60 * 24  # 1 día
+    # Almacén de ficheros subidos: "local" (disco) o "s3" (cualquier servicio compatible, requiere boto3)
+    blob_store_backend: str = os.getenv("BLOB_STORE_BACKEND", "local")
+    blob_store_dir: str = os.getenv("BLOB_STORE_DIR", os.path.join(app_data_dir, "blobs"))
+    # Solo S3 o un BLOB_STORE_DIR explícito (volumen montado) sobreviven a un redeploy
+    blob_store_persistent: bool = blob_store_backend == "s3" or bool(os.getenv("BLOB_STORE_DIR"))
+    s3_bucket: str = os.getenv("S3_BUCKET", "")
+    s3_prefix: str = os.getenv("S3_PREFIX", "blobs/")
+    s3_endpoint_url: str = os.getenv("S3_ENDPOINT_URL", "")
+    image_workers: int = int(os.getenv("IMAGE_WORKERS", "2"))  # Hilos que generan miniaturas de fotos
+    # Compresión de respuestas (br/gzip según Accept-Encoding) a partir de este tamaño en bytes
+    compression_minimum_size: int = int(os.getenv("COMPRESSION_MINIMUM_SIZE", "1024"))
+    gzip_level: int = int(os.getenv("GZIP_LEVEL", "6"))
+    brotli_quality: int = int(os.getenv("BROTLI_QUALITY", "4"))  # 11 es demasiado lento para respuestas dinámicas
+    alerts_interval_minutes: int = int(os.getenv("ALERTS_INTERVAL_MINUTES", "60"))  # 0 desactiva el evaluador
 
 settings = Settings()
 
@@ -1,5 +1,10 @@
 # app/db.py
+from typing import Dict
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from sqlmodel import SQLModel, create_engine, Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 from .config import settings
 import os
 
@@ -8,17 +13,105 @@ from .models import (
     User, Property, Rule, Movement, 
     FinancialMovement, RentalContract, 
     MortgageDetails, MortgageRevision, MortgagePrepayment,
-    ClassificationRule
+    ClassificationRule, TaxYearSnapshot, Notification,
+    PropertyAlertState, ExpenseMonthBucket, ExpenseStats, DerivedStateVersion
 )
-from .models_files import FileStorage, PropertyPhoto
+from .models_files import Blob, FileStorage, PropertyPhoto, ImageDerivative
+from .services.blob_migration import prepare_inline_columns
 
 os.makedirs(settings.app_data_dir, exist_ok=True)
 
-engine = create_engine(settings.database_url, pool_pre_ping=True)
+def _is_memory_database(url) -> bool:
+    return url.database in (None, "", ":memory:") or "mode=memory" in str(url)
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    """Per-connection SQLite tuning: WAL, relaxed fsync, page cache, mmap and lock wait"""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA busy_timeout = {settings.sqlite_busy_timeout_ms}")
+        cursor.execute("PRAGMA journal_mode = WAL")
+        # Con WAL, NORMAL solo sincroniza en los checkpoints y sigue siendo consistente
+        cursor.execute("PRAGMA synchronous = NORMAL")
+        # Negativo: tamaño en KiB en lugar de páginas
+        cursor.execute(f"PRAGMA cache_size = -{settings.sqlite_cache_size_kb}")
+        cursor.execute(f"PRAGMA mmap_size = {settings.sqlite_mmap_size}")
+    finally:
+        cursor.close()
+
+def _engine_options(url) -> Dict:
+    if url.get_backend_name() == "sqlite":
+        # Espera de bloqueo también en el driver (segundos)
+        return {"connect_args": {"timeout": settings.sqlite_busy_timeout_ms / 1000}}
+    return {
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_recycle": settings.db_pool_recycle,
+        "pool_timeout": settings.db_pool_timeout,
+        # Con pool_recycle el ping por checkout suele sobrar (un round trip por petición)
+        "pool_pre_ping": settings.db_pool_pre_ping
+    }
+
+def _tune(target: Engine, url) -> None:
+    if url.get_backend_name() == "sqlite" and not _is_memory_database(url):
+        event.listen(target, "connect", _sqlite_pragmas)
+
+def create_app_engine(database_url: str) -> Engine:
+    """Engine tuned for the backend in `database_url` (SQLite file/memory or a pooled server)"""
+    url = make_url(database_url)
+    app_engine = create_engine(url, **_engine_options(url))
+    _tune(app_engine, url)
+    return app_engine
+
+# Driver asíncrono de cada backend
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg"}
+
+def async_database_url(database_url: str) -> str:
+    """The same database through its asyncio driver (sqlite+aiosqlite, postgresql+asyncpg)"""
+    url = make_url(database_url)
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None:
+        raise ValueError(f"No async driver configured for {url.get_backend_name()}")
+    return url.set(drivername=f"{url.get_backend_name()}+{driver}").render_as_string(hide_password=False)
+
+def create_async_app_engine(database_url: str) -> AsyncEngine:
+    """Async counterpart of create_app_engine, with the same pool and SQLite tuning"""
+    url = make_url(database_url)
+    app_engine = create_async_engine(url, **_engine_options(url))
+    # Los eventos de conexión van en el engine síncrono subyacente
+    _tune(app_engine.sync_engine, url)
+    return app_engine
+
+engine = create_app_engine(settings.database_url)
+# Mismo SQLite en local (aiosqlite); en PostgreSQL, asyncpg salvo que ASYNC_DATABASE_URL diga otra cosa
+async_engine = create_async_app_engine(settings.async_database_url or async_database_url(settings.database_url))
+
+def pool_stats(target: Engine = engine) -> Dict:
+    """Connection pool counters (for monitoring)"""
+    pool = target.pool
+    stats = {"backend": target.dialect.name, "pool": type(pool).__name__}
+    # Solo QueuePool y derivados llevan contadores
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        counter = getattr(pool, name, None)
+        if callable(counter):
+            stats[name] = counter()
+    stats["status"] = pool.status()
+    return stats
 
 def init_db():
     SQLModel.metadata.create_all(engine)
+    # Bases antiguas: columnas nuevas y Base64 opcional, sin mover datos (migración: python -m app.manage)
+    prepare_inline_columns(engine)
+    # create_all no añade índices nuevos a tablas que ya existían
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
 
 def get_session():
     with Session(engine) as session:
         yield session
+
+async def get_async_session():
+    """Session for `async def` routes: queries are awaited instead of blocking the event loop"""
+    # Sin expirar al confirmar: en async no se puede recargar un atributo de forma implícita
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        yield session
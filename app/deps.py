@@ -1,25 +1,50 @@
 # app/deps.py
-from fastapi import Depends, HTTPException
+from typing import Optional
+
+from fastapi import Depends, HTTPException, Query
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt
 from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from .config import settings
-from .db import get_session
+from .db import engine, get_async_session, get_session
 from .models import User
 
 oauth2 = OAuth2PasswordBearer(tokenUrl="/auth/login")
+oauth2_optional = OAuth2PasswordBearer(tokenUrl="/auth/login", auto_error=False)
 
-def get_current_user(
-    token: str = Depends(oauth2),
-    session: Session = Depends(get_session),
-) -> User:
+def _token_user_id(token: str) -> int:
     try:
         data = jwt.decode(token, settings.jwt_secret, algorithms=[settings.jwt_algorithm])
-        user_id = int(data.get("sub"))
+        return int(data.get("sub"))
     except Exception:
         raise HTTPException(401, "Token inválido")
-    user = session.get(User, user_id)
+
+def _active_user(user: Optional[User]) -> User:
     if not user or not user.is_active:
         raise HTTPException(401, "Usuario inactivo o no existe")
     return user
+
+def get_current_user(
+    token: str = Depends(oauth2),
+    session: Session = Depends(get_session),
+) -> User:
+    return _active_user(session.get(User, _token_user_id(token)))
+
+async def get_current_user_async(
+    token: str = Depends(oauth2),
+    session: AsyncSession = Depends(get_async_session),
+) -> User:
+    """get_current_user for async routes (no threadpool hop)"""
+    return _active_user(await session.get(User, _token_user_id(token)))
+
+def get_stream_user(
+    header_token: Optional[str] = Depends(oauth2_optional),
+    token: Optional[str] = Query(None, description="Token JWT (EventSource no permite cabeceras)"),
+) -> User:
+    """Usuario de una conexión larga (SSE): sesión propia, cerrada antes de empezar a emitir"""
+    if not (header_token or token):
+        raise HTTPException(401, "Not authenticated")
+    with Session(engine) as session:
+        return get_current_user(header_token or token, session)
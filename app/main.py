@@ -1,17 +1,38 @@
 # app/main.py
-from fastapi import FastAPI, Request
+from fastapi import Depends, FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import Response
+import logging
 import os
 
-from .db import init_db
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+from .compression import CompressionMiddleware
+from .config import settings
+from .db import async_engine, engine, init_db, pool_stats
+from .deps import get_current_user
+from .responses import FastJSONResponse
+from .services.alerts import alert_scheduler, ensure_alert_state
+from .services.image_derivatives import shutdown_derivative_pool
+from .services.search import ensure_search_index
 from .routers import (
     properties, rules, movements, cashflow, auth,
-    financial_movements, rental_contracts, mortgage_details, classification_rules, uploads, euribor_rates, analytics, mortgage_calculator, document_manager, notifications, tax_assistant, integrations, file_storage
+    financial_movements, rental_contracts, mortgage_details, classification_rules, uploads, euribor_rates, analytics, mortgage_calculator, document_manager, notifications, tax_assistant, integrations, file_storage, events, search
 )
 
-app = FastAPI(title="Inmuebles API", version="0.1.0")
+logger = logging.getLogger(__name__)
+
+# Todas las respuestas JSON se renderizan con orjson
+app = FastAPI(title="Inmuebles API", version="0.1.0", default_response_class=FastJSONResponse)
+
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=settings.compression_minimum_size,
+    gzip_level=settings.gzip_level,
+    brotli_quality=settings.brotli_quality,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -42,6 +63,8 @@ app.include_router(notifications.router)
 app.include_router(tax_assistant.router)
 app.include_router(integrations.router)
 app.include_router(file_storage.router)
+app.include_router(events.router)
+app.include_router(search.router)
 
 # Global OPTIONS handler for CORS preflight
 @app.options("/{full_path:path}")
@@ -64,6 +87,17 @@ def on_startup():
     os.makedirs(f"{upload_dir}/photo", exist_ok=True)
     os.makedirs(f"{upload_dir}/document", exist_ok=True)
     os.makedirs(f"{upload_dir}/tenant-document", exist_ok=True)
+    # Estado incremental de alertas: solo se reconstruye si falta o es de otra versión
+    ensure_alert_state(engine)
+    # Índice de búsqueda (se construye la primera vez; después se mantiene en cada escritura)
+    ensure_search_index(engine)
+    alert_scheduler.start(engine, settings.alerts_interval_minutes * 60)
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    alert_scheduler.stop()
+    shutdown_derivative_pool()
+    await async_engine.dispose()
 
 # Montar archivos estáticos desde la ruta correcta
 upload_path = "/uploads" if os.path.exists("/uploads") else "uploads"
@@ -73,6 +107,22 @@ app.mount("/uploads", StaticFiles(directory=upload_path), name="uploads")
 def health():
     return {"status": "ok"}
 
+@app.get("/health/db")
+def health_db():
+    """La base de datos responde (público: solo arriba/abajo, sin detalles internos)"""
+    try:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+    except SQLAlchemyError:
+        logger.exception("Database health check failed")
+        return FastJSONResponse({"status": "unavailable"}, status_code=503)
+    return {"status": "ok"}
+
+@app.get("/health/db/pools")
+def health_db_pools(user=Depends(get_current_user)):
+    """Estado de los pools de conexiones (rutas síncronas y async)"""
+    return {"sync": pool_stats(engine), "async": pool_stats(async_engine.sync_engine)}
+
 # Force deploy 20250826_170951 - classification_rules and rental_contracts ready
 
 
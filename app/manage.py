@@ -0,0 +1,48 @@
+# app/manage.py
+"""
+Maintenance commands, run by hand against the configured database:
+
+    python -m app.manage migrate-blobs        # copy inline Base64 files to the blob store
+    python -m app.manage verify-blobs         # compare every copy with its inline original
+    python -m app.manage drop-inline-columns  # drop the Base64 columns (only after a clean verify)
+    python -m app.manage rebuild-alerts       # recompute the incremental alert state from every movement
+"""
+import argparse
+import json
+import logging
+import sys
+
+from .db import engine, init_db
+from .services.alerts import rebuild_alert_state
+from .services.blob_migration import (
+    BlobMigrationError, drop_inline_columns, migrate_inline_blobs, verify_inline_blobs
+)
+
+COMMANDS = {
+    "migrate-blobs": migrate_inline_blobs,
+    "verify-blobs": verify_inline_blobs,
+    "drop-inline-columns": drop_inline_columns,
+    "rebuild-alerts": rebuild_alert_state,
+}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.manage", description="Maintenance commands")
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+
+    init_db()
+    try:
+        result = COMMANDS[args.command](engine)
+    except BlobMigrationError as exc:
+        print(f"error: {exc}", file=sys.stderr)
+        return 1
+    print(json.dumps(result, indent=2, default=str))
+    if args.command == "verify-blobs" and (result["pending"] or result["mismatched"]):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
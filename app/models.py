@@ -1,6 +1,7 @@
 # app/models.py
 from typing import Optional, List
-from datetime import date
+from datetime import date, datetime, timezone
+from sqlalchemy import Index, UniqueConstraint
 from sqlmodel import SQLModel, Field, Relationship
 
 class User(SQLModel, table=True):
@@ -13,7 +14,7 @@ class User(SQLModel, table=True):
 
 class Property(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
-    owner_id: int = Field(foreign_key="user.id")
+    owner_id: int = Field(foreign_key="user.id", index=True)
     address: str
     rooms: Optional[int] = None
     m2: Optional[int] = None
@@ -58,6 +59,11 @@ class Movement(SQLModel, table=True):
     property: Optional[Property] = Relationship(back_populates="movements")
 
 class FinancialMovement(SQLModel, table=True):
+    __table_args__ = (
+        # Consultas por propiedad y rango de fechas (informes fiscales, dashboard)
+        Index("ix_financialmovement_property_date", "property_id", "date"),
+    )
+    
     id: Optional[int] = Field(default=None, primary_key=True)
     user_id: int = Field(foreign_key="user.id")  # Owner of the movement
     property_id: Optional[int] = Field(default=None, foreign_key="property.id")  # Can be null initially
@@ -75,7 +81,7 @@ class FinancialMovement(SQLModel, table=True):
 
 class RentalContract(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
-    property_id: int = Field(foreign_key="property.id")
+    property_id: int = Field(foreign_key="property.id", index=True)
     tenant_name: str
     start_date: date
     end_date: Optional[date] = None
@@ -99,7 +105,7 @@ class RentalContract(SQLModel, table=True):
 
 class TenantDocument(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
-    rental_contract_id: int = Field(foreign_key="rentalcontract.id")
+    rental_contract_id: int = Field(foreign_key="rentalcontract.id", index=True)
     document_type: str  # "dni", "payslip", "employment_contract", "bank_statement", "other"
     document_name: str  # Nombre del archivo
     file_path: str  # Ruta donde se almacena el archivo
@@ -165,3 +171,75 @@ class EuriborRate(SQLModel, table=True):
     source: Optional[str] = None      # Fuente de los datos
     created_at: Optional[date] = None # Fecha de creación del registro
 
+
+class TaxYearSnapshot(SQLModel, table=True):
+    """Agregados fiscales precalculados por usuario y año"""
+    __table_args__ = (UniqueConstraint("user_id", "year"),)
+    
+    id: Optional[int] = Field(default=None, primary_key=True)
+    user_id: int = Field(foreign_key="user.id", index=True)
+    year: int = Field(index=True)
+    data: str  # JSON con los agregados del año (ver services/tax_report.build_tax_year)
+    is_closed: bool = False  # Ejercicio cerrado: rara vez cambia, pero se invalida igual que uno abierto
+    is_stale: bool = False  # Algún dato del año cambió desde que se calculó
+    computed_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class Notification(SQLModel, table=True):
+    """Alerta persistida por el evaluador de alertas, con estado de lectura"""
+    __table_args__ = (
+        UniqueConstraint("user_id", "key"),
+        # Lectura de /notifications/alerts: alertas activas del usuario
+        Index("ix_notification_user_active", "user_id", "is_active", "created_at"),
+    )
+    
+    id: Optional[int] = Field(default=None, primary_key=True)
+    user_id: int = Field(foreign_key="user.id")
+    key: str  # Identificador estable de la alerta, p.ej. "contract_expiry_12"
+    type: str  # "payment_due", "unusual_expense", "contract_expiring", "savings_opportunity", "mortgage_review"
+    title: str
+    message: str
+    priority: str  # "high", "medium", "low"
+    property_id: Optional[int] = Field(default=None, foreign_key="property.id")
+    amount: Optional[float] = None
+    due_date: Optional[date] = None
+    action_url: Optional[str] = None
+    is_active: bool = True  # False cuando la condición de la alerta deja de cumplirse
+    read: bool = False
+    read_at: Optional[datetime] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class PropertyAlertState(SQLModel, table=True):
+    """Estado incremental de alertas por propiedad (mantenido por services/alerts.py)"""
+    property_id: int = Field(primary_key=True, foreign_key="property.id")
+    last_rent_date: Optional[date] = None  # Último cobro de renta registrado
+
+class ExpenseMonthBucket(SQLModel, table=True):
+    """Gasto mensual acumulado por propiedad y categoría, actualizado en cada escritura de movimientos"""
+    __table_args__ = (UniqueConstraint("property_id", "category", "year", "month"),)
+    
+    id: Optional[int] = Field(default=None, primary_key=True)
+    property_id: int = Field(foreign_key="property.id")
+    category: str  # subcategory o category del movimiento; "*" = total de la propiedad
+    year: int
+    month: int
+    total: float = 0.0  # Suma de gastos en positivo
+    count: int = 0  # Nº de movimientos de gasto en el mes
+
+class ExpenseStats(SQLModel, table=True):
+    """Media y varianza (Welford) del gasto mensual por propiedad y categoría en una ventana móvil"""
+    __table_args__ = (UniqueConstraint("property_id", "category"),)
+    
+    id: Optional[int] = Field(default=None, primary_key=True)
+    property_id: int = Field(foreign_key="property.id")
+    category: str
+    through_month: int  # Último mes incluido (año * 12 + mes); la ventana acaba ahí
+    n: int = 0  # Meses con gasto en la ventana
+    mean: float = 0.0
+    m2: float = 0.0  # Suma de cuadrados de las desviaciones (Welford)
+
+class DerivedStateVersion(SQLModel, table=True):
+    """Versión con la que se construyó un estado derivado (p.ej. el de alertas); 0 = desfasado"""
+    name: str = Field(primary_key=True)
+    version: int
+    built_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
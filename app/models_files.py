@@ -1,25 +1,52 @@
 # app/models_files.py
+from sqlalchemy import Index, UniqueConstraint
 from sqlmodel import Field, SQLModel
 from typing import Optional
-from datetime import datetime
+from datetime import datetime, timezone
+
+class Blob(SQLModel, table=True):
+    """Content stored in the blob store, addressed by SHA-256"""
+    sha256: str = Field(primary_key=True, max_length=64)
+    size: int
+    ref_count: int = Field(default=0)  # FileStorage rows (and derivatives) pointing at it
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class FileStorage(SQLModel, table=True):
-    """Store files in database as Base64"""
+    """Uploaded file metadata; the bytes live in the blob store"""
+    __table_args__ = (
+        # Listado de ficheros del usuario por tipo
+        Index("ix_filestorage_user_type", "user_id", "file_type", "id"),
+    )
     id: Optional[int] = Field(default=None, primary_key=True)
     filename: str
     content_type: str
-    file_data: str  # Base64 encoded file content
+    # None: fila de una base antigua con el Base64 aún sin migrar (app.manage migrate-blobs)
+    sha256: Optional[str] = Field(default=None, foreign_key="blob.sha256", index=True, max_length=64)
     file_size: int
     property_id: Optional[int] = None
     file_type: str  # 'photo', 'document', 'tenant-document'
-    created_at: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     user_id: Optional[int] = None
-    
+
 class PropertyPhoto(SQLModel, table=True):
-    """Property photos with Base64 data"""
+    """Photo of a property's gallery; the image is the linked FileStorage row"""
     id: Optional[int] = Field(default=None, primary_key=True)
-    property_id: int
+    property_id: int = Field(index=True)
+    file_id: Optional[int] = Field(default=None, foreign_key="filestorage.id", index=True)
     photo_url: str  # Will be an API endpoint
-    photo_data: str  # Base64 encoded image
     is_primary: bool = Field(default=False)
-    created_at: datetime = Field(default_factory=datetime.utcnow)
\ No newline at end of file
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class ImageDerivative(SQLModel, table=True):
+    """Resized rendition of an image blob (keyed by the source content, shared by duplicates)"""
+    __table_args__ = (UniqueConstraint("source_sha256", "size", "format"),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    source_sha256: str = Field(foreign_key="blob.sha256", index=True, max_length=64)
+    size: str  # 'thumb', 'card', 'full'
+    format: str  # 'webp', 'jpeg'
+    sha256: str = Field(foreign_key="blob.sha256", max_length=64)
+    content_type: str
+    width: int
+    height: int
+    file_size: int
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
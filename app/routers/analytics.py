@@ -3,10 +3,14 @@ from fastapi import APIRouter, Depends
 from typing import Dict, List, Optional
 from datetime import date, datetime, timedelta
 from sqlmodel import Session, select, func
+from sqlmodel.ext.asyncio.session import AsyncSession
 import logging
-from ..db import get_session
-from ..deps import get_current_user
-from ..models import Property, FinancialMovement, RentalContract, MortgageDetails
+from ..db import get_async_session, get_session
+from ..deps import get_current_user, get_current_user_async
+from ..models import (
+    Property, FinancialMovement, RentalContract, MortgageDetails, MortgagePrepayment, MortgageRevision
+)
+from ..services.mortgage_calculator import MortgageCalculator
 
 logger = logging.getLogger(__name__)
 
@@ -92,18 +96,18 @@ def debug_property_data(
     }
 
 @router.get("/dashboard/{property_id}")
-def get_property_dashboard(
+async def get_property_dashboard(
     property_id: int,
     year: Optional[int] = None,
-    session: Session = Depends(get_session),
-    current_user = Depends(get_current_user)
+    session: AsyncSession = Depends(get_async_session),
+    current_user = Depends(get_current_user_async)
 ):
     """Dashboard completo de métricas para una propiedad específica"""
     if year is None:
         year = datetime.now().year
     
     # Obtener la propiedad
-    property_data = session.get(Property, property_id)
+    property_data = await session.get(Property, property_id)
     if not property_data or property_data.owner_id != current_user.id:
         return {"error": "Propiedad no encontrada"}
     
@@ -112,12 +116,12 @@ def get_property_dashboard(
     end_date = date(year, 12, 31)
     
     # Movimientos del año
-    movements = session.exec(
+    movements = (await session.exec(
         select(FinancialMovement)
         .where(FinancialMovement.property_id == property_id)
         .where(FinancialMovement.date >= start_date)
         .where(FinancialMovement.date <= end_date)
-    ).all()
+    )).all()
     
     # Cálculos básicos
     total_income = sum(m.amount for m in movements if m.amount > 0)
@@ -135,10 +139,10 @@ def get_property_dashboard(
             expenses_by_category[category] = expenses_by_category.get(category, 0) + abs(movement.amount)
     
     # Obtener hipoteca de la propiedad
-    mortgage = session.exec(
+    mortgage = (await session.exec(
         select(MortgageDetails)
         .where(MortgageDetails.property_id == property_id)
-    ).first()
+    )).first()
     
     # Cálculo de inversión total: precio de compra + 10% proxy para impuestos y gastos
     purchase_price = property_data.purchase_price or 0
@@ -170,13 +174,22 @@ def get_property_dashboard(
     monthly_cash_flow = net_income / 12
     
     # Contrato activo
-    active_contract = session.exec(
+    active_contract = (await session.exec(
         select(RentalContract)
         .where(RentalContract.property_id == property_id)
         .where(RentalContract.is_active == True)
-    ).first()
+    )).first()
     
-    # Detalles hipoteca ya obtenidos arriba
+    # Detalles hipoteca ya obtenidos arriba; cuota y tipo vigentes según el plan común (revisiones y amortizaciones)
+    mortgage_position = None
+    if mortgage:
+        revisions = (await session.exec(
+            select(MortgageRevision).where(MortgageRevision.mortgage_id == mortgage.id)
+        )).all()
+        prepayments = (await session.exec(
+            select(MortgagePrepayment).where(MortgagePrepayment.mortgage_id == mortgage.id)
+        )).all()
+        mortgage_position = MortgageCalculator.current_position(mortgage, revisions, prepayments)
     
     return {
         "property": {
@@ -211,10 +224,10 @@ def get_property_dashboard(
         },
         "mortgage_info": {
             "has_mortgage": bool(mortgage),
-            "outstanding_balance": mortgage.outstanding_balance if mortgage else 0,
-            "monthly_payment": calculate_monthly_payment(mortgage) if mortgage else 0,
-            "current_rate": (mortgage.margin_percentage + 3.5) if mortgage else 0,  # Euribor + diferencial
-            "remaining_months": calculate_remaining_months_from_date(mortgage.end_date) if mortgage else 0,
+            "outstanding_balance": round(mortgage_position["balance"], 2) if mortgage else 0,
+            "monthly_payment": round(mortgage_position["payment"], 2) if mortgage else 0,
+            "current_rate": mortgage_position["annual_rate"] if mortgage else 0,  # Euribor revisado + diferencial (o tipo fijo)
+            "remaining_months": mortgage_position["remaining_months"] if mortgage else 0,
             "start_date": mortgage.start_date.isoformat() if mortgage else None,
             "end_date": mortgage.end_date.isoformat() if mortgage else None
         },
@@ -222,25 +235,25 @@ def get_property_dashboard(
     }
 
 @router.get("/portfolio-summary")
-def get_portfolio_summary(
+async def get_portfolio_summary(
     year: Optional[int] = None,
-    session: Session = Depends(get_session),
-    current_user = Depends(get_current_user)
+    session: AsyncSession = Depends(get_async_session),
+    current_user = Depends(get_current_user_async)
 ):
     """Resumen completo del portfolio de propiedades"""
     if year is None:
         year = datetime.now().year
     
     # Obtener todas las propiedades del usuario
-    properties = session.exec(
+    properties = (await session.exec(
         select(Property).where(Property.owner_id == current_user.id)
-    ).all()
+    )).all()
     
     # Get mortgage debt total
     from ..models import MortgageDetails
-    mortgages = session.exec(
+    mortgages = (await session.exec(
         select(MortgageDetails).join(Property).where(Property.owner_id == current_user.id)
-    ).all()
+    )).all()
     total_debt = sum(m.outstanding_balance for m in mortgages)
     
     # Calculate total property value
@@ -271,12 +284,12 @@ def get_portfolio_summary(
     
     for prop in properties:
         # Movimientos de la propiedad
-        movements = session.exec(
+        movements = (await session.exec(
             select(FinancialMovement)
             .where(FinancialMovement.property_id == prop.id)
             .where(FinancialMovement.date >= start_date)
             .where(FinancialMovement.date <= end_date)
-        ).all()
+        )).all()
         
         income = sum(m.amount for m in movements if m.amount > 0)
         expenses = sum(abs(m.amount) for m in movements if m.amount < 0)
@@ -401,33 +414,3 @@ def get_cash_flow_projection(
         "projection": projection
     }
 
-def calculate_monthly_payment(mortgage: MortgageDetails) -> float:
-    """Calcular pago mensual de hipoteca"""
-    if not mortgage:
-        return 0
-    
-    # Fórmula simplificada - en producción usar tasas reales
-    principal = mortgage.outstanding_balance
-    annual_rate = (mortgage.margin_percentage + 3.5) / 100  # Estimación Euribor + margen
-    monthly_rate = annual_rate / 12
-    
-    # Calcular meses restantes
-    today = date.today()
-    months_remaining = (mortgage.end_date.year - today.year) * 12 + (mortgage.end_date.month - today.month)
-    
-    if months_remaining <= 0 or monthly_rate == 0:
-        return 0
-    
-    # Fórmula de amortización
-    monthly_payment = principal * (monthly_rate * (1 + monthly_rate)**months_remaining) / ((1 + monthly_rate)**months_remaining - 1)
-    return round(monthly_payment, 2)
-
-def calculate_remaining_months_from_date(end_date):
-    """Calcular meses restantes hasta una fecha"""
-    if not end_date:
-        return 0
-    
-    today = date.today()
-    remaining_months = (end_date.year - today.year) * 12 + (end_date.month - today.month)
-    
-    return max(0, remaining_months)
\ No newline at end of file
@@ -7,11 +7,13 @@ from jose import jwt
 from passlib.context import CryptContext
 from pydantic import BaseModel, EmailStr
 from sqlmodel import Session, select
+from ..compression import no_compression
 from ..config import settings
 from ..db import get_session
 from ..models import User
 
-router = APIRouter(prefix="/auth", tags=["auth"])
+# Sin compresión: las respuestas llevan el token junto a datos enviados por el cliente (BREACH)
+router = APIRouter(prefix="/auth", tags=["auth"], dependencies=[Depends(no_compression)])
 pwd = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 def make_token(user_id: int) -> str:
@@ -6,11 +6,11 @@ from sqlmodel import Session, select
 from pydantic import BaseModel
 import os
 import uuid
-import shutil
 from pathlib import Path
 from ..db import get_session
 from ..deps import get_current_user
 from ..models import Property, RentalContract, TenantDocument
+from ..services.upload_stream import receive_upload
 
 router = APIRouter(prefix="/documents", tags=["document-manager"])
 
@@ -28,6 +28,12 @@ class DocumentTemplate(BaseModel):
     description: str
     required_fields: List[str]
 
+# Tamaño máximo de un documento subido
+MAX_DOCUMENT_SIZE = 10 * 1024 * 1024  # 10MB
+
+# Documentos que debe aportar todo inquilino con contrato activo
+REQUIRED_TENANT_DOCUMENTS = ["dni", "payslip", "employment_contract", "bank_statement"]
+
 @router.get("/alerts")
 def get_document_alerts(
     session: Session = Depends(get_session),
@@ -37,20 +43,33 @@ def get_document_alerts(
     alerts = []
     today = date.today()
     
-    # Obtener propiedades del usuario
-    properties = session.exec(
-        select(Property).where(Property.owner_id == current_user.id)
+    # Contratos activos de todas las propiedades del usuario (una consulta)
+    contracts = session.exec(
+        select(RentalContract.id, RentalContract.property_id, RentalContract.tenant_name, RentalContract.end_date)
+        .join(Property, Property.id == RentalContract.property_id)
+        .where(Property.owner_id == current_user.id)
+        .where(RentalContract.is_active == True)
+        .order_by(RentalContract.property_id, RentalContract.id)
     ).all()
     
-    for prop in properties:
-        # Contratos próximos a vencer
-        contracts = session.exec(
-            select(RentalContract)
-            .where(RentalContract.property_id == prop.id)
-            .where(RentalContract.is_active == True)
+    # Tipos de documento ya aportados por contrato (una consulta agrupada)
+    existing_doc_types: Dict[int, set] = {}
+    if contracts:
+        rows = session.exec(
+            select(TenantDocument.rental_contract_id, TenantDocument.document_type)
+            .where(TenantDocument.rental_contract_id.in_([contract.id for contract in contracts]))
+            .group_by(TenantDocument.rental_contract_id, TenantDocument.document_type)
         ).all()
-        
-        for contract in contracts:
+        for contract_id, document_type in rows:
+            existing_doc_types.setdefault(contract_id, set()).add(document_type)
+    
+    contracts_by_property: Dict[int, list] = {}
+    for contract in contracts:
+        contracts_by_property.setdefault(contract.property_id, []).append(contract)
+    
+    for property_id, property_contracts in contracts_by_property.items():
+        # Contratos próximos a vencer
+        for contract in property_contracts:
             if contract.end_date:
                 days_until_expiry = (contract.end_date - today).days
                 
@@ -60,7 +79,7 @@ def get_document_alerts(
                         message=f"Contrato de {contract.tenant_name} vence en {days_until_expiry} días",
                         priority="high" if days_until_expiry <= 7 else "medium",
                         due_date=contract.end_date,
-                        property_id=prop.id,
+                        property_id=property_id,
                         contract_id=contract.id
                     ))
                 elif days_until_expiry <= 0:
@@ -69,27 +88,21 @@ def get_document_alerts(
                         message=f"Contrato de {contract.tenant_name} ha vencido",
                         priority="high",
                         due_date=contract.end_date,
-                        property_id=prop.id,
+                        property_id=property_id,
                         contract_id=contract.id
                     ))
         
         # Documentos faltantes por contrato
-        for contract in contracts:
-            tenant_docs = session.exec(
-                select(TenantDocument)
-                .where(TenantDocument.rental_contract_id == contract.id)
-            ).all()
-            
-            required_docs = ["dni", "payslip", "employment_contract", "bank_statement"]
-            existing_doc_types = {doc.document_type for doc in tenant_docs}
-            missing_docs = set(required_docs) - existing_doc_types
-            
-            for missing_doc in missing_docs:
+        for contract in property_contracts:
+            present = existing_doc_types.get(contract.id, set())
+            for missing_doc in REQUIRED_TENANT_DOCUMENTS:
+                if missing_doc in present:
+                    continue
                 alerts.append(DocumentAlert(
                     type="document_missing",
                     message=f"Falta documento '{missing_doc}' de {contract.tenant_name}",
                     priority="medium",
-                    property_id=prop.id,
+                    property_id=property_id,
                     contract_id=contract.id
                 ))
     
@@ -187,9 +200,12 @@ async def upload_document(
             detail=f"Tipo de archivo no permitido. Permitidos: {allowed_extensions}"
         )
     
-    # Crear directorio si no existe
+    # Recibir por bloques con límite de tamaño
+    upload = await receive_upload(
+        file, MAX_DOCUMENT_SIZE, f"Archivo demasiado grande. Máximo {MAX_DOCUMENT_SIZE // (1024*1024)}MB"
+    )
+    
     upload_dir = Path("uploads/documents")
-    upload_dir.mkdir(parents=True, exist_ok=True)
     
     # Generar nombre único
     file_id = str(uuid.uuid4())
@@ -197,9 +213,9 @@ async def upload_document(
     file_path = upload_dir / safe_filename
     
     try:
-        # Guardar archivo
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # Guardar archivo (movimiento atómico, crea el directorio si no existe)
+        with upload:
+            upload.move_to(file_path)
         
         # Crear registro en base de datos
         tenant_doc = TenantDocument(
@@ -207,7 +223,7 @@ async def upload_document(
             document_type=document_type,
             document_name=file.filename,
             file_path=str(file_path),
-            file_size=file.size,
+            file_size=upload.size,
             description=description
         )
         
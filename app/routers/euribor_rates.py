@@ -1,13 +1,15 @@
 # app/routers/euribor_rates.py
 from datetime import date
 from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from pydantic import BaseModel
 
-from ..db import get_session
-from ..deps import get_current_user
+from ..db import get_async_session, get_session
+from ..deps import get_current_user, get_current_user_async
 from ..models import User, EuriborRate
+from ..responses import FastJSONResponse, check_list_format, columnar
 
 router = APIRouter(prefix="/euribor-rates", tags=["euribor-rates"])
 
@@ -40,23 +42,31 @@ class EuriborRateResponse(BaseModel):
 class BulkEuriborRatesCreate(BaseModel):
     rates: List[EuriborRateCreate]
 
+# Campos de EuriborRateResponse, leídos como columnas en el listado
+RATE_FIELDS = list(EuriborRateResponse.model_fields)
+
 @router.get("/", response_model=List[EuriborRateResponse])
-def get_euribor_rates(
+async def get_euribor_rates(
     start_date: Optional[date] = None,
     end_date: Optional[date] = None,
-    session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user)
+    format: str = Query("rows", description="rows | columnar (one array per field)"),
+    session: AsyncSession = Depends(get_async_session),
+    current_user: User = Depends(get_current_user_async)
 ):
     """Get Euribor rates with optional date filtering"""
-    query = select(EuriborRate).order_by(EuriborRate.date.desc())
+    check_list_format(format)
+    query = select(*[getattr(EuriborRate, field) for field in RATE_FIELDS]).order_by(EuriborRate.date.desc())
     
     if start_date:
         query = query.where(EuriborRate.date >= start_date)
     if end_date:
         query = query.where(EuriborRate.date <= end_date)
     
-    rates = session.exec(query).all()
-    return rates
+    # Filas directas del ORM: sin revalidar cada una contra el response_model
+    rates = [dict(row._mapping) for row in await session.exec(query)]
+    if format == "columnar":
+        return FastJSONResponse({"format": "columnar", "count": len(rates), "rates": columnar(rates, RATE_FIELDS)})
+    return FastJSONResponse(rates)
 
 @router.post("/", response_model=EuriborRateResponse)
 def create_euribor_rate(
@@ -0,0 +1,45 @@
+# app/routers/events.py
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import StreamingResponse
+
+from ..deps import get_stream_user
+from ..services.events import format_sse, get_broker, user_channel
+from ..services.jobs import job_tracker
+
+router = APIRouter(prefix="/events", tags=["events"])
+
+# Comentario SSE periódico para mantener viva la conexión a través de proxies
+EVENTS_KEEPALIVE_SECONDS = 15.0
+
+@router.get("/stream")
+async def stream_events(
+    request: Request,
+    current_user = Depends(get_stream_user)
+):
+    """
+    Canal push (server-sent events) del usuario.
+
+    Eventos: `alert` (alerta creada, actualizada o resuelta) y `job`
+    (progreso de importaciones y sincronizaciones). Sustituye el sondeo de
+    /notifications/alerts, /notifications/stats y del progreso de sincronización.
+    """
+    user_id = current_user.id
+    subscription = get_broker().subscribe(user_channel(user_id))
+
+    async def event_stream():
+        try:
+            yield "retry: 5000\n\n"
+            # Estado actual de los trabajos en curso, por si el cliente conecta a mitad
+            for job in job_tracker.active(user_id):
+                yield format_sse({"id": None, "type": "job", "data": job.to_dict()})
+            while not await request.is_disconnected():
+                event = await subscription.get(EVENTS_KEEPALIVE_SECONDS)
+                yield format_sse(event) if event else ": keepalive\n\n"
+        finally:
+            subscription.close()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
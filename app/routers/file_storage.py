@@ -1,17 +1,24 @@
 # app/routers/file_storage.py
-"""File storage using database instead of filesystem"""
+"""File storage: metadata in the database, contents in the blob store"""
 
-import base64
 import uuid
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
-from fastapi.responses import Response
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, UploadFile, File
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from typing import List, Optional
 from pathlib import Path
 
-from ..db import get_session
-from ..deps import get_current_user
+from ..db import engine, get_async_session, get_session
+from ..deps import get_current_user, get_current_user_async
 from ..models_files import FileStorage, PropertyPhoto
+from ..services.blob_migration import read_inline_file
+from ..services.blob_store import get_blob_store, purge_blob, store_file
+from ..services.image_derivatives import (
+    DERIVATIVE_CACHE_CONTROL, DERIVATIVE_FORMATS, DERIVATIVE_PENDING_CACHE_CONTROL, DERIVATIVE_SIZES,
+    find_blob_derivative, preferred_format, release_photo_blob, schedule_blob_derivatives
+)
+from ..services.upload_stream import spool_upload
 
 router = APIRouter(prefix="/files", tags=["file-storage"])
 
@@ -19,93 +26,156 @@ router = APIRouter(prefix="/files", tags=["file-storage"])
 MAX_PHOTO_SIZE = 5 * 1024 * 1024  # 5MB
 MAX_DOCUMENT_SIZE = 10 * 1024 * 1024  # 10MB
 
+# Cabeceras de caché al servir
+PHOTO_CACHE_CONTROL = "public, max-age=86400"  # 1 día
+DOCUMENT_CACHE_CONTROL = "private, no-cache"  # Revalidar siempre (ETag -> 304 sin cuerpo)
+
 # Allowed extensions
 PHOTO_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
 DOCUMENT_EXTENSIONS = {".pdf", ".doc", ".docx", ".jpg", ".jpeg", ".png"}
 
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+def _blob_response(
+    request: Request, sha256: str, content_type: str, filename: str, file_size: int,
+    disposition: str, cache_control: str, extra_headers: Optional[dict] = None
+) -> Response:
+    """
+    Serve a stored file. The ETag is the content hash, so it is strong and
+    never changes for a given URL: a matching If-None-Match gets a 304.
+    Local blobs go through FileResponse (sendfile when the server supports
+    it, single Range requests and If-Range); other backends are streamed.
+    """
+    etag = f'"{sha256}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control, **(extra_headers or {})}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    store = get_blob_store()
+    path = store.local_path(sha256)
+    if path is not None:
+        return FileResponse(
+            path,
+            media_type=content_type,
+            filename=filename,
+            content_disposition_type=disposition,
+            headers=headers
+        )
+    if not store.exists(sha256):
+        raise HTTPException(404, "File content not found")
+    return StreamingResponse(
+        store.iter_chunks(sha256),
+        media_type=content_type,
+        headers={
+            **headers,
+            "Content-Length": str(file_size),
+            "Content-Disposition": f'{disposition}; filename="{filename}"'
+        }
+    )
+
+async def _stored_file_response(
+    session: AsyncSession, request: Request, file_record: FileStorage,
+    disposition: str, cache_control: str, extra_headers: Optional[dict] = None
+) -> Response:
+    """The file's blob, or its inline Base64 copy while the row has not been migrated"""
+    if file_record.sha256 is not None:
+        return _blob_response(
+            request, file_record.sha256, file_record.content_type, file_record.filename, file_record.file_size,
+            disposition, cache_control, extra_headers
+        )
+    content = await session.run_sync(read_inline_file, file_record.id)
+    if content is None:
+        raise HTTPException(404, "File content not found")
+    return Response(
+        content=content,
+        media_type=file_record.content_type,
+        headers={
+            "Cache-Control": cache_control,
+            "Content-Disposition": f'{disposition}; filename="{file_record.filename}"',
+            **(extra_headers or {})
+        }
+    )
+
+# Subidas y borrados: rutas síncronas (threadpool), el almacén de blobs hace E/S bloqueante
 @router.post("/upload/photo")
-async def upload_photo_to_db(
+def upload_photo_to_db(
     file: UploadFile = File(...),
     property_id: Optional[int] = None,
     session: Session = Depends(get_session),
     user=Depends(get_current_user)
 ):
-    """Upload photo and store in database as Base64"""
+    """Upload photo to the blob store"""
     
     # Validate file extension
     file_extension = Path(file.filename or "").suffix.lower()
     if file_extension not in PHOTO_EXTENSIONS:
         raise HTTPException(400, f"Invalid file type. Allowed: {', '.join(PHOTO_EXTENSIONS)}")
     
-    # Read and validate file size
-    contents = await file.read()
-    if len(contents) > MAX_PHOTO_SIZE:
-        raise HTTPException(400, "File too large. Maximum 5MB")
-    
-    # Convert to Base64
-    file_data_base64 = base64.b64encode(contents).decode('utf-8')
-    
-    # Create database record
+    # Recibir por bloques validando el tamaño y hasheando sobre la marcha
+    with spool_upload(file.file, MAX_PHOTO_SIZE, "File too large. Maximum 5MB") as upload:
+        # Guardar el contenido (deduplicado por hash) y solo los metadatos en la base de datos
+        blob = store_file(session, upload.path, upload.sha256, upload.size)
     file_record = FileStorage(
         filename=file.filename or f"photo_{uuid.uuid4()}{file_extension}",
         content_type=file.content_type or "image/jpeg",
-        file_data=file_data_base64,
-        file_size=len(contents),
+        sha256=blob.sha256,
+        file_size=upload.size,
         property_id=property_id,
         file_type="photo",
         user_id=user.id
     )
     
     session.add(file_record)
-    session.commit()
-    session.refresh(file_record)
+    session.flush()
     
-    # If property_id provided, also create PropertyPhoto record
+    # If property_id provided, also create PropertyPhoto record (same file, no second copy)
     if property_id:
         property_photo = PropertyPhoto(
             property_id=property_id,
+            file_id=file_record.id,
             photo_url=f"/files/photo/{file_record.id}",
-            photo_data=file_data_base64,
             is_primary=False
         )
         session.add(property_photo)
-        session.commit()
+    session.commit()
+    session.refresh(file_record)
+    
+    # Miniaturas y variantes WebP/JPEG en segundo plano
+    schedule_blob_derivatives(engine, file_record.sha256)
     
     return {
         "id": file_record.id,
         "filename": file_record.filename,
         "url": f"/files/photo/{file_record.id}",
+        "sizes": {size: f"/files/photo/{file_record.id}?size={size}" for size in DERIVATIVE_SIZES},
         "size": file_record.file_size
     }
 
 @router.post("/upload/document")
-async def upload_document_to_db(
+def upload_document_to_db(
     file: UploadFile = File(...),
     document_type: str = "document",
     session: Session = Depends(get_session),
     user=Depends(get_current_user)
 ):
-    """Upload document and store in database as Base64"""
+    """Upload document to the blob store"""
     
     # Validate file extension
     file_extension = Path(file.filename or "").suffix.lower()
     if file_extension not in DOCUMENT_EXTENSIONS:
         raise HTTPException(400, f"Invalid file type. Allowed: {', '.join(DOCUMENT_EXTENSIONS)}")
     
-    # Read and validate file size
-    contents = await file.read()
-    if len(contents) > MAX_DOCUMENT_SIZE:
-        raise HTTPException(400, "File too large. Maximum 10MB")
-    
-    # Convert to Base64
-    file_data_base64 = base64.b64encode(contents).decode('utf-8')
-    
-    # Create database record
+    with spool_upload(file.file, MAX_DOCUMENT_SIZE, "File too large. Maximum 10MB") as upload:
+        blob = store_file(session, upload.path, upload.sha256, upload.size)
     file_record = FileStorage(
         filename=file.filename or f"document_{uuid.uuid4()}{file_extension}",
         content_type=file.content_type or "application/pdf",
-        file_data=file_data_base64,
-        file_size=len(contents),
+        sha256=blob.sha256,
+        file_size=upload.size,
         file_type=document_type,
         user_id=user.id
     )
@@ -124,74 +194,81 @@ async def upload_document_to_db(
 @router.get("/photo/{file_id}")
 async def get_photo_from_db(
     file_id: int,
-    session: Session = Depends(get_session)
+    request: Request,
+    size: Optional[str] = Query(None, description="thumb, card o full; sin tamaño se sirve el original"),
+    session: AsyncSession = Depends(get_async_session)
 ):
-    """Retrieve and serve photo from database"""
+    """Serve photo from the blob store (Range, ETag/If-None-Match), optionally resized"""
+    
+    if size is not None and size not in DERIVATIVE_SIZES:
+        raise HTTPException(400, f"Invalid size. Allowed: {', '.join(DERIVATIVE_SIZES)}")
     
     # Get file from database
-    file_record = session.get(FileStorage, file_id)
+    file_record = await session.get(FileStorage, file_id)
     if not file_record or file_record.file_type != "photo":
         raise HTTPException(404, "Photo not found")
     
-    # Decode Base64
-    file_data = base64.b64decode(file_record.file_data)
+    if size is not None and file_record.sha256 is not None:
+        # WebP o JPEG según lo que acepte el cliente
+        image_format = preferred_format(request.headers.get("accept"))
+        derivative = await session.run_sync(find_blob_derivative, file_record.sha256, size, image_format)
+        if derivative is not None:
+            extension = DERIVATIVE_FORMATS[image_format][2]
+            return _blob_response(
+                request, derivative.sha256, derivative.content_type,
+                f"{Path(file_record.filename).stem}-{size}.{extension}", derivative.file_size,
+                "inline", DERIVATIVE_CACHE_CONTROL, {"Vary": "Accept"}
+            )
+        # Aún no generada (o foto anterior al pipeline): se encola y se sirve el original sin caché larga
+        schedule_blob_derivatives(engine, file_record.sha256)
+        return await _stored_file_response(
+            session, request, file_record, "inline", DERIVATIVE_PENDING_CACHE_CONTROL, {"Vary": "Accept"}
+        )
     
-    # Return as image response
-    return Response(
-        content=file_data,
-        media_type=file_record.content_type,
-        headers={
-            "Content-Disposition": f"inline; filename={file_record.filename}",
-            "Cache-Control": "public, max-age=86400"  # Cache for 1 day
-        }
-    )
+    return await _stored_file_response(session, request, file_record, "inline", PHOTO_CACHE_CONTROL)
 
 @router.get("/document/{file_id}")
 async def get_document_from_db(
     file_id: int,
-    session: Session = Depends(get_session),
-    user=Depends(get_current_user)
+    request: Request,
+    session: AsyncSession = Depends(get_async_session),
+    user=Depends(get_current_user_async)
 ):
-    """Retrieve and serve document from database"""
+    """Serve document from the blob store (Range, ETag/If-None-Match)"""
     
     # Get file from database
-    file_record = session.get(FileStorage, file_id)
+    file_record = await session.get(FileStorage, file_id)
     if not file_record or file_record.file_type not in ["document", "tenant-document"]:
         raise HTTPException(404, "Document not found")
     
-    # Decode Base64
-    file_data = base64.b64decode(file_record.file_data)
-    
-    # Return as file response
-    return Response(
-        content=file_data,
-        media_type=file_record.content_type,
-        headers={
-            "Content-Disposition": f"attachment; filename={file_record.filename}"
-        }
-    )
+    return await _stored_file_response(session, request, file_record, "attachment", DOCUMENT_CACHE_CONTROL)
 
 @router.get("/property/{property_id}/photos")
 async def get_property_photos(
     property_id: int,
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
     """Get all photos for a property"""
     
-    statement = select(PropertyPhoto).where(PropertyPhoto.property_id == property_id)
-    photos = session.exec(statement).all()
+    # Solo las columnas que se devuelven
+    statement = (
+        select(PropertyPhoto.id, PropertyPhoto.photo_url, PropertyPhoto.is_primary)
+        .where(PropertyPhoto.property_id == property_id)
+        .order_by(PropertyPhoto.id)
+    )
+    photos = (await session.exec(statement)).all()
     
     return [
         {
-            "id": photo.id,
-            "url": photo.photo_url,
-            "is_primary": photo.is_primary
+            "id": photo_id,
+            "url": photo_url,
+            "is_primary": is_primary
         }
-        for photo in photos
+        for photo_id, photo_url, is_primary in photos
     ]
 
 @router.delete("/photo/{file_id}")
-async def delete_photo(
+def delete_photo(
     file_id: int,
     session: Session = Depends(get_session),
     user=Depends(get_current_user)
@@ -206,35 +283,46 @@ async def delete_photo(
     if file_record.user_id != user.id:
         raise HTTPException(403, "Not authorized to delete this photo")
     
+    # La foto desaparece también de la galería de la propiedad
+    for photo in session.exec(select(PropertyPhoto).where(PropertyPhoto.file_id == file_record.id)):
+        session.delete(photo)
+    sha256 = file_record.sha256
     session.delete(file_record)
+    session.flush()
+    # Filas sin migrar: el contenido se va con la propia fila
+    orphaned = release_photo_blob(session, sha256) if sha256 is not None else []
     session.commit()
+    # Los bytes se borran solo cuando ya nadie los referencia y el borrado está confirmado
+    for orphan in orphaned:
+        purge_blob(session, orphan)
     
     return {"message": "Photo deleted successfully"}
 
 @router.get("/list/{file_type}")
 async def list_files(
     file_type: str,
-    session: Session = Depends(get_session),
-    user=Depends(get_current_user)
+    session: AsyncSession = Depends(get_async_session),
+    user=Depends(get_current_user_async)
 ):
     """List all files of a specific type"""
     
     if file_type not in ["photo", "document", "tenant-document"]:
         raise HTTPException(400, "Invalid file type")
     
-    statement = select(FileStorage).where(
+    # Solo metadatos: el contenido está en el almacén de blobs y no se toca al listar
+    statement = select(FileStorage.id, FileStorage.filename, FileStorage.file_size, FileStorage.created_at).where(
         FileStorage.file_type == file_type,
         FileStorage.user_id == user.id
-    )
-    files = session.exec(statement).all()
+    ).order_by(FileStorage.id)
+    files = (await session.exec(statement)).all()
     
     return [
         {
-            "id": f.id,
-            "filename": f.filename,
-            "url": f"/files/{file_type.replace('-', '/')}/{f.id}",
-            "size": f.file_size,
-            "created_at": f.created_at
+            "id": file_id,
+            "filename": filename,
+            "url": f"/files/{file_type.replace('-', '/')}/{file_id}",
+            "size": file_size,
+            "created_at": created_at
         }
-        for f in files
+        for file_id, filename, file_size, created_at in files
     ]
\ No newline at end of file
@@ -1,19 +1,30 @@
 # app/routers/financial_movements.py
 from datetime import date
-from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
+from itertools import groupby
+from typing import Dict, Iterator, List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, UploadFile, File
+from sqlalchemy import tuple_
+from sqlalchemy.orm import aliased
 from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from pydantic import BaseModel
 import pandas as pd
+import base64
 import io
 from datetime import datetime
 
-from ..db import get_session
-from ..deps import get_current_user
+from ..db import engine, get_async_session, get_session
+from ..deps import get_current_user, get_current_user_async
 from ..models import User, Property, FinancialMovement, ClassificationRule
+from ..responses import FastJSONResponse, check_list_format, columnar
+from ..services.exports import EXPORT_FORMATS, export_response
+from ..services.jobs import job_tracker
 
 router = APIRouter(prefix="/financial-movements", tags=["financial-movements"])
 
+# Pasos de una importación de Excel (progreso publicado en /events/stream)
+EXCEL_IMPORT_STEPS = ["Leyendo fichero", "Procesando movimientos", "Guardando movimientos"]
+
 # Pydantic models para request/response
 class FinancialMovementCreate(BaseModel):
     property_id: int
@@ -46,48 +57,172 @@ class FinancialMovementResponse(BaseModel):
     is_classified: bool
     bank_balance: Optional[float] = None
 
+# Campos de FinancialMovementResponse (proyección con fields=)
+MOVEMENT_FIELDS = list(FinancialMovementResponse.model_fields)
+# Tamaño máximo de página del listado
+MAX_MOVEMENTS_PAGE = 5000
+# Columnas de la exportación (CSV/XLSX) y filas leídas por lote
+EXPORT_COLUMNS = [
+    "id", "date", "property_id", "property_address", "concept", "amount",
+    "category", "subcategory", "tenant_name", "bank_balance", "is_classified"
+]
+EXPORT_BATCH_SIZE = 1000
+LEDGER_COLUMNS = ["month", "date", "concept", "category", "subcategory", "tenant_name", "income", "expense", "balance"]
+LEDGER_SUMMARY_COLUMNS = ["month", "income", "expenses", "net", "movements_count"]
+MONTH_NAMES = [
+    'Enero', 'Febrero', 'Marzo', 'Abril', 'Mayo', 'Junio',
+    'Julio', 'Agosto', 'Septiembre', 'Octubre', 'Noviembre', 'Diciembre'
+]
+
 class BulkMovementUpload(BaseModel):
     movements: List[dict]
 
+def _visible_movements(user_id: int):
+    """Movements of the user's properties plus the user's unassigned ones (ownership via subquery)"""
+    owned_properties = select(Property.id).where(Property.owner_id == user_id)
+    return (
+        FinancialMovement.property_id.in_(owned_properties) |
+        ((FinancialMovement.property_id.is_(None)) & (FinancialMovement.user_id == user_id))
+    )
+
+def _movement_filter(
+    user_id: int,
+    property_id: Optional[int],
+    category: Optional[str],
+    start_date: Optional[date],
+    end_date: Optional[date]
+):
+    query_filter = _visible_movements(user_id)
+    if property_id:
+        query_filter &= FinancialMovement.property_id == property_id
+    if category:
+        query_filter &= FinancialMovement.category == category
+    if start_date:
+        query_filter &= FinancialMovement.date >= start_date
+    if end_date:
+        query_filter &= FinancialMovement.date <= end_date
+    return query_filter
+
+def _export_movement_rows(query_filter) -> Iterator[Dict]:
+    """Movimientos filtrados en lotes (yield_per), con su propia sesión para durar todo el streaming"""
+    # Alias: la subconsulta de propiedades del usuario no debe correlacionarse con el join
+    movement_property = aliased(Property)
+    statement = (
+        select(
+            *[getattr(FinancialMovement, column) for column in EXPORT_COLUMNS if column != "property_address"],
+            movement_property.address.label("property_address")
+        )
+        .outerjoin(movement_property, movement_property.id == FinancialMovement.property_id)
+        .where(query_filter)
+        .order_by(FinancialMovement.date, FinancialMovement.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    with Session(engine) as session:
+        for row in session.exec(statement):
+            yield dict(row._mapping)
+
+def _encode_cursor(movement_date: date, movement_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{movement_date.isoformat()}|{movement_id}".encode()).decode().rstrip("=")
+
+def _decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        movement_date, movement_id = raw.split("|")
+        return date.fromisoformat(movement_date), int(movement_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    if fields is None:
+        return None
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in MOVEMENT_FIELDS]
+    if unknown or not requested:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid fields: {', '.join(unknown) or '(empty)'}. Allowed: {', '.join(MOVEMENT_FIELDS)}"
+        )
+    return requested
+
 @router.get("/", response_model=List[FinancialMovementResponse])
-def get_financial_movements(
+async def get_financial_movements(
+    request: Request,
+    response: Response,
     property_id: Optional[int] = None,
     category: Optional[str] = None,
     start_date: Optional[date] = None,
     end_date: Optional[date] = None,
-    session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user)
+    limit: Optional[int] = Query(None, ge=1, le=MAX_MOVEMENTS_PAGE, description="Page size (keyset pagination)"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+    order: str = Query("asc", description="asc | desc, by (date, id)"),
+    fields: Optional[str] = Query(None, description="Comma-separated subset of fields, e.g. id,date,amount"),
+    format: str = Query("rows", description="rows | columnar (one array per field)"),
+    session: AsyncSession = Depends(get_async_session),
+    current_user: User = Depends(get_current_user_async)
 ):
-    """Get financial movements with optional filters"""
-    # Get user's property IDs for filtering
-    user_properties = session.exec(
-        select(Property).where(Property.owner_id == current_user.id)
-    ).all()
-    property_ids = [prop.id for prop in user_properties]
+    """
+    Get financial movements with optional filters, ordered by (date, id).
+
+    With `limit` the list is paginated by keyset: when there are more rows the
+    response carries `X-Next-Cursor` (and a `Link: rel="next"` header); pass it
+    back as `cursor` for the next page. `fields` returns only those fields and
+    `format=columnar` returns `{"format", "count", "movements": {field: [...]}}`.
+    """
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="Invalid order. Allowed: asc, desc")
+    check_list_format(format)
+    requested_fields = _parse_fields(fields)
     
     # Include both movements assigned to user properties AND unassigned movements for the user
-    if property_ids:
-        query = select(FinancialMovement).where(
-            (FinancialMovement.property_id.in_(property_ids)) |
-            ((FinancialMovement.property_id.is_(None)) & (FinancialMovement.user_id == current_user.id))
-        )
-    else:
-        # If user has no properties, only show their unassigned movements
-        query = select(FinancialMovement).where(
-            (FinancialMovement.property_id.is_(None)) & (FinancialMovement.user_id == current_user.id)
-        )
+    query_filter = _movement_filter(current_user.id, property_id, category, start_date, end_date)
     
-    if property_id:
-        query = query.where(FinancialMovement.property_id == property_id)
-    if category:
-        query = query.where(FinancialMovement.category == category)
-    if start_date:
-        query = query.where(FinancialMovement.date >= start_date)
-    if end_date:
-        query = query.where(FinancialMovement.date <= end_date)
+    # Keyset: continuar estrictamente después de (fecha, id) del último de la página anterior
+    key = tuple_(FinancialMovement.date, FinancialMovement.id)
+    if cursor:
+        after = _decode_cursor(cursor)
+        query_filter &= (key > after) if order == "asc" else (key < after)
+    ordering = (
+        (FinancialMovement.date, FinancialMovement.id) if order == "asc"
+        else (FinancialMovement.date.desc(), FinancialMovement.id.desc())
+    )
     
-    movements = session.exec(query).all()
-    return movements
+    # Solo las columnas pedidas (más fecha e id para el cursor)
+    selected = requested_fields or MOVEMENT_FIELDS
+    columns = list(dict.fromkeys([*selected, "date", "id"]))
+    query = select(*[getattr(FinancialMovement, column) for column in columns]).where(query_filter).order_by(*ordering)
+    if limit:
+        query = query.limit(limit + 1)
+    rows = (await session.exec(query)).all()
+    
+    if limit and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1].date, rows[-1].id)
+        next_url = request.url.include_query_params(cursor=next_cursor)
+        response.headers["X-Next-Cursor"] = next_cursor
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+    
+    # Filas leídas columna a columna del ORM: se serializan sin revalidar contra el response_model
+    movements = [{column: getattr(row, column) for column in selected} for row in rows]
+    if format == "columnar":
+        content = {"format": "columnar", "count": len(movements), "movements": columnar(movements, selected)}
+        return FastJSONResponse(content, headers=dict(response.headers))
+    return FastJSONResponse(movements, headers=dict(response.headers))
+
+@router.get("/export")
+def export_financial_movements(
+    property_id: Optional[int] = None,
+    category: Optional[str] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    format: str = Query("csv", description="csv | xlsx"),
+    current_user: User = Depends(get_current_user)
+):
+    """Download the movements matching the filters as CSV or XLSX, streamed in batches"""
+    check_list_format(format, EXPORT_FORMATS)
+    query_filter = _movement_filter(current_user.id, property_id, category, start_date, end_date)
+    return export_response(format, "movimientos", [
+        ("Movimientos", EXPORT_COLUMNS, _export_movement_rows(query_filter))
+    ])
 
 @router.post("/", response_model=FinancialMovementResponse)
 def create_financial_movement(
@@ -316,8 +451,10 @@ def upload_excel_bank_statement(
     if not file.filename.lower().endswith(('.xls', '.xlsx')):
         raise HTTPException(status_code=400, detail="Only Excel files (.xls, .xlsx) are allowed")
     
+    job = job_tracker.start(current_user.id, "excel_import", EXCEL_IMPORT_STEPS)
     try:
         # Read Excel file
+        job_tracker.step(job, "Leyendo fichero")
         contents = file.file.read()
         df = pd.read_excel(io.BytesIO(contents))
         
@@ -352,7 +489,9 @@ def upload_excel_bank_statement(
         created_movements = []
         errors = []
         
+        job_tracker.step(job, "Procesando movimientos")
         for index, row in df.iterrows():
+            job_tracker.progress(job, index, len(df), created=len(created_movements), errors=len(errors))
             try:
                 # Parse date
                 if pd.isna(row['Fecha']):
@@ -416,16 +555,20 @@ def upload_excel_bank_statement(
                 continue
         
         # Commit all valid movements
+        job_tracker.step(job, "Guardando movimientos")
         session.commit()
+        job_tracker.finish(job, total_rows=len(df), created=len(created_movements), errors=len(errors))
         
         return {
             "message": f"Successfully processed Excel file",
+            "job_id": job.id,
             "created_movements": len(created_movements),
             "total_rows": len(df),
             "errors": errors[:10]  # Limit to first 10 errors
         }
         
     except Exception as e:
+        job_tracker.fail(job, str(e))
         raise HTTPException(status_code=400, detail=f"Error processing Excel file: {str(e)}")
 
 @router.post("/upload-excel-global")
@@ -441,8 +584,10 @@ def upload_excel_global_movements(
     if not file.filename.lower().endswith(('.xls', '.xlsx')):
         raise HTTPException(status_code=400, detail="Only Excel files (.xls, .xlsx) are allowed")
     
+    job = job_tracker.start(current_user.id, "excel_import", EXCEL_IMPORT_STEPS)
     try:
         # Read Excel file
+        job_tracker.step(job, "Leyendo fichero")
         print("EXCEL PARSING: Reading file contents...")
         contents = file.file.read()
         print(f"EXCEL PARSING: File size: {len(contents)} bytes")
@@ -514,7 +659,12 @@ def upload_excel_global_movements(
         
         print(f"EXCEL PROCESSING: Starting to process {len(df)} rows from Excel")
         
+        job_tracker.step(job, "Procesando movimientos")
         for index, row in df.iterrows():
+            job_tracker.progress(
+                job, index, len(df),
+                created=len(created_movements), duplicates_skipped=duplicates_skipped, errors=len(errors)
+            )
             print(f"EXCEL PROCESSING: Processing row {index + 1}")
             try:
                 # Parse date
@@ -607,12 +757,18 @@ def upload_excel_global_movements(
                 continue
         
         # Commit all valid movements
+        job_tracker.step(job, "Guardando movimientos")
         session.commit()
+        job_tracker.finish(
+            job, total_rows=len(df), created=len(created_movements),
+            duplicates_skipped=duplicates_skipped, errors=len(errors)
+        )
         
         print(f"EXCEL SUMMARY: Total rows: {len(df)}, Created: {len(created_movements)}, Duplicates: {duplicates_skipped}, Errors: {len(errors)}")
         
         return {
             "message": f"Successfully processed Excel file",
+            "job_id": job.id,
             "created_movements": len(created_movements),
             "total_rows": len(df),
             "duplicates_skipped": duplicates_skipped,
@@ -620,6 +776,7 @@ def upload_excel_global_movements(
         }
         
     except Exception as e:
+        job_tracker.fail(job, str(e))
         print(f"EXCEL ERROR: Exception occurred: {str(e)}")
         print(f"EXCEL ERROR: Exception type: {type(e).__name__}")
         import traceback
@@ -843,4 +1000,63 @@ def get_property_monthly_breakdown(
         "property_id": property_id,
         "year": year,
         "monthly_data": [monthly_data[i] for i in range(1, 13)]
-    }
\ No newline at end of file
+    }
+
+def _month_totals() -> Dict[int, Dict]:
+    return {
+        number: {"month": name, "income": 0.0, "expenses": 0.0, "movements_count": 0}
+        for number, name in enumerate(MONTH_NAMES, 1)
+    }
+
+def _ledger_rows(query_filter, totals: Dict[int, Dict]) -> Iterator[Dict]:
+    """Asientos en orden con saldo acumulado del mes; acumula los totales mensuales en `totals`"""
+    balance = 0.0
+    current_month = None
+    for movement in _export_movement_rows(query_filter):
+        month_number = movement["date"].month
+        if month_number != current_month:
+            current_month, balance = month_number, 0.0
+        amount = movement["amount"]
+        balance += amount
+        month_totals = totals[month_number]
+        month_totals["movements_count"] += 1
+        if amount > 0:
+            month_totals["income"] += amount
+        else:
+            month_totals["expenses"] += abs(amount)
+        yield {
+            **movement,
+            "month": MONTH_NAMES[month_number - 1],
+            "income": amount if amount > 0 else 0.0,
+            "expense": abs(amount) if amount < 0 else 0.0,
+            "balance": round(balance, 2)
+        }
+
+def _ledger_sheets(query_filter, year: int):
+    """Una hoja por mes con movimientos y al final el resumen mensual"""
+    totals = _month_totals()
+    for month, rows in groupby(_ledger_rows(query_filter, totals), key=lambda row: row["month"]):
+        yield f"{month} {year}", LEDGER_COLUMNS, rows
+    summary = [{**month_totals, "net": month_totals["income"] - month_totals["expenses"]} for month_totals in totals.values()]
+    yield f"Resumen {year}", LEDGER_SUMMARY_COLUMNS, summary
+
+@router.get("/property/{property_id}/monthly/export")
+def export_property_monthly_ledger(
+    property_id: int,
+    year: Optional[int] = None,
+    format: str = Query("xlsx", description="xlsx (one sheet per month plus summary) | csv"),
+    session: Session = Depends(get_session),
+    current_user: User = Depends(get_current_user)
+):
+    """Download the property's monthly ledger (every movement with the month's running balance)"""
+    check_list_format(format, EXPORT_FORMATS)
+    property_obj = session.get(Property, property_id)
+    if not property_obj or property_obj.owner_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Property not found")
+    
+    year = year or datetime.now().year
+    query_filter = _movement_filter(current_user.id, property_id, None, date(year, 1, 1), date(year, 12, 31))
+    filename = f"libro_mensual_{property_id}_{year}"
+    if format == "csv":
+        return export_response(format, filename, [("Libro", LEDGER_COLUMNS, _ledger_rows(query_filter, _month_totals()))])
+    return export_response(format, filename, _ledger_sheets(query_filter, year))
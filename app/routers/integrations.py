@@ -2,17 +2,22 @@
 from fastapi import APIRouter, Depends, HTTPException
 from typing import Dict, List, Optional
 from datetime import date, datetime, timedelta
-from sqlmodel import Session, select
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from pydantic import BaseModel
 import httpx
 import asyncio
-from ..db import get_session
-from ..deps import get_current_user
+from ..db import get_async_session
+from ..deps import get_current_user_async
 from ..models import Property, EuriborRate, FinancialMovement
 from ..services.bankinter_client import download_bankinter_data, BankinterClient
+from ..services.jobs import job_tracker
 
 router = APIRouter(prefix="/integrations", tags=["integrations"])
 
+# Pasos de una sincronización con Bankinter (progreso publicado en /events/stream)
+BANKINTER_SYNC_STEPS = ["Descargando transacciones", "Importando a sistema"]
+
 class MarketPrice(BaseModel):
     property_id: int
     estimated_value: float
@@ -58,11 +63,11 @@ class BankTestRequest(BaseModel):
 
 @router.get("/market-prices")
 async def get_market_prices(
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
     """Obtener precios de mercado estimados para las propiedades"""
     
-    properties = session.exec(select(Property)).all()
+    properties = (await session.exec(select(Property))).all()
     
     market_data = []
     
@@ -123,7 +128,7 @@ async def get_market_prices(
 
 @router.get("/bank-connections")
 async def get_bank_connections(
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
     """Obtener estado de conexiones bancarias (PSD2)"""
     
@@ -164,7 +169,7 @@ async def get_bank_connections(
 @router.post("/sync-bank-transactions")
 async def sync_bank_transactions(
     bank_name: str,
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
     """Sincronizar transacciones bancarias autom[INFO]ticamente"""
     
@@ -208,7 +213,7 @@ async def sync_bank_transactions(
 async def get_calendar_events(
     start_date: Optional[date] = None,
     end_date: Optional[date] = None,
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
     """Obtener eventos de calendario relacionados con propiedades"""
     
@@ -217,7 +222,7 @@ async def get_calendar_events(
     if not end_date:
         end_date = start_date + timedelta(days=90)
     
-    properties = session.exec(select(Property)).all()
+    properties = (await session.exec(select(Property))).all()
     
     events = []
     
@@ -267,7 +272,7 @@ async def get_calendar_events(
 
 @router.get("/euribor-sync")
 async def sync_euribor_rates(
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
     """Sincronizar tasas Euribor desde fuentes oficiales"""
     
@@ -277,9 +282,9 @@ async def sync_euribor_rates(
     today = date.today()
     
     # Verificar si ya tenemos datos de hoy
-    existing_rate = session.exec(
+    existing_rate = (await session.exec(
         select(EuriborRate).where(EuriborRate.date == today)
-    ).first()
+    )).first()
     
     if existing_rate:
         return {
@@ -311,8 +316,8 @@ async def sync_euribor_rates(
     )
     
     session.add(new_rate)
-    session.commit()
-    session.refresh(new_rate)
+    await session.commit()
+    await session.refresh(new_rate)
     
     return {
         "status": "updated",
@@ -325,11 +330,11 @@ async def sync_euribor_rates(
 @router.get("/insurance-quotes")
 async def get_insurance_quotes(
     property_id: int,
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
     """Obtener cotizaciones de seguros para una propiedad"""
     
-    property_data = session.get(Property, property_id)
+    property_data = await session.get(Property, property_id)
     if not property_data:
         raise HTTPException(status_code=404, detail="Property not found")
     
@@ -391,11 +396,11 @@ async def get_insurance_quotes(
 
 @router.get("/property-management-services")
 async def get_property_management_services(
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
     """Obtener servicios de gesti[INFO]n inmobiliaria disponibles"""
     
-    properties = session.exec(select(Property)).all()
+    properties = (await session.exec(select(Property))).all()
     
     # Simulaci[INFO]n de servicios de gesti[INFO]n
     services = [
@@ -455,7 +460,7 @@ async def get_property_management_services(
 
 @router.get("/status")
 async def get_integrations_status(
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
     """Obtener estado de todas las integraciones"""
     
@@ -529,7 +534,7 @@ async def get_integrations_status(
 @router.post("/connect/{service_id}")
 async def connect_integration(
     service_id: str,
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
     """Conectar con un servicio espec[INFO]fico"""
     
@@ -620,7 +625,7 @@ async def connect_integration(
 @router.post("/disconnect/{service_id}")
 async def disconnect_integration(
     service_id: str,
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
     """Desconectar un servicio espec[INFO]fico"""
     
@@ -636,7 +641,7 @@ async def disconnect_integration(
 
 @router.get("/bank-sync")
 async def get_bank_transactions(
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
     """Obtener transacciones bancarias sincronizadas"""
     
@@ -702,7 +707,7 @@ async def get_bank_transactions(
 @router.post("/calendar-export")
 async def export_calendar(
     format: str = "ics",
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
     """Exportar eventos a calendario externo"""
     
@@ -710,7 +715,7 @@ async def export_calendar(
         raise HTTPException(status_code=400, detail="Unsupported format")
     
     # Obtener eventos
-    events_data = await get_calendar_events(session=session, current_user=current_user)
+    events_data = await get_calendar_events(start_date=None, end_date=None, session=session)
     events = events_data["events"]
     
     if format == "ics":
@@ -747,8 +752,8 @@ END:VEVENT
 @router.post("/bankinter/connect")
 async def connect_bankinter(
     config: BankiterConfig,
-    session: Session = Depends(get_session),
-    current_user = Depends(get_current_user)
+    session: AsyncSession = Depends(get_async_session),
+    current_user = Depends(get_current_user_async)
 ):
     """Configurar conexi[INFO]n con Bankinter"""
     
@@ -838,13 +843,15 @@ async def connect_bankinter(
 @router.post("/bankinter/download")
 async def download_bankinter_statements(
     request: BankDownloadRequest,
-    session: Session = Depends(get_session),
-    current_user = Depends(get_current_user)
+    session: AsyncSession = Depends(get_async_session),
+    current_user = Depends(get_current_user_async)
 ):
     """Descargar extractos de Bankinter"""
     
+    job = job_tracker.start(current_user.id, "bankinter_sync", BANKINTER_SYNC_STEPS)
     try:
         # DESCARGA REAL DE DATOS DE BANKINTER
+        job_tracker.step(job, "Descargando transacciones")
         result = await download_bankinter_data(
             request.username, 
             request.password, 
@@ -855,6 +862,7 @@ async def download_bankinter_statements(
             raise HTTPException(status_code=400, detail=result["error"])
         
         imported_count = 0
+        job_tracker.step(job, "Importando a sistema")
         
         # Importar transacciones al sistema si se solicita
         if request.import_to_system:
@@ -864,6 +872,12 @@ async def download_bankinter_statements(
             # Por ahora simulamos la importaci[INFO]n
             imported_count = result["transactions"]
         
+        job_tracker.finish(
+            job,
+            accounts_processed=result["accounts"],
+            transactions_found=result["transactions"],
+            transactions_imported=imported_count
+        )
         return {
             "success": True,
             "message": f"SUCCESS Descarga completada: {result['transactions']} transacciones",
@@ -884,15 +898,17 @@ async def download_bankinter_statements(
             ]
         }
         
-    except HTTPException:
+    except HTTPException as e:
+        job_tracker.fail(job, str(e.detail))
         raise
     except Exception as e:
+        job_tracker.fail(job, str(e))
         raise HTTPException(status_code=500, detail=f"Error en descarga simulada: {str(e)}")
 
 @router.get("/bankinter/status")
 async def get_bankinter_status(
-    session: Session = Depends(get_session),
-    current_user = Depends(get_current_user)
+    session: AsyncSession = Depends(get_async_session),
+    current_user = Depends(get_current_user_async)
 ):
     """Obtener estado de la integraci[INFO]n con Bankinter"""
     
@@ -933,8 +949,8 @@ async def get_bankinter_status(
 @router.post("/bankinter/test-connection")
 async def test_bankinter_connection(
     request: BankTestRequest,
-    session: Session = Depends(get_session),
-    current_user = Depends(get_current_user)
+    session: AsyncSession = Depends(get_async_session),
+    current_user = Depends(get_current_user_async)
 ):
     """Probar conexi[INFO]n con Bankinter sin guardar credenciales"""
     
@@ -1033,8 +1049,8 @@ async def test_bankinter_connection(
 
 @router.post("/bankinter/sync-now")
 async def sync_bankinter_now(
-    session: Session = Depends(get_session),
-    current_user = Depends(get_current_user)
+    session: AsyncSession = Depends(get_async_session),
+    current_user = Depends(get_current_user_async)
 ):
     """Forzar sincronizaci[INFO]n inmediata con Bankinter"""
     
@@ -1046,37 +1062,29 @@ async def sync_bankinter_now(
         "message": "SYNC Iniciando sincronizaci[INFO]n con Bankinter...",
         "estimated_duration": "2-5 minutos",
         "progress_url": f"/integrations/bankinter/sync-progress/{current_user.id}",
+        "events_url": "/events/stream",
         "notification": "Recibir[INFO]s una notificaci[INFO]n cuando termine"
     }
 
 @router.get("/bankinter/sync-progress/{user_id}")
 async def get_sync_progress(
     user_id: int,
-    session: Session = Depends(get_session)
+    current_user = Depends(get_current_user_async)
 ):
-    """Obtener progreso de sincronizaci[INFO]n"""
+    """Obtener progreso de la última sincronización (también se emite en /events/stream)"""
+    if user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Not allowed")
     
-    # TODO: Implementar seguimiento real del progreso
+    job = job_tracker.latest(user_id, "bankinter_sync")
+    if job is None:
+        return {
+            "sync_id": None,
+            "status": "idle",
+            "progress_percentage": 0,
+            "current_step": None,
+            "steps": [],
+            "stats": {},
+            "estimated_completion": None
+        }
     
-    return {
-        "sync_id": f"sync_{user_id}_{int(datetime.now().timestamp())}",
-        "status": "in_progress",  # pending, in_progress, completed, failed
-        "progress_percentage": 75,
-        "current_step": "Procesando transacciones",
-        "steps": [
-            {"step": "Conectando con Bankinter", "status": "completed"},
-            {"step": "Obteniendo cuentas", "status": "completed"},
-            {"step": "Descargando transacciones", "status": "completed"},
-            {"step": "Procesando transacciones", "status": "in_progress"},
-            {"step": "Categorizando movimientos", "status": "pending"},
-            {"step": "Importando a sistema", "status": "pending"}
-        ],
-        "stats": {
-            "accounts_processed": 2,
-            "transactions_found": 156,
-            "transactions_processed": 117,
-            "new_transactions": 23,
-            "duplicate_transactions": 94
-        },
-        "estimated_completion": (datetime.now() + timedelta(minutes=2)).isoformat()
-    }
\ No newline at end of file
+    return {"sync_id": job.id, **job.to_dict()}
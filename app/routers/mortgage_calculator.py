@@ -1,16 +1,26 @@
 # app/routers/mortgage_calculator.py
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Query
 from typing import Dict, List, Optional
 from datetime import date, datetime, timedelta
+from dateutil.relativedelta import relativedelta
 from sqlmodel import Session, select
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from ..db import get_session
 from ..deps import get_current_user
-from ..models import MortgageDetails, EuriborRate
-import math
+from ..models import MortgageDetails, MortgagePrepayment, MortgageRevision, EuriborRate, Property
+from ..services.amortization import AnnuityLoan
+from ..services.mortgage_calculator import DEFAULT_EURIBOR, REDUCE_PAYMENT, REDUCE_TERM, MortgageCalculator
+from ..services.refinancing import RefinanceOption, compare_refinancing
 
 router = APIRouter(prefix="/mortgage-calculator", tags=["mortgage-calculator"])
 
+# Máximo de filas de la tabla de amortización por página
+MAX_SCHEDULE_PAGE = 600
+
+# Rentabilidad alternativa del efectivo (% anual) para descontar flujos
+DEFAULT_DISCOUNT_RATE = 2.0
+MAX_REFINANCE_OFFERS = 50
+
 class AmortizationRequest(BaseModel):
     property_id: int
     prepayment_amount: float
@@ -23,6 +33,43 @@ class MortgageSimulation(BaseModel):
     term_years: int
     start_date: date
 
+class RefinanceOffer(BaseModel):
+    name: Optional[str] = None
+    annual_rate: Optional[float] = None  # Tipo fijo (TIN)
+    margin: Optional[float] = None  # Diferencial sobre el Euribor actual si no hay tipo fijo
+    fees: float = Field(0.0, ge=0)  # Gastos fijos de la operación
+    fees_percentage: float = Field(0.0, ge=0)  # Comisión de apertura sobre el nuevo capital
+    term_years: Optional[int] = Field(None, ge=1, le=50)  # Por defecto, el plazo restante actual
+
+class RefinanceComparison(BaseModel):
+    property_id: int
+    offers: List[RefinanceOffer] = Field(..., min_length=1, max_length=MAX_REFINANCE_OFFERS)
+    available_cash: float = Field(0.0, ge=0)  # Efectivo para amortizar antes de subrogar/refinanciar
+    discount_rate: float = DEFAULT_DISCOUNT_RATE
+    cancellation_fee_percentage: float = Field(0.0, ge=0)  # Comisión de cancelación de la hipoteca actual
+    mix_steps: int = Field(10, ge=1, le=100)
+
+def latest_euribor_12m(session: Session) -> Optional[float]:
+    """Euribor 12M más reciente, o None si no hay datos"""
+    latest_euribor = session.exec(
+        select(EuriborRate).order_by(EuriborRate.date.desc())
+    ).first()
+    return latest_euribor.rate_12m if latest_euribor else None
+
+def mortgage_plan_inputs(session: Session, mortgage: MortgageDetails):
+    """Revisiones y amortizaciones de la hipoteca, entradas del plan común"""
+    revisions = session.exec(
+        select(MortgageRevision).where(MortgageRevision.mortgage_id == mortgage.id)
+    ).all()
+    prepayments = session.exec(
+        select(MortgagePrepayment).where(MortgagePrepayment.mortgage_id == mortgage.id)
+    ).all()
+    return revisions, prepayments
+
+def mortgage_position(session: Session, mortgage: MortgageDetails) -> Dict:
+    """Posición actual de la hipoteca según el plan común (revisiones y amortizaciones incluidas)"""
+    return MortgageCalculator.current_position(mortgage, *mortgage_plan_inputs(session, mortgage))
+
 @router.get("/current-payment/{property_id}")
 def get_current_mortgage_payment(
     property_id: int,
@@ -37,31 +84,22 @@ def get_current_mortgage_payment(
     if not mortgage:
         return {"error": "No hay hipoteca registrada para esta propiedad"}
     
-    # Obtener la tasa Euribor más reciente
-    latest_euribor = session.exec(
-        select(EuriborRate).order_by(EuriborRate.date.desc())
-    ).first()
-    
-    current_euribor = latest_euribor.rate_12m if latest_euribor else 3.5
-    current_rate = current_euribor + mortgage.margin_percentage
-    
-    # Calcular pago mensual actual
-    monthly_payment = calculate_monthly_payment_detailed(
-        mortgage.outstanding_balance,
-        current_rate,
-        mortgage.start_date,
-        mortgage.end_date
-    )
+    # Cuota, tipo y saldo del mes actual según el mismo plan que /mortgage-details/{id}/summary
+    position = mortgage_position(session, mortgage)
+    # Euribor de la revisión vigente (euribor + diferencial = tipo total); sin Euribor en las fijas
+    current_euribor = None
+    if mortgage.mortgage_type != "Fija":
+        current_euribor = round(position["annual_rate"] - mortgage.margin_percentage, 4)
     
     return {
         "property_id": property_id,
-        "outstanding_balance": mortgage.outstanding_balance,
+        "outstanding_balance": position["balance"],
         "current_euribor": current_euribor,
         "margin": mortgage.margin_percentage,
-        "total_rate": current_rate,
-        "monthly_payment": monthly_payment,
-        "remaining_months": calculate_remaining_months(mortgage.end_date),
-        "total_interest_remaining": calculate_total_interest_remaining(mortgage, current_rate)
+        "total_rate": position["annual_rate"],
+        "monthly_payment": position["payment"],
+        "remaining_months": position["remaining_months"],
+        "total_interest_remaining": position["remaining_interest"]
     }
 
 @router.post("/simulate-prepayment")
@@ -78,107 +116,96 @@ def simulate_prepayment(
     if not mortgage:
         return {"error": "No hay hipoteca registrada para esta propiedad"}
     
-    # Obtener tasa actual
-    latest_euribor = session.exec(
-        select(EuriborRate).order_by(EuriborRate.date.desc())
-    ).first()
-    
-    current_euribor = latest_euribor.rate_12m if latest_euribor else 3.5
-    annual_rate = current_euribor + mortgage.margin_percentage
-    
-    # Escenario actual (sin amortización)
-    current_scenario = calculate_amortization_schedule(
-        mortgage.outstanding_balance,
-        annual_rate,
-        mortgage.start_date,
-        mortgage.end_date
-    )
-    
-    # Escenario con amortización anticipada
-    new_principal = mortgage.outstanding_balance - request.prepayment_amount
-    
-    if request.reduce_term:
-        # Mantener la cuota, reducir plazo
-        current_monthly = current_scenario["monthly_payment"]
-        new_end_date = calculate_new_end_date(new_principal, annual_rate, current_monthly, request.prepayment_date)
-        new_scenario = calculate_amortization_schedule(
-            new_principal,
-            annual_rate,
-            request.prepayment_date,
-            new_end_date,
-            fixed_payment=current_monthly
-        )
-    else:
-        # Mantener el plazo, reducir cuota
-        new_scenario = calculate_amortization_schedule(
-            new_principal,
-            annual_rate,
-            request.prepayment_date,
-            mortgage.end_date
-        )
-    
-    # Calcular ahorros
-    current_total_interest = sum(payment["interest"] for payment in current_scenario["schedule"])
-    new_total_interest = sum(payment["interest"] for payment in new_scenario["schedule"])
+    # Mantener la cuota y reducir plazo, o mantener el plazo y reducir cuota
+    strategy = REDUCE_TERM if request.reduce_term else REDUCE_PAYMENT
+    
+    # Escenario actual (sin amortización) y con la amortización añadida al plan común
+    revisions, prepayments = mortgage_plan_inputs(session, mortgage)
+    with_prepayment = [*prepayments, MortgagePrepayment(
+        mortgage_id=mortgage.id,
+        payment_date=request.prepayment_date,
+        amount=request.prepayment_amount
+    )]
+    current = MortgageCalculator.current_position(mortgage, revisions, prepayments, strategy=strategy)
+    new = MortgageCalculator.current_position(mortgage, revisions, with_prepayment, strategy=strategy)
+    # Cuota vigente tras la amortización
+    new_payment_date = max(date.today(), request.prepayment_date + relativedelta(months=1))
+    new_payment = round(MortgageCalculator.current_position(
+        mortgage, revisions, with_prepayment, as_of_date=new_payment_date, strategy=strategy
+    )["payment"], 2)
+    
+    # Ahorros sobre lo que queda por pagar desde hoy (forma cerrada, sin generar la tabla)
+    current_total_interest = current["remaining_interest"]
+    new_total_interest = new["remaining_interest"]
     interest_savings = current_total_interest - new_total_interest
     
-    months_saved = len(current_scenario["schedule"]) - len(new_scenario["schedule"]) if request.reduce_term else 0
-    monthly_savings = current_scenario["monthly_payment"] - new_scenario["monthly_payment"] if not request.reduce_term else 0
+    current_months = current["remaining_months"]
+    new_months = new["remaining_months"]
+    current_payment = round(current["payment"], 2)
+    
+    months_saved = current_months - new_months if request.reduce_term else 0
+    monthly_savings = current_payment - new_payment if not request.reduce_term else 0
     
     return {
         "prepayment_amount": request.prepayment_amount,
-        "strategy": "reduce_term" if request.reduce_term else "reduce_payment",
+        "strategy": strategy,
         "current_scenario": {
-            "monthly_payment": current_scenario["monthly_payment"],
+            "monthly_payment": current_payment,
             "total_interest": current_total_interest,
-            "remaining_months": len(current_scenario["schedule"]),
-            "end_date": mortgage.end_date.isoformat()
+            "remaining_months": current_months,
+            "end_date": current["end_date"].isoformat()
         },
         "new_scenario": {
-            "monthly_payment": new_scenario["monthly_payment"],
+            "monthly_payment": new_payment,
             "total_interest": new_total_interest,
-            "remaining_months": len(new_scenario["schedule"]),
-            "end_date": new_scenario["end_date"]
+            "remaining_months": new_months,
+            "end_date": new["end_date"].isoformat()
         },
         "savings": {
             "interest_savings": round(interest_savings, 2),
             "months_saved": months_saved,
             "monthly_savings": round(monthly_savings, 2),
-            "total_savings": round(interest_savings + (monthly_savings * len(new_scenario["schedule"])), 2)
+            "total_savings": round(interest_savings + (monthly_savings * new_months), 2)
         }
     }
 
 @router.post("/simulate-mortgage")
 def simulate_new_mortgage(
     simulation: MortgageSimulation,
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_SCHEDULE_PAGE),
     session: Session = Depends(get_session),
     current_user = Depends(get_current_user)
 ):
-    """Simular una nueva hipoteca"""
-    end_date = simulation.start_date.replace(year=simulation.start_date.year + simulation.term_years)
-    
-    amortization = calculate_amortization_schedule(
+    """Simular una nueva hipoteca (tabla completa paginada con offset/limit)"""
+    loan = AnnuityLoan(
         simulation.loan_amount,
         simulation.annual_rate,
         simulation.start_date,
-        end_date
+        simulation.term_years * 12
     )
     
-    total_interest = sum(payment["interest"] for payment in amortization["schedule"])
+    total_interest = loan.total_interest()
     total_paid = simulation.loan_amount + total_interest
     
-    return {
+    result = {
         "loan_amount": simulation.loan_amount,
         "annual_rate": simulation.annual_rate,
         "term_years": simulation.term_years,
-        "monthly_payment": amortization["monthly_payment"],
+        "monthly_payment": round(loan.payment, 2),
         "total_interest": round(total_interest, 2),
         "total_paid": round(total_paid, 2),
         "schedule_summary": {
-            "first_6_months": amortization["schedule"][:6],
-            "total_payments": len(amortization["schedule"])
+            "first_6_months": list(loan.rows(0, 6)),
+            "total_payments": loan.payoff_month()
         }
     }
+    
+    # Solo se materializan filas adicionales si se piden
+    if limit is not None:
+        result["schedule"] = loan.page(offset, limit)
+    
+    return result
 
 @router.get("/rate-evolution/{property_id}")
 def get_rate_evolution_impact(
@@ -204,15 +231,11 @@ def get_rate_evolution_impact(
     
     # Simular pagos con diferentes escenarios
     scenarios = []
-    current_rate = euribor_rates[0].rate_12m + mortgage.margin_percentage
     
-    # Escenario actual
-    current_payment = calculate_monthly_payment_detailed(
-        mortgage.outstanding_balance,
-        current_rate,
-        mortgage.start_date,
-        mortgage.end_date
-    )
+    # Escenario actual: tipo y cuota vigentes según el plan
+    position = mortgage_position(session, mortgage)
+    current_rate = position["annual_rate"]
+    current_payment = position["payment"]
     
     # Escenarios de estrés
     stress_scenarios = [
@@ -224,12 +247,7 @@ def get_rate_evolution_impact(
     
     for scenario in stress_scenarios:
         new_rate = current_rate + scenario["rate_change"]
-        new_payment = calculate_monthly_payment_detailed(
-            mortgage.outstanding_balance,
-            new_rate,
-            mortgage.start_date,
-            mortgage.end_date
-        )
+        new_payment = MortgageCalculator.current_loan(position, annual_rate=new_rate).payment
         
         scenarios.append({
             "scenario": scenario["name"],
@@ -256,110 +274,51 @@ def get_rate_evolution_impact(
         ]
     }
 
-def calculate_monthly_payment_detailed(principal: float, annual_rate: float, start_date: date, end_date: date) -> float:
-    """Calcular pago mensual detallado"""
-    monthly_rate = annual_rate / 100 / 12
-    
-    # Calcular meses restantes
-    today = date.today()
-    months_remaining = (end_date.year - today.year) * 12 + (end_date.month - today.month)
+@router.post("/compare")
+def compare_refinancing_offers(
+    request: RefinanceComparison,
+    session: Session = Depends(get_session),
+    current_user = Depends(get_current_user)
+):
+    """Comparar ofertas de refinanciación con la hipoteca actual (VAN, punto de equilibrio y coste total)"""
+    mortgage = session.exec(
+        select(MortgageDetails).where(MortgageDetails.property_id == request.property_id)
+    ).first()
+    property_obj = session.get(Property, request.property_id)
     
-    if months_remaining <= 0 or monthly_rate == 0:
-        return principal / 1 if months_remaining <= 0 else 0
+    if not mortgage or not property_obj or property_obj.owner_id != current_user.id:
+        return {"error": "No hay hipoteca registrada para esta propiedad"}
     
-    # Fórmula de amortización francesa
-    monthly_payment = principal * (monthly_rate * (1 + monthly_rate)**months_remaining) / ((1 + monthly_rate)**months_remaining - 1)
-    return monthly_payment
-
-def calculate_remaining_months(end_date: date) -> int:
-    """Calcular meses restantes"""
-    today = date.today()
-    return max(0, (end_date.year - today.year) * 12 + (end_date.month - today.month))
-
-def calculate_total_interest_remaining(mortgage: MortgageDetails, annual_rate: float) -> float:
-    """Calcular intereses totales restantes"""
-    monthly_payment = calculate_monthly_payment_detailed(
-        mortgage.outstanding_balance,
-        annual_rate,
-        mortgage.start_date,
-        mortgage.end_date
+    euribor_12m = latest_euribor_12m(session)
+    current_euribor = euribor_12m if euribor_12m is not None else DEFAULT_EURIBOR
+    # Préstamo actual desde su posición en el plan común
+    current_loan = MortgageCalculator.current_loan(mortgage_position(session, mortgage))
+    
+    options = []
+    for index, offer in enumerate(request.offers, start=1):
+        if offer.annual_rate is None and offer.margin is None:
+            raise HTTPException(status_code=400, detail=f"Offer {index}: annual_rate or margin is required")
+        options.append(RefinanceOption(
+            name=offer.name or f"Oferta {index}",
+            annual_rate=offer.annual_rate if offer.annual_rate is not None else current_euribor + offer.margin,
+            term_months=offer.term_years * 12 if offer.term_years else current_loan.term_months,
+            fees=offer.fees,
+            fees_percentage=offer.fees_percentage
+        ))
+    
+    comparison = compare_refinancing(
+        current_loan,
+        options,
+        available_cash=request.available_cash,
+        discount_rate=request.discount_rate,
+        cancellation_fee_percentage=request.cancellation_fee_percentage,
+        mix_steps=request.mix_steps
     )
     
-    remaining_months = calculate_remaining_months(mortgage.end_date)
-    total_payments = monthly_payment * remaining_months
-    return max(0, total_payments - mortgage.outstanding_balance)
-
-def calculate_amortization_schedule(principal: float, annual_rate: float, start_date: date, end_date: date, fixed_payment: Optional[float] = None) -> Dict:
-    """Generar tabla de amortización"""
-    monthly_rate = annual_rate / 100 / 12
-    total_months = (end_date.year - start_date.year) * 12 + (end_date.month - start_date.month)
-    
-    if fixed_payment is None:
-        monthly_payment = principal * (monthly_rate * (1 + monthly_rate)**total_months) / ((1 + monthly_rate)**total_months - 1)
-    else:
-        monthly_payment = fixed_payment
-    
-    schedule = []
-    remaining_balance = principal
-    current_date = start_date
-    
-    while remaining_balance > 1 and len(schedule) < total_months * 2:  # Safety limit
-        interest_payment = remaining_balance * monthly_rate
-        principal_payment = min(monthly_payment - interest_payment, remaining_balance)
-        
-        if principal_payment <= 0:
-            break
-            
-        remaining_balance -= principal_payment
-        
-        schedule.append({
-            "month": len(schedule) + 1,
-            "date": current_date.isoformat(),
-            "payment": round(monthly_payment, 2),
-            "principal": round(principal_payment, 2),
-            "interest": round(interest_payment, 2),
-            "balance": round(remaining_balance, 2)
-        })
-        
-        # Avanzar al siguiente mes
-        if current_date.month == 12:
-            current_date = current_date.replace(year=current_date.year + 1, month=1)
-        else:
-            current_date = current_date.replace(month=current_date.month + 1)
-    
-    final_end_date = schedule[-1]["date"] if schedule else end_date.isoformat()
-    
     return {
-        "monthly_payment": round(monthly_payment, 2),
-        "total_months": len(schedule),
-        "end_date": final_end_date,
-        "schedule": schedule
+        "property_id": request.property_id,
+        "current_euribor": current_euribor,
+        "discount_rate": request.discount_rate,
+        "available_cash": request.available_cash,
+        **comparison
     }
-
-def calculate_new_end_date(principal: float, annual_rate: float, monthly_payment: float, start_date: date) -> date:
-    """Calcular nueva fecha de fin manteniendo la cuota"""
-    monthly_rate = annual_rate / 100 / 12
-    
-    if monthly_rate == 0 or monthly_payment <= 0:
-        months = 360  # Default 30 years
-    else:
-        try:
-            months = math.log(1 + (principal * monthly_rate) / monthly_payment) / math.log(1 + monthly_rate)
-            months = int(math.ceil(months))
-        except (ValueError, ZeroDivisionError):
-            months = 360  # Default fallback
-    
-    years_to_add = months // 12
-    months_to_add = months % 12
-    
-    new_end_date = start_date.replace(year=start_date.year + years_to_add)
-    
-    if new_end_date.month + months_to_add > 12:
-        new_end_date = new_end_date.replace(
-            year=new_end_date.year + 1,
-            month=new_end_date.month + months_to_add - 12
-        )
-    else:
-        new_end_date = new_end_date.replace(month=new_end_date.month + months_to_add)
-    
-    return new_end_date
\ No newline at end of file
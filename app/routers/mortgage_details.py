@@ -1,14 +1,20 @@
 # app/routers/mortgage_details.py
 from datetime import date
-from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from sqlmodel import Session, select
 from pydantic import BaseModel
+import pandas as pd
 
 from ..db import get_session
 from ..deps import get_current_user
 from ..models import User, Property, MortgageDetails, MortgageRevision, MortgagePrepayment
-from ..services.mortgage_calculator import MortgageCalculator
+from ..responses import FastJSONResponse, check_list_format, columnar, json_line
+from ..services.exports import EXPORT_FORMATS, export_response
+from ..services.mortgage_calculator import (
+    MortgageCalculator, REDUCE_PAYMENT, STRATEGIES, Segment, iter_plan_rows, plan_length
+)
 
 router = APIRouter(prefix="/mortgage-details", tags=["mortgage-details"])
 
@@ -325,13 +331,84 @@ def get_mortgage_by_property(
     return mortgage
 
 # Calculation endpoints
+SCHEDULE_FORMATS = {"rows", "columnar", "ndjson"}
+SCHEDULE_COLUMNS = ["month", "payment", "interest", "principal", "balance", "annual_rate", "prepayment"]
+
+def _parse_month(value: Optional[str], param: str) -> Optional[pd.Period]:
+    """Parse a YYYY-MM query parameter into a monthly period"""
+    if value is None:
+        return None
+    try:
+        return pd.Period(value, freq="M")
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail=f"Invalid '{param}' month, expected YYYY-MM")
+
+def _schedule_window(
+    plan: Tuple[Segment, ...],
+    from_month: Optional[pd.Period],
+    to_month: Optional[pd.Period],
+    offset: int,
+    limit: Optional[int]
+) -> Tuple[int, int]:
+    """Plan positions (first, last inclusive) of the [from, to] month window after offset/limit"""
+    first, last = 0, plan_length(plan) - 1
+    if plan:
+        start = plan[0].start_month
+        if from_month is not None:
+            first = max(first, from_month.year * 12 + from_month.month - 1 - start)
+        if to_month is not None:
+            last = min(last, to_month.year * 12 + to_month.month - 1 - start)
+    first += offset
+    if limit is not None:
+        last = min(last, first + limit - 1)
+    return first, last
+
+def _compact_row(row: Dict) -> Dict:
+    """Row with ISO month and values rounded for the compact formats"""
+    return {
+        "month": row["month"].date().isoformat(),
+        "payment": round(row["payment"], 2),
+        "interest": round(row["interest"], 2),
+        "principal": round(row["principal"], 2),
+        "balance": round(row["balance"], 2),
+        "annual_rate": round(row["annual_rate"], 4),
+        "prepayment": round(row["prepayment"], 2)
+    }
+
+def _schedule_columns(rows: List[Dict]) -> Dict[str, list]:
+    """Rows as parallel arrays, one per column"""
+    return columnar(map(_compact_row, rows), SCHEDULE_COLUMNS)
+
+def _schedule_ndjson(rows: Iterable[Dict]) -> Iterator[bytes]:
+    for row in rows:
+        yield json_line(_compact_row(row))
+
+def _check_strategy(strategy: str) -> str:
+    """Validate the prepayment strategy (reduce_payment | reduce_term)"""
+    if strategy not in STRATEGIES:
+        raise HTTPException(status_code=400, detail=f"Invalid strategy. Allowed: {', '.join(sorted(STRATEGIES))}")
+    return strategy
+
+STRATEGY_QUERY = Query(REDUCE_PAYMENT, description="Prepayment strategy: reduce_payment | reduce_term")
+
 @router.get("/{mortgage_id}/calculate-schedule")
 def calculate_amortization_schedule(
     mortgage_id: int,
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1),
+    from_: Optional[str] = Query(None, alias="from", description="First month (YYYY-MM)"),
+    to_: Optional[str] = Query(None, alias="to", description="Last month (YYYY-MM)"),
+    format: str = Query("rows", description="rows | columnar | ndjson"),
+    strategy: str = STRATEGY_QUERY,
     session: Session = Depends(get_session),
     current_user: User = Depends(get_current_user)
 ):
-    """Calculate full amortization schedule"""
+    """Calculate amortization schedule, optionally windowed by month and paginated"""
+    check_list_format(format, SCHEDULE_FORMATS)
+    _check_strategy(strategy)
+    from_month = _parse_month(from_, "from")
+    to_month = _parse_month(to_, "to")
+    
     mortgage = session.get(MortgageDetails, mortgage_id)
     if not mortgage:
         raise HTTPException(status_code=404, detail="Mortgage not found")
@@ -350,21 +427,89 @@ def calculate_amortization_schedule(
         select(MortgagePrepayment).where(MortgagePrepayment.mortgage_id == mortgage_id)
     ).all()
     
-    # Calculate schedule
-    schedule = MortgageCalculator.generate_amortization_schedule(
-        mortgage, revisions, prepayments
-    )
+    # Solo se expanden las filas de la ventana pedida, a partir del plan por segmentos (cacheado)
+    plan = MortgageCalculator.plan(mortgage, revisions, prepayments, strategy)
+    total = plan_length(plan)
+    first, last = _schedule_window(plan, from_month, to_month, offset, limit)
+    rows = iter_plan_rows(plan, first, last) if first <= last else iter(())
+    
+    if format == "ndjson":
+        return StreamingResponse(
+            _schedule_ndjson(rows),
+            media_type="application/x-ndjson",
+            headers={"X-Total-Count": str(total)}
+        )
+    
+    rows = list(rows)
+    # Respuesta ya serializable por orjson (meses como pd.Timestamp incluidos): sin jsonable_encoder
+    if format == "columnar":
+        return FastJSONResponse({
+            "format": "columnar",
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "count": len(rows),
+            "schedule": _schedule_columns(rows)
+        })
+    
+    return FastJSONResponse({
+        "schedule": rows,
+        "total": total,
+        "offset": offset,
+        "limit": limit
+    })
+
+def _export_schedule_rows(rows: Iterable[Dict]) -> Iterator[Dict]:
+    for row in rows:
+        compact = _compact_row(row)
+        # Mes como fecha (celda de fecha en Excel)
+        compact["month"] = row["month"].date()
+        yield compact
+
+@router.get("/{mortgage_id}/schedule/export")
+def export_amortization_schedule(
+    mortgage_id: int,
+    format: str = Query("xlsx", description="xlsx | csv"),
+    strategy: str = STRATEGY_QUERY,
+    session: Session = Depends(get_session),
+    current_user: User = Depends(get_current_user)
+):
+    """Download the full amortization schedule as CSV or XLSX"""
+    check_list_format(format, EXPORT_FORMATS)
+    _check_strategy(strategy)
+    mortgage = session.get(MortgageDetails, mortgage_id)
+    if not mortgage:
+        raise HTTPException(status_code=404, detail="Mortgage not found")
+    
+    # Verify ownership
+    property_obj = session.get(Property, mortgage.property_id)
+    if not property_obj or property_obj.owner_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Mortgage not found")
+    
+    revisions = session.exec(
+        select(MortgageRevision).where(MortgageRevision.mortgage_id == mortgage_id)
+    ).all()
+    
+    prepayments = session.exec(
+        select(MortgagePrepayment).where(MortgagePrepayment.mortgage_id == mortgage_id)
+    ).all()
     
-    return {"schedule": schedule}
+    # Filas generadas a medida que se escribe el fichero
+    plan = MortgageCalculator.plan(mortgage, revisions, prepayments, strategy)
+    return export_response(format, f"cuadro_amortizacion_{mortgage_id}", [
+        ("Cuadro de amortización", SCHEDULE_COLUMNS, _export_schedule_rows(iter_plan_rows(plan)))
+    ])
 
 @router.get("/{mortgage_id}/current-status")
 def get_current_mortgage_status(
     mortgage_id: int,
     as_of_date: Optional[date] = None,
+    strategy: str = STRATEGY_QUERY,
     session: Session = Depends(get_session),
     current_user: User = Depends(get_current_user)
 ):
     """Get current payment and balance"""
+    _check_strategy(strategy)
     mortgage = session.get(MortgageDetails, mortgage_id)
     if not mortgage:
         raise HTTPException(status_code=404, detail="Mortgage not found")
@@ -385,7 +530,7 @@ def get_current_mortgage_status(
     
     # Calculate current status
     status = MortgageCalculator.calculate_current_payment_and_balance(
-        mortgage, revisions, prepayments, as_of_date
+        mortgage, revisions, prepayments, as_of_date, strategy
     )
     
     return status
@@ -393,10 +538,12 @@ def get_current_mortgage_status(
 @router.get("/{mortgage_id}/summary")
 def get_mortgage_summary(
     mortgage_id: int,
+    strategy: str = STRATEGY_QUERY,
     session: Session = Depends(get_session),
     current_user: User = Depends(get_current_user)
 ):
     """Get comprehensive mortgage summary"""
+    _check_strategy(strategy)
     mortgage = session.get(MortgageDetails, mortgage_id)
     if not mortgage:
         raise HTTPException(status_code=404, detail="Mortgage not found")
@@ -417,7 +564,7 @@ def get_mortgage_summary(
     
     # Calculate summary
     summary = MortgageCalculator.calculate_mortgage_summary(
-        mortgage, revisions, prepayments
+        mortgage, revisions, prepayments, strategy
     )
     
     return summary
@@ -483,6 +630,7 @@ def generate_revision_calendar(
 class PrepaymentImpactRequest(BaseModel):
     amount: float
     payment_date: date
+    strategy: str = REDUCE_PAYMENT  # reduce_payment | reduce_term
 
 @router.post("/{mortgage_id}/calculate-prepayment-impact")
 def calculate_prepayment_impact(
@@ -492,6 +640,7 @@ def calculate_prepayment_impact(
     current_user: User = Depends(get_current_user)
 ):
     """Calculate the impact of a potential prepayment"""
+    _check_strategy(prepayment_data.strategy)
     mortgage = session.get(MortgageDetails, mortgage_id)
     if not mortgage:
         raise HTTPException(status_code=404, detail="Mortgage not found")
@@ -513,7 +662,8 @@ def calculate_prepayment_impact(
     # Calculate impact
     impact = MortgageCalculator.calculate_prepayment_impact(
         mortgage, revisions, prepayments,
-        prepayment_data.amount, prepayment_data.payment_date
+        prepayment_data.amount, prepayment_data.payment_date,
+        strategy=prepayment_data.strategy
     )
     
     return impact
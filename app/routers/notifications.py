@@ -1,13 +1,13 @@
 # app/routers/notifications.py
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException
 from typing import Dict, List, Optional
-from datetime import date, datetime, timedelta
-from sqlmodel import Session, select
+from datetime import date, datetime, timedelta, timezone
+from sqlmodel import Session, select, func
 from pydantic import BaseModel
 from ..db import get_session
 from ..deps import get_current_user
-from ..models import Property, RentalContract, FinancialMovement, MortgageDetails, EuriborRate
-import statistics
+from ..models import Property, RentalContract, FinancialMovement, MortgageDetails, EuriborRate, Notification
+from ..services.alerts import evaluate_user_alerts
 
 router = APIRouter(prefix="/notifications", tags=["notifications"])
 
@@ -18,74 +18,74 @@ class NotificationRule(BaseModel):
     email_enabled: bool = False
     sms_enabled: bool = False
 
-class Notification(BaseModel):
-    id: str
-    type: str
-    title: str
-    message: str
-    priority: str  # "high", "medium", "low"
-    property_id: Optional[int] = None
-    amount: Optional[float] = None
-    due_date: Optional[date] = None
-    action_url: Optional[str] = None
-    created_at: datetime
-    read: bool = False
+# Nivel visual de cada tipo de alerta en /alerts
+ALERT_LEVELS = {
+    "payment_due": "warning",
+    "unusual_expense": "warning",
+    "contract_expiring": "warning",
+    "mortgage_review": "info",
+    "savings_opportunity": "success"
+}
+
+ALERT_ACTIONS = {
+    "payment_due": ["Contactar inquilino", "Enviar requerimiento"],
+    "unusual_expense": ["Revisar gastos"],
+    "contract_expiring": ["Renovar contrato", "Contactar inquilino"],
+    "mortgage_review": ["Revisar hipoteca"],
+    "savings_opportunity": ["Simular refinanciación"]
+}
+
+PRIORITY_ORDER = {"high": 3, "medium": 2, "low": 1}
+
+def active_notifications(session: Session, user_id: int, include_read: bool = True) -> List[Notification]:
+    """Alertas activas del usuario (lectura por ix_notification_user_active)"""
+    query = (
+        select(Notification)
+        .where(Notification.user_id == user_id)
+        .where(Notification.is_active == True)
+        .order_by(Notification.created_at.desc())
+    )
+    if not include_read:
+        query = query.where(Notification.read == False)
+    notifications = session.exec(query).all()
+    # Orden estable por prioridad, manteniendo la fecha descendente dentro de cada una
+    return sorted(notifications, key=lambda n: PRIORITY_ORDER.get(n.priority, 0), reverse=True)
+
+def alert_level(notification: Notification) -> str:
+    if notification.type == "contract_expiring" and notification.priority == "high":
+        return "critical"
+    return ALERT_LEVELS.get(notification.type, "info")
 
 @router.get("/alerts")
 def get_active_notifications(
-    session: Session = Depends(get_session)
+    include_read: bool = True,
+    session: Session = Depends(get_session),
+    current_user = Depends(get_current_user)
 ):
     """Obtener todas las notificaciones activas del usuario"""
-    
-    # Simulación de notificaciones (sin autenticación para demo)
     notifications = [
         {
-            "id": "notif_001",
-            "type": "warning",
-            "title": "Pago de alquiler pendiente",
-            "description": "El inquilino del Piso en Calle Mayor, 45 no ha pagado el alquiler de agosto",
-            "created_at": "2025-08-20T10:30:00",
-            "property_id": 1,
-            "amount": 850.0,
-            "due_date": "2025-08-01",
-            "actions": ["Contactar inquilino", "Enviar requerimiento"]
-        },
-        {
-            "id": "notif_002",
-            "type": "info", 
-            "title": "Renovación de seguro próxima",
-            "description": "El seguro de hogar de la propiedad en Av. Andalucía vence en 30 días",
-            "created_at": "2025-08-19T15:45:00",
-            "property_id": 2,
-            "due_date": "2025-09-20",
-            "actions": ["Renovar seguro", "Comparar ofertas"]
-        },
-        {
-            "id": "notif_003",
-            "type": "success",
-            "title": "Oportunidad de ahorro detectada", 
-            "description": "Puedes ahorrar €120/año cambiando de compañía eléctrica en la propiedad de C/ Larga",
-            "created_at": "2025-08-18T09:15:00",
-            "property_id": 3,
-            "amount": 120.0,
-            "actions": ["Ver ofertas", "Cambiar compañía"]
-        },
-        {
-            "id": "notif_004",
-            "type": "critical",
-            "title": "IBI vencido - Recargo por demora",
-            "description": "El IBI del segundo trimestre está vencido y generará recargos",
-            "created_at": "2025-08-17T12:00:00",
-            "property_id": 1,
-            "amount": 290.0,
-            "due_date": "2025-07-31", 
-            "actions": ["Pagar urgente", "Gestionar recargo"]
+            "id": n.key,
+            "type": alert_level(n),
+            "alert_type": n.type,
+            "title": n.title,
+            "description": n.message,
+            "priority": n.priority,
+            "created_at": n.created_at.isoformat(),
+            "property_id": n.property_id,
+            "amount": n.amount,
+            "due_date": n.due_date.isoformat() if n.due_date else None,
+            "action_url": n.action_url,
+            "actions": ALERT_ACTIONS.get(n.type, []),
+            "read": n.read
         }
+        for n in active_notifications(session, current_user.id, include_read)
     ]
     
     return {
         "notifications": notifications,
         "total": len(notifications),
+        "unread": len([n for n in notifications if not n["read"]]),
         "by_type": {
             "critical": len([n for n in notifications if n["type"] == "critical"]),
             "warning": len([n for n in notifications if n["type"] == "warning"]),
@@ -96,195 +96,68 @@ def get_active_notifications(
 
 @router.get("/stats")
 def get_notification_stats(
-    session: Session = Depends(get_session)
+    session: Session = Depends(get_session),
+    current_user = Depends(get_current_user)
 ):
     """Estadísticas de notificaciones"""
+    rows = session.exec(
+        select(Notification.type, Notification.priority, func.count(), func.sum(Notification.amount))
+        .where(Notification.user_id == current_user.id)
+        .where(Notification.is_active == True)
+        .group_by(Notification.type, Notification.priority)
+    ).all()
     
     return {
-        "total_alerts": 4,
-        "critical_alerts": 1,
-        "potential_savings": 120,
-        "overdue_payments": 2
+        "total_alerts": sum(count for _, _, count, _ in rows),
+        "critical_alerts": sum(
+            count for alert_type, priority, count, _ in rows
+            if alert_type == "contract_expiring" and priority == "high"
+        ),
+        "potential_savings": sum(total or 0 for alert_type, _, _, total in rows if alert_type == "savings_opportunity"),
+        "overdue_payments": sum(count for alert_type, _, count, _ in rows if alert_type == "payment_due")
     }
 
 @router.get("/original-alerts")
 def get_original_notifications(
-    session: Session = Depends(get_session)
+    session: Session = Depends(get_session),
+    current_user = Depends(get_current_user)
 ):
-    """Obtener propiedades del usuario (implementación original)"""
-    notifications = []
-    today = date.today()
-    
-    # Obtener propiedades del usuario
-    properties = session.exec(select(Property)).all()
-    
-    for prop in properties:
-        # 1. Contratos próximos a vencer
-        contracts = session.exec(
-            select(RentalContract)
-            .where(RentalContract.property_id == prop.id)
-            .where(RentalContract.is_active == True)
-        ).all()
-        
-        for contract in contracts:
-            if contract.end_date:
-                days_until_expiry = (contract.end_date - today).days
-                
-                if 0 <= days_until_expiry <= 30:
-                    notifications.append(Notification(
-                        id=f"contract_expiry_{contract.id}",
-                        type="contract_expiring",
-                        title="Contrato próximo a vencer",
-                        message=f"El contrato de {contract.tenant_name} en {prop.address} vence en {days_until_expiry} días",
-                        priority="high" if days_until_expiry <= 7 else "medium",
-                        property_id=prop.id,
-                        due_date=contract.end_date,
-                        action_url=f"/financial-agent/contracts",
-                        created_at=datetime.now(),
-                        read=False
-                    ))
-        
-        # 2. Pagos de renta pendientes (detectar si no hay ingresos en los últimos 35 días)
-        last_month = today - timedelta(days=35)
-        recent_rent_payments = session.exec(
-            select(FinancialMovement)
-            .where(FinancialMovement.property_id == prop.id)
-            .where(FinancialMovement.category == "Renta")
-            .where(FinancialMovement.amount > 0)
-            .where(FinancialMovement.date >= last_month)
-        ).all()
-        
-        active_contract = session.exec(
-            select(RentalContract)
-            .where(RentalContract.property_id == prop.id)
-            .where(RentalContract.is_active == True)
-        ).first()
-        
-        if active_contract and not recent_rent_payments:
-            notifications.append(Notification(
-                id=f"missing_rent_{prop.id}",
-                type="payment_due",
-                title="Posible pago de renta pendiente",
-                message=f"No se ha registrado pago de renta en {prop.address} en los últimos 35 días",
-                priority="high",
-                property_id=prop.id,
-                amount=active_contract.monthly_rent,
-                action_url=f"/financial-agent/property/{prop.id}",
-                created_at=datetime.now(),
-                read=False
-            ))
-        
-        # 3. Gastos inusuales (gastos 3x superiores al promedio mensual)
-        six_months_ago = today - timedelta(days=180)
-        expenses = session.exec(
-            select(FinancialMovement)
-            .where(FinancialMovement.property_id == prop.id)
-            .where(FinancialMovement.amount < 0)
-            .where(FinancialMovement.date >= six_months_ago)
-        ).all()
-        
-        if expenses:
-            monthly_expenses = {}
-            for expense in expenses:
-                month_key = f"{expense.date.year}-{expense.date.month:02d}"
-                if month_key not in monthly_expenses:
-                    monthly_expenses[month_key] = 0
-                monthly_expenses[month_key] += abs(expense.amount)
-            
-            if len(monthly_expenses) >= 3:
-                avg_monthly_expense = statistics.mean(monthly_expenses.values())
-                current_month = f"{today.year}-{today.month:02d}"
-                current_month_expense = monthly_expenses.get(current_month, 0)
-                
-                if current_month_expense > avg_monthly_expense * 2.5:
-                    notifications.append(Notification(
-                        id=f"unusual_expense_{prop.id}",
-                        type="unusual_expense",
-                        title="Gastos inusuales detectados",
-                        message=f"Los gastos de {prop.address} este mes (€{current_month_expense:.0f}) superan significativamente el promedio (€{avg_monthly_expense:.0f})",
-                        priority="medium",
-                        property_id=prop.id,
-                        amount=current_month_expense - avg_monthly_expense,
-                        action_url=f"/financial-agent/property/{prop.id}",
-                        created_at=datetime.now(),
-                        read=False
-                    ))
-        
-        # 4. Oportunidades de ahorro en hipoteca
-        mortgage = session.exec(
-            select(MortgageDetails).where(MortgageDetails.property_id == prop.id)
-        ).first()
-        
-        if mortgage:
-            # Obtener tasa Euribor actual
-            latest_euribor = session.exec(
-                select(EuriborRate).order_by(EuriborRate.date.desc())
-            ).first()
-            
-            if latest_euribor:
-                current_rate = latest_euribor.rate_12m + mortgage.margin_percentage
-                
-                # Si la tasa actual es significativamente menor que hace 12 meses
-                year_ago_euribor = session.exec(
-                    select(EuriborRate)
-                    .where(EuriborRate.date <= today - timedelta(days=365))
-                    .order_by(EuriborRate.date.desc())
-                ).first()
-                
-                if year_ago_euribor:
-                    old_rate = year_ago_euribor.rate_12m + mortgage.margin_percentage
-                    rate_diff = old_rate - current_rate
-                    
-                    if rate_diff > 0.5:  # Si la diferencia es mayor a 0.5%
-                        monthly_savings = mortgage.outstanding_balance * (rate_diff / 100) / 12
-                        notifications.append(Notification(
-                            id=f"refinance_opportunity_{prop.id}",
-                            type="savings_opportunity",
-                            title="Oportunidad de refinanciación",
-                            message=f"Los tipos han bajado {rate_diff:.2f}%. Podrías ahorrar €{monthly_savings:.0f}/mes refinanciando la hipoteca de {prop.address}",
-                            priority="low",
-                            property_id=prop.id,
-                            amount=monthly_savings * 12,
-                            action_url=f"/financial-agent/mortgage-calculator",
-                            created_at=datetime.now(),
-                            read=False
-                        ))
-        
-        # 5. Revisiones de hipoteca próximas
-        if mortgage:
-            # Calcular próxima revisión (cada 12 meses desde start_date)
-            months_since_start = (today.year - mortgage.start_date.year) * 12 + (today.month - mortgage.start_date.month)
-            months_to_next_review = mortgage.review_period_months - (months_since_start % mortgage.review_period_months)
-            
-            if months_to_next_review <= 2:
-                next_review_date = today + timedelta(days=months_to_next_review * 30)
-                notifications.append(Notification(
-                    id=f"mortgage_review_{prop.id}",
-                    type="mortgage_review",
-                    title="Revisión de hipoteca próxima",
-                    message=f"La hipoteca de {prop.address} se revisará aproximadamente el {next_review_date.strftime('%d/%m/%Y')}",
-                    priority="medium",
-                    property_id=prop.id,
-                    due_date=next_review_date,
-                    action_url=f"/financial-agent/property/{prop.id}/mortgage",
-                    created_at=datetime.now(),
-                    read=False
-                ))
-    
-    # Ordenar por prioridad y fecha
-    priority_order = {"high": 3, "medium": 2, "low": 1}
-    notifications.sort(key=lambda x: (priority_order.get(x.priority, 0), x.created_at), reverse=True)
+    """Alertas del usuario en el formato original (calculadas por el evaluador de alertas)"""
+    notifications = [
+        {
+            "id": n.key,
+            "type": n.type,
+            "title": n.title,
+            "message": n.message,
+            "priority": n.priority,
+            "property_id": n.property_id,
+            "amount": n.amount,
+            "due_date": n.due_date,
+            "action_url": n.action_url,
+            "created_at": n.created_at,
+            "read": n.read
+        }
+        for n in active_notifications(session, current_user.id)
+    ]
     
     return {
         "notifications": notifications,
         "summary": {
             "total": len(notifications),
-            "high_priority": len([n for n in notifications if n.priority == "high"]),
-            "medium_priority": len([n for n in notifications if n.priority == "medium"]),
-            "low_priority": len([n for n in notifications if n.priority == "low"])
+            "high_priority": len([n for n in notifications if n["priority"] == "high"]),
+            "medium_priority": len([n for n in notifications if n["priority"] == "medium"]),
+            "low_priority": len([n for n in notifications if n["priority"] == "low"])
         }
     }
 
+@router.post("/evaluate")
+def evaluate_notifications(
+    session: Session = Depends(get_session),
+    current_user = Depends(get_current_user)
+):
+    """Recalcular ahora las alertas del usuario"""
+    return evaluate_user_alerts(session, current_user.id)
+
 @router.get("/savings-opportunities")
 def get_savings_opportunities(
     session: Session = Depends(get_session)
@@ -361,9 +234,24 @@ def get_savings_opportunities(
 @router.post("/mark-read/{notification_id}")
 def mark_notification_read(
     notification_id: str,
-    session: Session = Depends(get_session)
+    session: Session = Depends(get_session),
+    current_user = Depends(get_current_user)
 ):
-    """Marcar notificación como leída (en una implementación real se guardaría en BD)"""
+    """Marcar notificación como leída"""
+    notification = session.exec(
+        select(Notification)
+        .where(Notification.user_id == current_user.id)
+        .where(Notification.key == notification_id)
+    ).first()
+    if not notification:
+        raise HTTPException(status_code=404, detail="Notification not found")
+    
+    if not notification.read:
+        notification.read = True
+        notification.read_at = datetime.now(timezone.utc)
+        session.add(notification)
+        session.commit()
+    
     return {"message": "Notification marked as read", "notification_id": notification_id}
 
 @router.get("/settings")
@@ -10,6 +10,7 @@ from pydantic import BaseModel
 from ..db import get_session
 from ..deps import get_current_user
 from ..models import User, Property, RentalContract, TenantDocument
+from ..services.upload_stream import receive_upload, spool_upload
 
 router = APIRouter(prefix="/rental-contracts", tags=["rental-contracts"])
 
@@ -194,17 +195,16 @@ def upload_contract_pdf(
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
     
     # Save file (implement your file storage logic here)
-    import os
     from pathlib import Path
     
     upload_dir = Path("data/assets/contracts")
-    upload_dir.mkdir(parents=True, exist_ok=True)
-    
     file_path = upload_dir / f"contract_{contract_id}_{file.filename}"
     
-    with open(file_path, "wb") as buffer:
-        content = file.file.read()
-        buffer.write(content)
+    # Copia por bloques con límite de tamaño; el PDF anterior se sustituye de forma atómica
+    with spool_upload(
+        file.file, MAX_FILE_SIZE, f"File too large. Maximum size: {MAX_FILE_SIZE // (1024*1024)}MB"
+    ) as upload:
+        upload.move_to(file_path)
     
     # Update contract with file info
     contract.contract_pdf_path = str(file_path)
@@ -351,16 +351,10 @@ async def upload_tenant_document(
             detail=f"File type not allowed. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}"
         )
     
-    # Read file content to check size
-    content = await file.read()
-    if len(content) > MAX_FILE_SIZE:
-        raise HTTPException(
-            status_code=400, 
-            detail=f"File too large. Maximum size: {MAX_FILE_SIZE // (1024*1024)}MB"
-        )
-    
-    # Reset file pointer
-    await file.seek(0)
+    # Receive in chunks, stopping as soon as the size limit is exceeded
+    upload = await receive_upload(
+        file, MAX_FILE_SIZE, f"File too large. Maximum size: {MAX_FILE_SIZE // (1024*1024)}MB"
+    )
     
     # Generate unique filename
     file_extension = get_file_extension(file.filename)
@@ -372,8 +366,8 @@ async def upload_tenant_document(
     
     # Save file
     try:
-        with open(file_path, "wb") as f:
-            f.write(content)
+        with upload:
+            upload.move_to(file_path)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to save file: {str(e)}")
     
@@ -383,7 +377,7 @@ async def upload_tenant_document(
         document_type=document_type,
         document_name=file.filename,
         file_path=file_path,
-        file_size=len(content),
+        file_size=upload.size,
         description=description
     )
     
@@ -0,0 +1,50 @@
+# app/routers/search.py
+from fastapi import APIRouter, Depends, HTTPException, Query
+from typing import List, Optional
+from sqlmodel import Session
+from ..db import get_session
+from ..deps import get_current_user
+from ..services.search import SEARCH_KINDS, query_terms, search
+
+router = APIRouter(prefix="/search", tags=["search"])
+
+# Resultados por página como máximo
+MAX_SEARCH_LIMIT = 100
+
+@router.get("")
+def search_everything(
+    q: str = Query(..., min_length=1, description="Palabras a buscar (todas, como prefijo, sin acentos)"),
+    kind: Optional[List[str]] = Query(None, description="movement, contract, document, file"),
+    limit: int = Query(20, ge=1, le=MAX_SEARCH_LIMIT),
+    offset: int = Query(0, ge=0),
+    session: Session = Depends(get_session),
+    current_user = Depends(get_current_user)
+):
+    """
+    Búsqueda de texto completo en conceptos e inquilinos de movimientos,
+    datos de inquilinos de los contratos y nombres de documentos.
+
+    Devuelve los resultados ordenados por relevancia, paginados con
+    `limit`/`offset`; `has_more` indica si hay más páginas.
+    """
+    unknown = set(kind or []) - set(SEARCH_KINDS)
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Tipo no válido: {', '.join(sorted(unknown))}. Usa: {', '.join(SEARCH_KINDS)}"
+        )
+    if not query_terms(q):
+        raise HTTPException(status_code=400, detail="La búsqueda no contiene palabras")
+
+    # Una fila de más para saber si hay página siguiente sin contar todos los resultados
+    hits = search(session, current_user.id, q, kind, limit + 1, offset)
+    return {
+        "query": q,
+        "offset": offset,
+        "limit": limit,
+        "has_more": len(hits) > limit,
+        "hits": [
+            {"kind": hit.kind, "id": hit.id, "title": hit.title, "snippet": hit.snippet, "score": round(hit.score, 4)}
+            for hit in hits[:limit]
+        ]
+    }
@@ -1,16 +1,31 @@
 # app/routers/tax_assistant.py
-from fastapi import APIRouter, Depends
-from typing import Dict, List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from typing import Dict, Iterator, List, Optional
 from datetime import date, datetime, timedelta
 from sqlmodel import Session, select
 from pydantic import BaseModel
-from ..db import get_session
+from ..db import engine, get_session
 from ..deps import get_current_user
 from ..models import Property, FinancialMovement, RentalContract
+from ..services.tax_report import (
+    DEDUCTION_BUCKETS, DEDUCTION_ITEMS_PREVIEW, iter_deduction_items, months_rented_by_property, top_deduction_items
+)
+from ..services.exports import EXPORT_FORMATS as DOWNLOAD_FORMATS, export_response
+from ..services.tax_snapshot import get_tax_year
+from ..responses import FastJSONResponse, check_list_format, columnar, json_line
 import calendar
 
 router = APIRouter(prefix="/tax-assistant", tags=["tax-assistant"])
 
+EXPORT_FORMATS = {"csv", "xlsx", "ndjson", "columnar"}
+EXPORT_COLUMNS = ["date", "property_address", "category", "deduction_bucket", "concept", "amount"]
+REPORT_COLUMNS = [
+    "property_id", "address", "rental_income", *DEDUCTION_BUCKETS,
+    "total_expenses", "amortization", "taxable_income", "months_rented"
+]
+REPORT_TOTALS = ["total_rental_income", "total_expenses", "depreciation", "net_result", "tax_rate", "tax_amount"]
+
 class TaxReport(BaseModel):
     year: int
     total_rental_income: float
@@ -29,30 +44,15 @@ class DeductionCategory(BaseModel):
 @router.get("/summary/{year}")
 def get_tax_summary(
     year: int,
-    session: Session = Depends(get_session)
+    refresh: bool = False,
+    session: Session = Depends(get_session),
+    current_user = Depends(get_current_user)
 ):
     """Resumen fiscal del año"""
-    properties = session.exec(select(Property)).all()
-    
-    start_date = date(year, 1, 1)
-    end_date = date(year, 12, 31)
+    tax_year = get_tax_year(session, current_user.id, year, refresh)
     
-    total_rental_income = 0
-    total_deductible_expenses = 0
-    
-    for prop in properties:
-        movements = session.exec(
-            select(FinancialMovement)
-            .where(FinancialMovement.property_id == prop.id)
-            .where(FinancialMovement.date >= start_date)
-            .where(FinancialMovement.date <= end_date)
-        ).all()
-        
-        rental_income = sum(m.amount for m in movements if m.category == "Renta" and m.amount > 0)
-        expenses = sum(abs(m.amount) for m in movements if m.amount < 0)
-        
-        total_rental_income += rental_income
-        total_deductible_expenses += expenses
+    total_rental_income = tax_year["rental_income"]
+    total_deductible_expenses = tax_year["expenses"]
     
     net_income = total_rental_income - total_deductible_expenses
     tax_liability = calculate_estimated_tax(net_income)
@@ -70,14 +70,9 @@ def get_tax_summary(
 @router.get("/deductions/{year}")
 def get_deductions_breakdown(
     year: int,
-    session: Session = Depends(get_session)
+    current_user = Depends(get_current_user)
 ):
     """Análisis de deducciones del año"""
-    properties = session.exec(select(Property)).all()
-    
-    start_date = date(year, 1, 1)
-    end_date = date(year, 12, 31)
-    
     deductions = [
         {
             "concept": "IBI (Impuesto Bienes Inmuebles)",
@@ -124,91 +119,23 @@ def get_deductions_breakdown(
 @router.get("/annual-report/{year}")
 def get_annual_tax_report(
     year: int,
-    session: Session = Depends(get_session)
+    refresh: bool = False,
+    session: Session = Depends(get_session),
+    current_user = Depends(get_current_user)
 ):
     """Generar informe fiscal anual completo"""
     
-    # Obtener propiedades del usuario
-    properties = session.exec(select(Property)).all()
-    
-    start_date = date(year, 1, 1)
-    end_date = date(year, 12, 31)
-    
+    # Informe por propiedad del usuario, desde el snapshot del año
+    property_reports = get_tax_year(session, current_user.id, year, refresh)["properties"]
+    return build_annual_report(year, property_reports)
+
+def build_annual_report(year: int, property_reports: List[Dict]) -> Dict:
+    """Totales del informe anual a partir de los informes por propiedad"""
     total_rental_income = 0
     total_deductible_expenses = 0
-    property_reports = []
-    
-    for prop in properties:
-        # Obtener movimientos del año
-        movements = session.exec(
-            select(FinancialMovement)
-            .where(FinancialMovement.property_id == prop.id)
-            .where(FinancialMovement.date >= start_date)
-            .where(FinancialMovement.date <= end_date)
-        ).all()
-        
-        # Separar ingresos y gastos
-        rental_income = sum(m.amount for m in movements if m.category == "Renta" and m.amount > 0)
-        
-        # Gastos deducibles por categoría
-        deductible_expenses = {
-            "IBI": 0,
-            "Comunidad": 0,
-            "Seguros": 0,
-            "Reparaciones": 0,
-            "Hipoteca": 0,  # Solo intereses
-            "Gestión": 0,
-            "Suministros": 0,
-            "Otros": 0
-        }
-        
-        for movement in movements:
-            if movement.amount < 0:  # Es un gasto
-                amount = abs(movement.amount)
-                subcategory = movement.subcategory or movement.category
-                
-                if subcategory in deductible_expenses:
-                    deductible_expenses[subcategory] += amount
-                elif "IBI" in movement.concept.upper():
-                    deductible_expenses["IBI"] += amount
-                elif "COMUNIDAD" in movement.concept.upper():
-                    deductible_expenses["Comunidad"] += amount
-                elif "SEGURO" in movement.concept.upper():
-                    deductible_expenses["Seguros"] += amount
-                elif "REPARACION" in movement.concept.upper() or "MANTENIMIENTO" in movement.concept.upper():
-                    deductible_expenses["Reparaciones"] += amount
-                elif "HIPOTECA" in movement.concept.upper() or "INTERES" in movement.concept.upper():
-                    deductible_expenses["Hipoteca"] += amount
-                elif "GESTION" in movement.concept.upper() or "ADMINISTRACION" in movement.concept.upper():
-                    deductible_expenses["Gestión"] += amount
-                elif any(word in movement.concept.upper() for word in ["LUZ", "AGUA", "GAS", "INTERNET"]):
-                    deductible_expenses["Suministros"] += amount
-                else:
-                    deductible_expenses["Otros"] += amount
-        
-        property_total_expenses = sum(deductible_expenses.values())
-        property_taxable_income = rental_income - property_total_expenses
-        
-        # Calcular amortización de la vivienda (3% anual del valor de compra, excluyendo terreno)
-        amortization = 0
-        if prop.purchase_price:
-            # Estimamos que el 70% del precio es construcción (deducible) y 30% terreno (no deducible)
-            building_value = prop.purchase_price * 0.7
-            amortization = building_value * 0.03  # 3% anual
-        
-        property_reports.append({
-            "property_id": prop.id,
-            "address": prop.address,
-            "rental_income": rental_income,
-            "deductible_expenses": deductible_expenses,
-            "total_expenses": property_total_expenses,
-            "amortization": amortization,
-            "taxable_income": rental_income - property_total_expenses - amortization,
-            "months_rented": calculate_months_rented(prop.id, year, session)
-        })
-        
-        total_rental_income += rental_income
-        total_deductible_expenses += property_total_expenses + amortization
+    for report in property_reports:
+        total_rental_income += report["rental_income"]
+        total_deductible_expenses += report["total_expenses"] + report["amortization"]
     
     taxable_income = total_rental_income - total_deductible_expenses
     estimated_tax = calculate_estimated_tax(taxable_income)
@@ -224,54 +151,57 @@ def get_annual_tax_report(
         "quarterly_payments": [estimated_tax/4, estimated_tax/4, estimated_tax/4, estimated_tax/4]
     }
 
+def _report_rows(property_reports: List[Dict]) -> Iterator[Dict]:
+    """Una fila por propiedad con cada cubo de gasto deducible como columna"""
+    for report in property_reports:
+        yield {**report, **report["deductible_expenses"]}
+
+@router.get("/annual-report/{year}/export")
+def export_annual_tax_report(
+    year: int,
+    format: str = Query("xlsx", description="xlsx | csv"),
+    refresh: bool = False,
+    session: Session = Depends(get_session),
+    current_user = Depends(get_current_user)
+):
+    """
+    Informe fiscal anual para el gestor. El CSV lleva una fila por propiedad;
+    el XLSX añade los totales y todas las partidas de gasto del año.
+    """
+    check_list_format(format, DOWNLOAD_FORMATS)
+    property_reports = get_tax_year(session, current_user.id, year, refresh)["properties"]
+    report = build_annual_report(year, property_reports)
+    totals = [{"item": item, "value": report[item]} for item in REPORT_TOTALS]
+    return export_response(format, f"informe_fiscal_{year}", [
+        (f"Propiedades {year}", REPORT_COLUMNS, _report_rows(property_reports)),
+        ("Totales", ["item", "value"], totals),
+        ("Partidas", EXPORT_COLUMNS, _export_rows(current_user.id, year, None)),
+    ])
+
 @router.get("/deduction-analysis/{year}")
 def get_deduction_analysis(
     year: int,
-    session: Session = Depends(get_session)
+    top: int = Query(DEDUCTION_ITEMS_PREVIEW, ge=0, le=100, description="Largest items per category"),
+    refresh: bool = False,
+    session: Session = Depends(get_session),
+    current_user = Depends(get_current_user)
 ):
     """Análisis detallado de deducciones por categoría"""
     
-    properties = session.exec(select(Property)).all()
+    # Gastos agrupados por categoría (total y partidas mayores), desde el snapshot
+    all_expenses = get_tax_year(session, current_user.id, year, refresh)["deductions"]
+    total_expenses = sum(data["total"] for data in all_expenses)
     
-    start_date = date(year, 1, 1)
-    end_date = date(year, 12, 31)
-    
-    # Agrupar todos los gastos por categoría
-    all_expenses = {}
-    total_expenses = 0
-    
-    for prop in properties:
-        movements = session.exec(
-            select(FinancialMovement)
-            .where(FinancialMovement.property_id == prop.id)
-            .where(FinancialMovement.date >= start_date)
-            .where(FinancialMovement.date <= end_date)
-            .where(FinancialMovement.amount < 0)
-        ).all()
-        
-        for movement in movements:
-            amount = abs(movement.amount)
-            category = movement.subcategory or movement.category
-            
-            if category not in all_expenses:
-                all_expenses[category] = {
-                    "total": 0,
-                    "items": []
-                }
-            
-            all_expenses[category]["total"] += amount
-            all_expenses[category]["items"].append({
-                "property_address": prop.address,
-                "date": movement.date.isoformat(),
-                "concept": movement.concept,
-                "amount": amount
-            })
-            
-            total_expenses += amount
+    # Otro top-N distinto del guardado: ranking con ROW_NUMBER() en SQL
+    if top != DEDUCTION_ITEMS_PREVIEW:
+        owned = select(Property.id).where(Property.owner_id == current_user.id)
+        top_items = top_deduction_items(session, owned, year, top)
+        all_expenses = [{**data, "items": top_items.get(data["category"], [])} for data in all_expenses]
     
     # Crear categorías con porcentajes
     deduction_categories = []
-    for category, data in all_expenses.items():
+    for data in all_expenses:
+        category = data["category"]
         percentage = (data["total"] / total_expenses * 100) if total_expenses > 0 else 0
         
         # Determinar descripción fiscal
@@ -293,7 +223,7 @@ def get_deduction_analysis(
             amount=data["total"],
             percentage=percentage,
             description=description,
-            items=data["items"][:5]  # Mostrar solo los 5 primeros items
+            items=data["items"]  # Solo las `top` partidas de mayor importe
         ))
     
     # Ordenar por importe descendente
@@ -310,11 +240,60 @@ def get_deduction_analysis(
         }
     }
 
+def _export_rows(user_id: int, year: int, category: Optional[str]) -> Iterator[Dict]:
+    """Partidas de gasto del año en lotes, con su propia sesión para durar todo el streaming"""
+    with Session(engine) as session:
+        owned = select(Property.id).where(Property.owner_id == user_id)
+        for row in iter_deduction_items(session, owned, year, category):
+            movement_date, address, label, bucket, concept, amount = row
+            yield {
+                "date": movement_date,
+                "property_address": address,
+                "category": label,
+                "deduction_bucket": bucket,
+                "concept": concept,
+                "amount": amount
+            }
+
+def _export_ndjson(rows: Iterator[Dict]) -> Iterator[bytes]:
+    for row in rows:
+        yield json_line(row)
+
+@router.get("/deduction-analysis/{year}/items")
+def export_deduction_items(
+    year: int,
+    format: str = Query("csv", description="csv | xlsx | ndjson | columnar"),
+    category: Optional[str] = None,
+    current_user = Depends(get_current_user)
+):
+    """
+    Exportar todas las partidas de gasto del año (para el gestor) sin cargarlas en memoria.
+    `columnar` devuelve un único JSON con un array por columna (para gráficos).
+    """
+    check_list_format(format, EXPORT_FORMATS)
+    
+    rows = _export_rows(current_user.id, year, category)
+    if format == "ndjson":
+        return StreamingResponse(_export_ndjson(rows), media_type="application/x-ndjson")
+    if format == "columnar":
+        items = columnar(rows, EXPORT_COLUMNS)
+        return FastJSONResponse({
+            "format": "columnar",
+            "year": year,
+            "category": category,
+            "count": len(items["date"]),
+            "items": items
+        })
+    
+    return export_response(format, f"deducciones_{year}", [("Partidas", EXPORT_COLUMNS, rows)])
+
 @router.get("/quarterly-summary/{year}/{quarter}")
 def get_quarterly_summary(
     year: int,
     quarter: int,
-    session: Session = Depends(get_session)
+    refresh: bool = False,
+    session: Session = Depends(get_session),
+    current_user = Depends(get_current_user)
 ):
     """Resumen trimestral para pagos fraccionados"""
     
@@ -327,24 +306,9 @@ def get_quarterly_summary(
     start_date = date(year, start_month, 1)
     end_date = date(year, end_month, calendar.monthrange(year, end_month)[1])
     
-    properties = session.exec(select(Property)).all()
-    
-    quarterly_income = 0
-    quarterly_expenses = 0
-    
-    for prop in properties:
-        movements = session.exec(
-            select(FinancialMovement)
-            .where(FinancialMovement.property_id == prop.id)
-            .where(FinancialMovement.date >= start_date)
-            .where(FinancialMovement.date <= end_date)
-        ).all()
-        
-        income = sum(m.amount for m in movements if m.amount > 0 and m.category == "Renta")
-        expenses = sum(abs(m.amount) for m in movements if m.amount < 0)
-        
-        quarterly_income += income
-        quarterly_expenses += expenses
+    quarter_totals = get_tax_year(session, current_user.id, year, refresh)["quarters"][quarter - 1]
+    quarterly_income = quarter_totals["income"]
+    quarterly_expenses = quarter_totals["expenses"]
     
     quarterly_profit = quarterly_income - quarterly_expenses
     estimated_quarterly_tax = calculate_estimated_tax(quarterly_profit) / 4  # Aproximación
@@ -367,14 +331,24 @@ def get_quarterly_summary(
 @router.get("/tax-planning/{year}")
 def get_tax_planning_suggestions(
     year: int,
-    session: Session = Depends(get_session)
+    session: Session = Depends(get_session),
+    current_user = Depends(get_current_user)
 ):
     """Sugerencias de planificación fiscal"""
     
     suggestions = []
     
-    # Obtener datos del año actual
-    annual_report = get_annual_tax_report(year, session)
+    # Obtener datos del año actual (snapshot del usuario)
+    property_reports = get_tax_year(session, current_user.id, year)["properties"]
+    report = build_annual_report(year, property_reports)
+    annual_report = TaxReport(
+        year=year,
+        total_rental_income=report["total_rental_income"],
+        total_deductible_expenses=report["total_expenses"],
+        taxable_income=report["net_result"],
+        estimated_tax=report["tax_amount"],
+        properties=property_reports
+    )
     
     # 1. Optimización de gastos deducibles
     if annual_report.taxable_income > 10000:
@@ -428,7 +402,7 @@ def get_tax_planning_suggestions(
 @router.get("/documents-checklist/{year}")
 def get_tax_documents_checklist(
     year: int,
-    session: Session = Depends(get_session)
+    current_user = Depends(get_current_user)
 ):
     """Lista de documentos necesarios para la declaración"""
     
@@ -485,23 +459,7 @@ def get_tax_documents_checklist(
 
 def calculate_months_rented(property_id: int, year: int, session: Session) -> int:
     """Calcular meses que la propiedad estuvo alquilada"""
-    contracts = session.exec(
-        select(RentalContract).where(RentalContract.property_id == property_id)
-    ).all()
-    
-    start_year = date(year, 1, 1)
-    end_year = date(year, 12, 31)
-    
-    total_days = 0
-    for contract in contracts:
-        # Calcular overlap del contrato con el año
-        contract_start = max(contract.start_date, start_year)
-        contract_end = min(contract.end_date or end_year, end_year)
-        
-        if contract_start <= contract_end:
-            total_days += (contract_end - contract_start).days + 1
-    
-    return min(12, total_days // 30)  # Convertir días a meses aproximados
+    return months_rented_by_property(session, [property_id], year)[property_id]
 
 def calculate_estimated_tax(taxable_income: float) -> float:
     """Calcular impuesto estimado sobre ingresos inmobiliarios"""
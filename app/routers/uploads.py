@@ -1,12 +1,17 @@
 # app/routers/uploads.py
 import os
 import uuid
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, UploadFile, File
 from fastapi.responses import FileResponse
 from pathlib import Path
 from typing import Optional
 import shutil
 from ..deps import get_current_user
+from ..services.upload_stream import receive_upload
+from ..services.image_derivatives import (
+    DERIVATIVE_CACHE_CONTROL, DERIVATIVE_FORMATS, DERIVATIVE_PENDING_CACHE_CONTROL, DERIVATIVE_SIZES,
+    delete_file_derivatives, file_derivative_path, preferred_format, schedule_file_derivatives
+)
 
 router = APIRouter(prefix="/uploads", tags=["uploads"])
 
@@ -14,6 +19,8 @@ router = APIRouter(prefix="/uploads", tags=["uploads"])
 # Use /uploads for Render persistent disk, otherwise local uploads
 UPLOAD_DIR = Path("/uploads") if os.path.exists("/uploads") else Path("uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
+# Miniaturas y variantes WebP/JPEG de las fotos
+DERIVATIVES_DIR = UPLOAD_DIR / "derivatives"
 
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
@@ -34,13 +41,8 @@ async def upload_photo(
             detail=f"Tipo de archivo no permitido. Usa: {', '.join(ALLOWED_EXTENSIONS)}"
         )
     
-    # Check file size
-    contents = await file.read()
-    if len(contents) > MAX_FILE_SIZE:
-        raise HTTPException(
-            status_code=400,
-            detail="El archivo es demasiado grande. Máximo 5MB"
-        )
+    # Check file size (se recibe por bloques y se corta al pasar el límite)
+    upload = await receive_upload(file, MAX_FILE_SIZE, "El archivo es demasiado grande. Máximo 5MB")
     
     # Generate unique filename
     unique_filename = f"{uuid.uuid4()}{file_extension}"
@@ -48,14 +50,18 @@ async def upload_photo(
     
     try:
         # Save file
-        with open(file_path, "wb") as buffer:
-            buffer.write(contents)
+        with upload:
+            upload.move_to(file_path)
+        
+        # Variantes reducidas en segundo plano
+        schedule_file_derivatives(file_path, DERIVATIVES_DIR)
         
         # Return the file URL
         return {
             "url": f"/uploads/photo/{unique_filename}",
+            "sizes": {size: f"/uploads/photo/{unique_filename}?size={size}" for size in DERIVATIVE_SIZES},
             "filename": unique_filename,
-            "size": len(contents)
+            "size": upload.size
         }
     
     except Exception as e:
@@ -65,13 +71,39 @@ async def upload_photo(
         raise HTTPException(status_code=500, detail="Error al guardar el archivo")
 
 @router.get("/photo/{filename}")
-async def get_photo(filename: str):
-    """Serve uploaded photos"""
+async def get_photo(
+    filename: str,
+    request: Request,
+    size: Optional[str] = Query(None, description="thumb, card o full; sin tamaño se sirve el original")
+):
+    """Serve uploaded photos, optionally resized"""
+    if size is not None and size not in DERIVATIVE_SIZES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Tamaño no válido. Usa: {', '.join(DERIVATIVE_SIZES)}"
+        )
     file_path = UPLOAD_DIR / filename
     
     if not file_path.exists():
         raise HTTPException(status_code=404, detail="Archivo no encontrado")
     
+    if size is not None:
+        image_format = preferred_format(request.headers.get("accept"))
+        derivative_path = file_derivative_path(DERIVATIVES_DIR, filename, size, image_format)
+        if derivative_path.exists():
+            return FileResponse(
+                path=derivative_path,
+                media_type=DERIVATIVE_FORMATS[image_format][1],
+                headers={"Cache-Control": DERIVATIVE_CACHE_CONTROL, "Vary": "Accept"}
+            )
+        # Aún no generada (o foto anterior al pipeline): se encola y se sirve el original con caché corta
+        schedule_file_derivatives(file_path, DERIVATIVES_DIR)
+        return FileResponse(
+            path=file_path,
+            media_type="image/*",
+            headers={"Cache-Control": DERIVATIVE_PENDING_CACHE_CONTROL, "Vary": "Accept"}
+        )
+    
     return FileResponse(
         path=file_path,
         media_type="image/*",
@@ -88,6 +120,7 @@ async def delete_photo(filename: str, user=Depends(get_current_user)):
     
     try:
         file_path.unlink()
+        delete_file_derivatives(DERIVATIVES_DIR, filename)
         return {"message": "Archivo eliminado correctamente"}
     except Exception as e:
         raise HTTPException(status_code=500, detail="Error al eliminar el archivo")
\ No newline at end of file
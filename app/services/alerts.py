@@ -0,0 +1,818 @@
+# app/services/alerts.py
+"""
+Alert evaluator behind /notifications.
+
+Alerts are persisted in the Notification table, keyed by a stable alert key
+so read state survives re-evaluation. Alerts whose condition no longer holds
+are deactivated, not deleted. Every alert raised, updated or resolved is
+pushed to the user's event channel once the change is committed.
+
+Writes keep alerts fresh incrementally: evaluators registered per model with
+`alert_evaluator` receive each insert/update/delete inside the flush, update
+small per-property state (last rent received, monthly expense buckets and
+their rolling statistics, see expense_stats) with O(1) statements and name
+the alerts they affect, which are then refreshed once per flush. That state
+is built from the movements only once (`ensure_alert_state`) and rebuilt
+when ALERT_STATE_VERSION changes or an evaluator failed and marked it stale;
+`python -m app.manage rebuild-alerts` forces it. A background worker still re-evaluates every user on a fixed
+interval, for conditions driven by the calendar (a contract entering its
+expiry window, rent becoming overdue) and for fan-out changes (property
+edits, Euribor rates), reading the same incremental state.
+"""
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import delete, event, func, insert, inspect, or_, update
+from sqlmodel import Session, select
+
+from ..models import (
+    Property, RentalContract, FinancialMovement, MortgageDetails, EuriborRate, Notification, User,
+    PropertyAlertState, DerivedStateVersion
+)
+from .events import publish_user_event
+from .upsert import insert_if_absent, upsert
+from .expense_stats import (
+    TOTAL_CATEGORY, Stats, StatsKey, add_expense, current_month_totals, expense_category, is_anomaly, load_stats,
+    rebuild_expense_buckets
+)
+
+logger = logging.getLogger(__name__)
+
+# Agrupa ráfagas de escrituras (p.ej. una importación) en una sola evaluación
+ALERTS_DEBOUNCE_SECONDS = 2.0
+
+CONTRACT_EXPIRY_DAYS = 30
+MISSING_RENT_DAYS = 35
+REFINANCE_RATE_DROP = 0.5
+MORTGAGE_REVIEW_MONTHS = 2
+
+# Subirla al cambiar cómo se deriva el estado incremental: el siguiente arranque lo reconstruye
+ALERT_STATE_VERSION = 1
+STALE_STATE_VERSION = 0
+ALERT_STATE_NAME = "alerts"
+
+ALERT_FIELDS = ("type", "title", "message", "priority", "property_id", "amount", "due_date", "action_url")
+
+_PENDING_KEY = "alert_targets"
+_EVENTS_KEY = "alert_events"
+_CHANGES_KEY = "alert_changes"
+
+# ("user", user_id) | ("all", 0)
+Target = Tuple[str, int]
+# (user_id, payload de _alert_change) pendiente de publicar tras el commit
+AlertChange = Tuple[int, Dict]
+# (rule, subject), p.ej. ("missing_rent", property_id) o ("unusual_expense", (property_id, category))
+Refresh = Tuple[str, object]
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _is_rent(values: Optional[Dict]) -> bool:
+    return bool(values) and values["property_id"] is not None \
+        and values["category"] == "Renta" and values["amount"] > 0
+
+
+def _is_expense(values: Optional[Dict]) -> bool:
+    return bool(values) and values["property_id"] is not None and values["amount"] < 0
+
+
+# ---------------------------------------------------------------------------
+# Reglas de alerta: una alerta (o None) a partir de datos ya leídos
+# ---------------------------------------------------------------------------
+
+def _contract_alert(contract, address: str, today: date) -> Optional[Dict]:
+    if not contract.end_date:
+        return None
+    days_until_expiry = (contract.end_date - today).days
+    if not 0 <= days_until_expiry <= CONTRACT_EXPIRY_DAYS:
+        return None
+    return {
+        "key": f"contract_expiry_{contract.id}",
+        "type": "contract_expiring",
+        "title": "Contrato próximo a vencer",
+        "message": f"El contrato de {contract.tenant_name} en {address} vence en {days_until_expiry} días",
+        "priority": "high" if days_until_expiry <= 7 else "medium",
+        "property_id": contract.property_id,
+        "due_date": contract.end_date,
+        "action_url": "/financial-agent/contracts"
+    }
+
+
+def _missing_rent_alert(prop, contract, last_rent_date: Optional[date], today: date) -> Optional[Dict]:
+    if contract is None:
+        return None
+    if last_rent_date is not None and last_rent_date >= today - timedelta(days=MISSING_RENT_DAYS):
+        return None
+    return {
+        "key": f"missing_rent_{prop.id}",
+        "type": "payment_due",
+        "title": "Posible pago de renta pendiente",
+        "message": f"No se ha registrado pago de renta en {prop.address} en los últimos {MISSING_RENT_DAYS} días",
+        "priority": "high",
+        "property_id": prop.id,
+        "amount": contract.monthly_rent,
+        "action_url": f"/financial-agent/property/{prop.id}"
+    }
+
+
+def _unusual_expense_key(property_id: int, category: str) -> str:
+    if category == TOTAL_CATEGORY:
+        return f"unusual_expense_{property_id}"
+    return f"unusual_expense_{property_id}_{category}"
+
+
+def _unusual_expense_alert(prop, category: str, stats: Stats, current_month_expense: Optional[float]) -> Optional[Dict]:
+    """Current month's expense of a category (or the property total) far above its rolling history"""
+    if current_month_expense is None or not is_anomaly(stats, current_month_expense):
+        return None
+    avg_monthly_expense = stats[1]
+    if category == TOTAL_CATEGORY:
+        message = f"Los gastos de {prop.address} este mes (€{current_month_expense:.0f}) superan significativamente el promedio (€{avg_monthly_expense:.0f})"
+    else:
+        message = f"Los gastos de {category} en {prop.address} este mes (€{current_month_expense:.0f}) superan significativamente su promedio (€{avg_monthly_expense:.0f})"
+    return {
+        "key": _unusual_expense_key(prop.id, category),
+        "type": "unusual_expense",
+        "title": "Gastos inusuales detectados",
+        "message": message,
+        "priority": "medium",
+        "property_id": prop.id,
+        "amount": current_month_expense - avg_monthly_expense,
+        "action_url": f"/financial-agent/property/{prop.id}"
+    }
+
+
+def _refinance_alert(prop, mortgage, latest_euribor: Optional[float], year_ago_euribor: Optional[float]) -> Optional[Dict]:
+    # Oportunidad de refinanciación si los tipos han bajado
+    if latest_euribor is None or year_ago_euribor is None:
+        return None
+    current_rate = latest_euribor + mortgage.margin_percentage
+    old_rate = year_ago_euribor + mortgage.margin_percentage
+    rate_diff = old_rate - current_rate
+    if rate_diff <= REFINANCE_RATE_DROP:
+        return None
+    monthly_savings = mortgage.outstanding_balance * (rate_diff / 100) / 12
+    return {
+        "key": f"refinance_opportunity_{prop.id}",
+        "type": "savings_opportunity",
+        "title": "Oportunidad de refinanciación",
+        "message": f"Los tipos han bajado {rate_diff:.2f}%. Podrías ahorrar €{monthly_savings:.0f}/mes refinanciando la hipoteca de {prop.address}",
+        "priority": "low",
+        "property_id": prop.id,
+        "amount": monthly_savings * 12,
+        "action_url": "/financial-agent/mortgage-calculator"
+    }
+
+
+def _review_alert(prop, mortgage, today: date) -> Optional[Dict]:
+    # Revisión de hipoteca próxima
+    if not mortgage.review_period_months or mortgage.review_period_months <= 0:
+        return None
+    months_since_start = (today.year - mortgage.start_date.year) * 12 + (today.month - mortgage.start_date.month)
+    months_to_next_review = mortgage.review_period_months - (months_since_start % mortgage.review_period_months)
+    if months_to_next_review > MORTGAGE_REVIEW_MONTHS:
+        return None
+    next_review_date = today + timedelta(days=months_to_next_review * 30)
+    return {
+        "key": f"mortgage_review_{prop.id}",
+        "type": "mortgage_review",
+        "title": "Revisión de hipoteca próxima",
+        "message": f"La hipoteca de {prop.address} se revisará aproximadamente el {next_review_date.strftime('%d/%m/%Y')}",
+        "priority": "medium",
+        "property_id": prop.id,
+        "due_date": next_review_date,
+        "action_url": f"/financial-agent/property/{prop.id}/mortgage"
+    }
+
+
+def _euribor_rates(connection, today: date) -> Tuple[Optional[float], Optional[float]]:
+    """Current Euribor 12m and the one a year ago: two reads for the whole portfolio"""
+    latest = connection.execute(
+        select(EuriborRate.rate_12m).order_by(EuriborRate.date.desc()).limit(1)
+    ).scalar()
+    year_ago = connection.execute(
+        select(EuriborRate.rate_12m)
+        .where(EuriborRate.date <= today - timedelta(days=365))
+        .order_by(EuriborRate.date.desc())
+        .limit(1)
+    ).scalar()
+    return latest, year_ago
+
+
+# ---------------------------------------------------------------------------
+# Evaluación completa por usuario
+# ---------------------------------------------------------------------------
+
+def compute_user_alerts(session: Session, user_id: int, today: Optional[date] = None) -> List[Dict]:
+    """Current alerts of a user, from set-based reads over all of their properties"""
+    today = today or date.today()
+    properties = {
+        prop.id: prop
+        for prop in session.exec(select(Property).where(Property.owner_id == user_id)).all()
+    }
+    if not properties:
+        return []
+    property_ids = list(properties)
+    connection = session.connection()
+
+    contracts = session.exec(
+        select(RentalContract)
+        .where(RentalContract.property_id.in_(property_ids))
+        .where(RentalContract.is_active == True)
+        .order_by(RentalContract.id)
+    ).all()
+    # Primer contrato activo de cada propiedad
+    active_contracts: Dict[int, RentalContract] = {}
+    for contract in contracts:
+        active_contracts.setdefault(contract.property_id, contract)
+
+    last_rent = dict(session.exec(
+        select(PropertyAlertState.property_id, PropertyAlertState.last_rent_date)
+        .where(PropertyAlertState.property_id.in_(property_ids))
+    ).all())
+    # Gasto del mes por categoría (y total) frente a su media móvil
+    month_expenses = current_month_totals(connection, property_ids, today)
+    expense_stats = load_stats(connection, month_expenses, today)
+    mortgages = session.exec(
+        select(MortgageDetails).where(MortgageDetails.property_id.in_(property_ids))
+    ).all()
+    latest_euribor, year_ago_euribor = _euribor_rates(connection, today) if mortgages else (None, None)
+
+    alerts = [_contract_alert(contract, properties[contract.property_id].address, today) for contract in contracts]
+    alerts += [
+        _missing_rent_alert(properties[property_id], contract, last_rent.get(property_id), today)
+        for property_id, contract in active_contracts.items()
+    ]
+    alerts += [
+        _unusual_expense_alert(properties[property_id], category, expense_stats[(property_id, category)], total)
+        for (property_id, category), total in sorted(month_expenses.items())
+    ]
+    for mortgage in mortgages:
+        prop = properties[mortgage.property_id]
+        alerts.append(_refinance_alert(prop, mortgage, latest_euribor, year_ago_euribor))
+        alerts.append(_review_alert(prop, mortgage, today))
+    return [alert for alert in alerts if alert]
+
+
+def _alert_change(action: str, key: str, alert: Optional[Dict] = None) -> Dict:
+    """Payload of an `alert` push event: "raised", "updated" or "resolved" """
+    return {
+        "action": action,
+        "key": key,
+        "alert": {field: alert.get(field) for field in ("key", *ALERT_FIELDS)} if alert else None
+    }
+
+
+def sync_user_notifications(session: Session, user_id: int, alerts: List[Dict]) -> Dict[str, int]:
+    """Upsert alerts by key keeping read state; deactivate those no longer raised"""
+    existing = {
+        notification.key: notification
+        for notification in session.exec(select(Notification).where(Notification.user_id == user_id)).all()
+    }
+    now = _now()
+    created = reactivated = resolved = 0
+    changes: List[Dict] = []
+
+    for alert in alerts:
+        notification = existing.pop(alert["key"], None)
+        if notification is None:
+            notification = Notification(user_id=user_id, **alert)
+            created += 1
+            changes.append(_alert_change("raised", alert["key"], alert))
+        else:
+            if not notification.is_active:
+                # La condición vuelve a darse: es una alerta nueva para el usuario
+                notification.is_active = True
+                notification.read = False
+                notification.read_at = None
+                notification.created_at = now
+                reactivated += 1
+                changes.append(_alert_change("raised", alert["key"], alert))
+            elif any(getattr(notification, field) != alert.get(field) for field in ALERT_FIELDS):
+                changes.append(_alert_change("updated", alert["key"], alert))
+            for field in ALERT_FIELDS:
+                setattr(notification, field, alert.get(field))
+            notification.updated_at = now
+        session.add(notification)
+
+    for notification in existing.values():
+        if notification.is_active:
+            notification.is_active = False
+            notification.updated_at = now
+            session.add(notification)
+            resolved += 1
+            changes.append(_alert_change("resolved", notification.key))
+
+    session.commit()
+    for change in changes:
+        publish_user_event(user_id, "alert", change)
+    return {"active": len(alerts), "created": created, "reactivated": reactivated, "resolved": resolved}
+
+
+def evaluate_user_alerts(session: Session, user_id: int, today: Optional[date] = None) -> Dict[str, int]:
+    """Recompute and persist the alerts of one user"""
+    return sync_user_notifications(session, user_id, compute_user_alerts(session, user_id, today))
+
+
+def evaluate_alerts(engine, user_ids: Optional[Iterable[int]] = None) -> int:
+    """Evaluate the given users (every user when None), each in its own session"""
+    with Session(engine) as session:
+        if user_ids is None:
+            user_ids = session.exec(select(User.id)).all()
+    evaluated = 0
+    for user_id in user_ids:
+        try:
+            with Session(engine) as session:
+                evaluate_user_alerts(session, user_id)
+            evaluated += 1
+        except Exception:
+            logger.exception("Alert evaluation failed for user %s", user_id)
+    return evaluated
+
+
+# ---------------------------------------------------------------------------
+# Estado incremental
+# ---------------------------------------------------------------------------
+
+def rebuild_alert_state(engine) -> Dict[str, int]:
+    """Recompute the incremental alert state from every movement (repair: python -m app.manage rebuild-alerts)"""
+    state = PropertyAlertState.__table__
+    with engine.begin() as connection:
+        connection.execute(delete(state))
+
+        last_rent = connection.execute(
+            select(FinancialMovement.property_id, func.max(FinancialMovement.date))
+            .where(FinancialMovement.property_id.is_not(None))
+            .where(FinancialMovement.category == "Renta")
+            .where(FinancialMovement.amount > 0)
+            .group_by(FinancialMovement.property_id)
+        ).all()
+        if last_rent:
+            connection.execute(insert(state), [
+                {"property_id": property_id, "last_rent_date": last_date}
+                for property_id, last_date in last_rent
+            ])
+        buckets = rebuild_expense_buckets(connection)
+        _set_state_version(connection, ALERT_STATE_VERSION)
+    logger.info("Rebuilt alert state: %s rent watermarks, %s expense buckets", len(last_rent), buckets)
+    return {"rent_watermarks": len(last_rent), "expense_buckets": buckets}
+
+
+def _set_state_version(connection, version: int) -> None:
+    table = DerivedStateVersion.__table__
+    values = {"version": version, "built_at": _now()}
+    upsert(connection, table, {"name": ALERT_STATE_NAME, **values}, key=("name",), set_=values)
+
+
+def ensure_alert_state(engine) -> bool:
+    """
+    Rebuild the incremental state only when it was never built, was built
+    by another ALERT_STATE_VERSION or was marked stale; otherwise the writes
+    keep it current and this is a single-row read. True if it rebuilt.
+    """
+    with engine.connect() as connection:
+        version = connection.execute(
+            select(DerivedStateVersion.version).where(DerivedStateVersion.name == ALERT_STATE_NAME)
+        ).scalar()
+    if version == ALERT_STATE_VERSION:
+        return False
+    rebuild_alert_state(engine)
+    return True
+
+
+def _set_last_rent(connection, property_id: int, last_rent_date: Optional[date]) -> None:
+    table = PropertyAlertState.__table__
+    upsert(
+        connection, table, {"property_id": property_id, "last_rent_date": last_rent_date},
+        key=("property_id",), set_={"last_rent_date": last_rent_date}
+    )
+
+
+def _advance_last_rent(connection, property_id: int, rent_date: date) -> None:
+    table = PropertyAlertState.__table__
+    # Solo avanza: un cobro anterior al último registrado no cambia la marca
+    upsert(
+        connection, table, {"property_id": property_id, "last_rent_date": rent_date},
+        key=("property_id",), set_={"last_rent_date": rent_date},
+        where=or_(table.c.last_rent_date.is_(None), table.c.last_rent_date < rent_date)
+    )
+
+
+def _retract_last_rent(connection, property_id: int, rent_date: date) -> None:
+    table = PropertyAlertState.__table__
+    current = connection.execute(
+        select(table.c.last_rent_date).where(table.c.property_id == property_id)
+    ).scalar()
+    if current is not None and rent_date < current:
+        return  # No era el último cobro: la marca no cambia
+    # Se ha quitado el último cobro: buscar el anterior (ix_financialmovement_property_date)
+    previous = connection.execute(
+        select(func.max(FinancialMovement.date))
+        .where(FinancialMovement.property_id == property_id)
+        .where(FinancialMovement.category == "Renta")
+        .where(FinancialMovement.amount > 0)
+    ).scalar()
+    _set_last_rent(connection, property_id, previous)
+
+
+# ---------------------------------------------------------------------------
+# Evaluadores por evento
+# ---------------------------------------------------------------------------
+
+@dataclass
+class DomainEvent:
+    """Insert, update or delete of one row, with its watched values before and after the flush"""
+    action: str  # "insert" | "update" | "delete"
+    obj: object
+    before: Optional[Dict[str, object]] = None  # None en inserciones
+    after: Optional[Dict[str, object]] = None  # None en borrados
+
+    def moved(self, *fields: str) -> bool:
+        """Whether any of `fields` differs between before and after"""
+        if self.before is None or self.after is None:
+            return True
+        return any(self.before[field] != self.after[field] for field in fields)
+
+
+Evaluator = Callable[[object, DomainEvent], Iterable[Refresh]]
+
+# modelo -> [(campos observados, evaluador)]
+_EVALUATORS: Dict[type, List[Tuple[Tuple[str, ...], Evaluator]]] = {}
+# regla -> refresco de su alerta para un sujeto
+_REFRESHERS: Dict[str, Callable[[object, object, date], List[AlertChange]]] = {}
+
+
+def alert_evaluator(model: type, fields: Tuple[str, ...]):
+    """
+    Register `fn(connection, event)` for inserts, updates and deletes of `model`
+    that touch `fields`. It runs inside the flush, updates incremental state
+    with a constant number of statements and returns the alerts to refresh.
+    """
+    def register(fn: Evaluator) -> Evaluator:
+        _EVALUATORS.setdefault(model, []).append((("id", "property_id", *fields), fn))
+        return fn
+    return register
+
+
+def alert_refresher(rule: str):
+    """Register `fn(connection, subject, today)` that recomputes the alerts of `rule` for one subject and returns their changes"""
+    def register(fn):
+        _REFRESHERS[rule] = fn
+        return fn
+    return register
+
+
+def _upsert_alert(connection, user_id: Optional[int], key: str, alert: Optional[Dict]) -> List[AlertChange]:
+    """Single-key counterpart of sync_user_notifications; returns the changes to push"""
+    table = Notification.__table__
+    now = _now()
+    if alert is None:
+        # Las claves llevan el id de la propiedad/contrato: basta la clave
+        owners = connection.execute(
+            select(table.c.user_id).where(table.c.key == key).where(table.c.is_active == True)
+        ).scalars().all()
+        if owners:
+            connection.execute(
+                update(table)
+                .where(table.c.key == key)
+                .where(table.c.is_active == True)
+                .values(is_active=False, updated_at=now)
+            )
+        return [(owner, _alert_change("resolved", key)) for owner in owners]
+
+    values = {field: alert.get(field) for field in ALERT_FIELDS}
+    current_statement = (
+        select(table.c.id, table.c.is_active, *(table.c[field] for field in ALERT_FIELDS))
+        .where(table.c.user_id == user_id)
+        .where(table.c.key == key)
+    )
+    current = connection.execute(current_statement).first()
+    if current is None:
+        if insert_if_absent(connection, table, {
+            "user_id": user_id, "key": key, "is_active": True, "read": False,
+            "created_at": now, "updated_at": now, **values
+        }, key=("user_id", "key")):
+            return [(user_id, _alert_change("raised", key, alert))]
+        # Otra escritura simultánea la acaba de crear: se actualiza la suya
+        current = connection.execute(current_statement).first()
+    if current.is_active:
+        if all(getattr(current, field) == value for field, value in values.items()):
+            return []
+        action = "updated"
+    else:
+        # La condición vuelve a darse: es una alerta nueva para el usuario
+        values.update(is_active=True, read=False, read_at=None, created_at=now)
+        action = "raised"
+    connection.execute(update(table).where(table.c.id == current.id).values(updated_at=now, **values))
+    return [(user_id, _alert_change(action, key, alert))]
+
+
+def _property_row(connection, property_id: int):
+    return connection.execute(
+        select(Property.id, Property.address, Property.owner_id).where(Property.id == property_id)
+    ).first()
+
+
+@alert_evaluator(FinancialMovement, ("date", "amount", "category"))
+def _track_last_rent(connection, event: DomainEvent) -> Iterable[Refresh]:
+    was_rent, is_rent = _is_rent(event.before), _is_rent(event.after)
+    if not (was_rent or is_rent):
+        return []
+    if was_rent:
+        _retract_last_rent(connection, event.before["property_id"], event.before["date"])
+    if is_rent:
+        _advance_last_rent(connection, event.after["property_id"], event.after["date"])
+    return {("missing_rent", values["property_id"]) for values in (event.before, event.after) if _is_rent(values)}
+
+
+@alert_evaluator(FinancialMovement, ("date", "amount", "category", "subcategory"))
+def _track_monthly_expenses(connection, event: DomainEvent) -> Iterable[Refresh]:
+    refresh = set()
+    for values, sign in ((event.before, -1), (event.after, 1)):
+        if not _is_expense(values):
+            continue
+        category = expense_category(values["category"], values["subcategory"])
+        add_expense(connection, values["property_id"], category, values["date"], -values["amount"] * sign, sign)
+        refresh.add(("unusual_expense", (values["property_id"], category)))
+        refresh.add(("unusual_expense", (values["property_id"], TOTAL_CATEGORY)))
+    return refresh
+
+
+@alert_evaluator(RentalContract, ("tenant_name", "end_date", "monthly_rent", "is_active"))
+def _track_contract(connection, event: DomainEvent) -> Iterable[Refresh]:
+    contract_id = (event.after or event.before)["id"]
+    # El contrato activo de la propiedad puede haber cambiado: también su alerta de renta
+    return {("contract_expiry", contract_id)} | {
+        ("missing_rent", values["property_id"]) for values in (event.before, event.after) if values
+    }
+
+
+@alert_evaluator(MortgageDetails, ("outstanding_balance", "margin_percentage", "start_date", "review_period_months"))
+def _track_mortgage(connection, event: DomainEvent) -> Iterable[Refresh]:
+    return {("mortgage", values["property_id"]) for values in (event.before, event.after) if values}
+
+
+@alert_refresher("missing_rent")
+def _refresh_missing_rent(connection, property_id: int, today: date) -> List[AlertChange]:
+    prop = _property_row(connection, property_id)
+    if prop is None:
+        return []
+    contract = connection.execute(
+        select(RentalContract.id, RentalContract.monthly_rent)
+        .where(RentalContract.property_id == property_id)
+        .where(RentalContract.is_active == True)
+        .order_by(RentalContract.id)
+        .limit(1)
+    ).first()
+    last_rent_date = connection.execute(
+        select(PropertyAlertState.last_rent_date).where(PropertyAlertState.property_id == property_id)
+    ).scalar()
+    return _upsert_alert(connection, prop.owner_id, f"missing_rent_{property_id}",
+                         _missing_rent_alert(prop, contract, last_rent_date, today))
+
+
+@alert_refresher("unusual_expense")
+def _refresh_unusual_expense(connection, subject: StatsKey, today: date) -> List[AlertChange]:
+    property_id, category = subject
+    prop = _property_row(connection, property_id)
+    if prop is None:
+        return []
+    total = current_month_totals(connection, [property_id], today).get(subject)
+    stats = load_stats(connection, [subject], today)[subject] if total is not None else None
+    return _upsert_alert(connection, prop.owner_id, _unusual_expense_key(property_id, category),
+                         _unusual_expense_alert(prop, category, stats, total))
+
+
+@alert_refresher("contract_expiry")
+def _refresh_contract_expiry(connection, contract_id: int, today: date) -> List[AlertChange]:
+    contract = connection.execute(
+        select(
+            RentalContract.id, RentalContract.property_id, RentalContract.tenant_name,
+            RentalContract.end_date, RentalContract.is_active, Property.address, Property.owner_id
+        )
+        .join(Property, Property.id == RentalContract.property_id)
+        .where(RentalContract.id == contract_id)
+    ).first()
+    alert = _contract_alert(contract, contract.address, today) if contract and contract.is_active else None
+    return _upsert_alert(connection, contract.owner_id if contract else None, f"contract_expiry_{contract_id}", alert)
+
+
+@alert_refresher("mortgage")
+def _refresh_mortgage(connection, property_id: int, today: date) -> List[AlertChange]:
+    prop = _property_row(connection, property_id)
+    if prop is None:
+        return []
+    table = MortgageDetails.__table__
+    mortgage = connection.execute(select(table).where(table.c.property_id == property_id)).first()
+    refinance = review = None
+    if mortgage is not None:
+        refinance = _refinance_alert(prop, mortgage, *_euribor_rates(connection, today))
+        review = _review_alert(prop, mortgage, today)
+    return (
+        _upsert_alert(connection, prop.owner_id, f"refinance_opportunity_{property_id}", refinance)
+        + _upsert_alert(connection, prop.owner_id, f"mortgage_review_{property_id}", review)
+    )
+
+
+def _previous(obj, field: str):
+    history = inspect(obj).attrs[field].history
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return getattr(obj, field)
+
+
+def _watched_fields(model: type) -> Set[str]:
+    return {field for fields, _ in _EVALUATORS[model] for field in fields}
+
+
+def _collect_events(session, flush_context, instances) -> None:
+    events: List[DomainEvent] = session.info.setdefault(_EVENTS_KEY, [])
+    for action, objects in (("insert", session.new), ("update", session.dirty), ("delete", session.deleted)):
+        for obj in objects:
+            model = type(obj)
+            if model not in _EVALUATORS:
+                continue
+            fields = _watched_fields(model)
+            if action == "update":
+                state = inspect(obj)
+                if not any(state.attrs[field].history.has_changes() for field in fields):
+                    continue
+            before = None if action == "insert" else {field: _previous(obj, field) for field in fields}
+            events.append(DomainEvent(action, obj, before))
+
+
+def _run_evaluators(session, flush_context) -> None:
+    events: List[DomainEvent] = session.info.pop(_EVENTS_KEY, [])
+    if not events:
+        return
+
+    for domain_event in events:
+        if domain_event.action != "delete":
+            domain_event.after = {
+                field: getattr(domain_event.obj, field) for field in _watched_fields(type(domain_event.obj))
+            }
+
+    connection = session.connection()
+    # Las alertas son un efecto secundario: si fallan se deshace solo su SAVEPOINT, nunca la escritura del usuario
+    try:
+        with connection.begin_nested():
+            changes = _evaluate_events(connection, events, date.today())
+    except Exception:
+        logger.exception("Alert evaluators failed; the write is kept and the alert state is marked for rebuild")
+        try:
+            with connection.begin_nested():
+                # La próxima pasada del evaluador periódico lo reconstruye (ensure_alert_state)
+                _set_state_version(connection, STALE_STATE_VERSION)
+        except Exception:
+            logger.exception("Could not mark the alert state stale")
+        return
+    session.info.setdefault(_CHANGES_KEY, []).extend(changes)
+
+
+def _evaluate_events(connection, events: List[DomainEvent], today: date) -> List[AlertChange]:
+    refresh: Set[Refresh] = set()
+    for domain_event in events:
+        for fields, evaluator in _EVALUATORS[type(domain_event.obj)]:
+            if domain_event.action == "update" and not domain_event.moved(*fields):
+                continue
+            refresh.update(evaluator(connection, domain_event))
+
+    # Cada alerta afectada se recalcula una sola vez por flush; los cambios se publican tras el commit
+    changes: List[AlertChange] = []
+    for rule, subject in refresh:
+        changes.extend(_REFRESHERS[rule](connection, subject, today))
+    return changes
+
+
+event.listen(Session, "before_flush", _collect_events)
+event.listen(Session, "after_flush", _run_evaluators)
+
+
+# ---------------------------------------------------------------------------
+# Evaluación periódica y cambios que afectan a muchas alertas
+# ---------------------------------------------------------------------------
+
+def _resolve_users(targets: Set[Target]) -> Optional[Set[int]]:
+    """User ids affected by a set of targets (None = everyone)"""
+    if any(kind == "all" for kind, _ in targets):
+        return None
+    return {key for kind, key in targets if kind == "user"}
+
+
+class AlertScheduler:
+    """
+    Single background worker: full evaluation every `interval` seconds and,
+    in between, debounced evaluation of the users touched by committed
+    changes that fan out to many alerts (property edits, Euribor rates).
+    """
+
+    def __init__(self):
+        self._engine = None
+        self._interval = 0.0
+        self._pending: Set[Target] = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, engine, interval_seconds: float) -> None:
+        if self.running or interval_seconds <= 0:
+            return
+        self._engine = engine
+        self._interval = interval_seconds
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="alert-evaluator", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def notify(self, targets: Set[Target]) -> None:
+        """Queue users whose data changed; ignored while the worker is not running"""
+        if not targets or not self.running:
+            return
+        with self._lock:
+            self._pending.update(targets)
+        self._wake.set()
+
+    def _take_pending(self) -> Set[Target]:
+        with self._lock:
+            pending, self._pending = self._pending, set()
+        return pending
+
+    def _run(self) -> None:
+        next_full_run = time.monotonic()
+        while not self._stop.is_set():
+            self._wake.wait(timeout=max(0.0, next_full_run - time.monotonic()))
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+
+            if time.monotonic() >= next_full_run:
+                self._take_pending()
+                try:
+                    ensure_alert_state(self._engine)
+                except Exception:
+                    logger.exception("Alert state rebuild failed")
+                evaluate_alerts(self._engine)
+                next_full_run = time.monotonic() + self._interval
+                continue
+
+            # Esperar a que termine la ráfaga de escrituras antes de evaluar
+            self._stop.wait(ALERTS_DEBOUNCE_SECONDS)
+            pending = self._take_pending()
+            if pending:
+                evaluate_alerts(self._engine, _resolve_users(pending))
+
+
+alert_scheduler = AlertScheduler()
+
+
+def _values(obj, field: str) -> list:
+    history = inspect(obj).attrs[field].history
+    values = [*history.added, *history.unchanged, *history.deleted]
+    if not values:
+        values = [getattr(obj, field)]
+    return [value for value in values if value is not None]
+
+
+def _collect_targets(session, flush_context, instances) -> None:
+    pending: Set[Target] = session.info.setdefault(_PENDING_KEY, set())
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, Property):
+            pending.update(("user", owner_id) for owner_id in _values(obj, "owner_id"))
+        elif isinstance(obj, EuriborRate):
+            pending.add(("all", 0))
+
+
+def _dispatch_targets(session) -> None:
+    alert_scheduler.notify(session.info.pop(_PENDING_KEY, set()))
+    for user_id, change in session.info.pop(_CHANGES_KEY, []):
+        publish_user_event(user_id, "alert", change)
+
+
+def _discard_targets(session, *args) -> None:
+    session.info.pop(_PENDING_KEY, None)
+    session.info.pop(_EVENTS_KEY, None)
+    session.info.pop(_CHANGES_KEY, None)
+
+
+event.listen(Session, "before_flush", _collect_targets)
+event.listen(Session, "after_commit", _dispatch_targets)
+event.listen(Session, "after_rollback", _discard_targets)
@@ -0,0 +1,162 @@
+# app/services/amortization.py
+import math
+from datetime import date
+from typing import Dict, Iterator, List, Optional
+
+from dateutil.relativedelta import relativedelta
+
+# Saldo por debajo del cual el préstamo se considera amortizado
+BALANCE_TOLERANCE = 0.01
+
+
+class AnnuityLoan:
+    """
+    Closed-form French amortization for a constant-rate loan.
+
+    Totals, balance at month k and payoff month are computed with the
+    annuity formulas; schedule rows are only materialised when iterated.
+    """
+
+    def __init__(
+        self,
+        principal: float,
+        annual_rate: float,
+        start_date: date,
+        term_months: int,
+        payment: Optional[float] = None
+    ):
+        self.principal = float(principal)
+        self.annual_rate = float(annual_rate)
+        self.monthly_rate = self.annual_rate / 100.0 / 12.0
+        self.start_date = start_date
+        self.term_months = max(0, int(term_months))
+        self.payment = float(payment) if payment is not None else self.annuity_payment(
+            self.principal, self.monthly_rate, self.term_months
+        )
+
+    @staticmethod
+    def annuity_payment(principal: float, monthly_rate: float, num_payments: int) -> float:
+        """Standard annuity payment; the whole principal if there are no payments left"""
+        if num_payments <= 0:
+            return principal
+        if monthly_rate == 0:
+            return principal / num_payments
+        return principal * monthly_rate / (1 - (1 + monthly_rate) ** (-num_payments))
+
+    @classmethod
+    def from_dates(
+        cls,
+        principal: float,
+        annual_rate: float,
+        start_date: date,
+        end_date: date,
+        payment: Optional[float] = None
+    ) -> "AnnuityLoan":
+        """Build a loan whose term is the number of whole months between two dates"""
+        return cls(principal, annual_rate, start_date, months_between(start_date, end_date), payment)
+
+    @property
+    def amortizes(self) -> bool:
+        """False when the payment does not even cover the first month's interest"""
+        return self.principal > BALANCE_TOLERANCE and self.payment > self.principal * self.monthly_rate
+
+    def balance_at(self, month: int) -> float:
+        """Outstanding balance after `month` payments (0 = start of the loan)"""
+        if month <= 0:
+            return self.principal
+        r = self.monthly_rate
+        if r == 0:
+            balance = self.principal - self.payment * month
+        else:
+            growth = (1 + r) ** month
+            balance = self.principal * growth - self.payment * (growth - 1) / r
+        return max(0.0, balance)
+
+    def payoff_month(self) -> int:
+        """Number of payments until the balance falls below BALANCE_TOLERANCE"""
+        if not self.amortizes:
+            return 0
+        r = self.monthly_rate
+        if r == 0:
+            months = (self.principal - BALANCE_TOLERANCE) / self.payment
+        else:
+            # B_k <= tol  <=>  (1 + r)^k >= (A - r·tol) / (A - r·P)
+            months = math.log(
+                (self.payment - r * BALANCE_TOLERANCE) / (self.payment - r * self.principal)
+            ) / math.log(1 + r)
+        return max(1, math.ceil(months - 1e-9))
+
+    def total_interest(self) -> float:
+        """Interest paid over the whole life of the loan"""
+        months = self.payoff_month()
+        r = self.monthly_rate
+        if months == 0 or r == 0:
+            return 0.0
+        # r · Σ_{k=0}^{n-1} B_k  =  (P - A/r)((1 + r)^n - 1) + n·A
+        growth = (1 + r) ** months
+        return (self.principal - self.payment / r) * (growth - 1) + months * self.payment
+
+    def total_paid(self) -> float:
+        return self.principal + self.total_interest() if self.amortizes else 0.0
+
+    def payment_date(self, month: int) -> date:
+        """Date of the given (1-based) payment"""
+        return self.start_date + relativedelta(months=month - 1)
+
+    def end_date(self) -> date:
+        months = self.payoff_month()
+        return self.payment_date(months) if months else self.start_date
+
+    def rows(self, offset: int = 0, limit: Optional[int] = None) -> Iterator[Dict]:
+        """
+        Lazily yield schedule rows starting after `offset` payments.
+        Only the first balance is computed in closed form; the rest recurse.
+        """
+        months = self.payoff_month()
+        offset = max(0, offset)
+        stop = months if limit is None else min(months, offset + max(0, limit))
+
+        balance = self.balance_at(offset)
+        for month in range(offset + 1, stop + 1):
+            interest = balance * self.monthly_rate
+            principal = min(self.payment - interest, balance)
+            balance = max(0.0, balance - principal)
+            yield {
+                "month": month,
+                "date": self.payment_date(month).isoformat(),
+                "payment": round(self.payment, 2),
+                "principal": round(principal, 2),
+                "interest": round(interest, 2),
+                "balance": round(balance, 2)
+            }
+
+    def page(self, offset: int = 0, limit: Optional[int] = None) -> Dict:
+        """Page of schedule rows plus the total, for paginated responses"""
+        return {
+            "offset": offset,
+            "limit": limit,
+            "total": self.payoff_month(),
+            "rows": list(self.rows(offset, limit))
+        }
+
+    def summary(self, preview_rows: int = 6) -> Dict:
+        """Totals plus the first rows of the schedule"""
+        months = self.payoff_month()
+        return {
+            "monthly_payment": round(self.payment, 2),
+            "total_months": months,
+            "total_interest": round(self.total_interest(), 2),
+            "total_paid": round(self.total_paid(), 2),
+            "end_date": self.end_date().isoformat(),
+            "first_rows": list(self.rows(0, preview_rows))
+        }
+
+
+def months_between(start_date: date, end_date: date) -> int:
+    """Whole calendar months between two dates"""
+    return (end_date.year - start_date.year) * 12 + (end_date.month - start_date.month)
+
+
+def materialize_schedule(loan: AnnuityLoan) -> List[Dict]:
+    """Full schedule as a list, for callers that still need every row"""
+    return list(loan.rows())
@@ -0,0 +1,312 @@
+# app/services/blob_migration.py
+"""
+Migration of the Base64 columns into the blob store.
+
+Older databases kept file contents inline: FileStorage.file_data and
+PropertyPhoto.photo_data (the same photo stored twice on upload). Moving
+them out is an explicit, three-step operation run from `python -m app.manage`,
+never at startup:
+
+1. `migrate-blobs` copies every row's bytes to the blob store in small
+   committed batches, checks what was written and only then points the row
+   at its blob (`sha256`), linking each PropertyPhoto to its FileStorage
+   row. The inline columns are left untouched and an interrupted run
+   resumes where it stopped. It refuses to run unless the blob store is
+   persistent (S3, or a BLOB_STORE_DIR that is a mounted volume): on an
+   ephemeral disk the next redeploy would lose the copies.
+2. `verify-blobs` re-reads every migrated blob and compares it with the
+   inline copy.
+3. `drop-inline-columns` drops the inline columns, only after a clean
+   verification.
+
+At startup `prepare_inline_columns` only makes the schema usable by the
+current code (new columns added, inline columns made nullable) and rows not
+yet migrated are served from their inline copy (`read_inline_file`).
+"""
+import base64
+import logging
+import re
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from sqlalchemy import column, func, insert, inspect, select, table, text, update
+from sqlalchemy.engine import Engine
+
+from ..config import settings
+from ..models import Property
+from ..models_files import Blob, FileStorage
+from .blob_store import BlobStore, get_blob_store, sha256_bytes
+
+logger = logging.getLogger(__name__)
+
+# Filas movidas por transacción
+MIGRATION_BATCH_SIZE = 100
+
+# Columnas Base64 antiguas: tabla -> columna
+INLINE_COLUMNS = {"filestorage": "file_data", "propertyphoto": "photo_data"}
+
+_PHOTO_URL = re.compile(r"^/files/photo/(\d+)$")
+
+# Firmas de los formatos de imagen aceptados en la subida
+_IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF8", "image/gif"),
+)
+
+_legacy_files = table("filestorage", column("id"), column("file_data"), column("sha256"), column("file_size"))
+_legacy_photos = table(
+    "propertyphoto", column("id"), column("property_id"), column("photo_url"), column("photo_data"), column("file_id")
+)
+
+
+class BlobMigrationError(RuntimeError):
+    """The migration cannot run, or its result did not verify"""
+
+
+def _image_content_type(content: bytes) -> str:
+    if content[:4] == b"RIFF" and content[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, content_type in _IMAGE_SIGNATURES:
+        if content.startswith(signature):
+            return content_type
+    return "image/jpeg"
+
+
+def _decode(data: Optional[str]) -> bytes:
+    return base64.b64decode(data or "")
+
+
+def _columns(engine: Engine, table_name: str) -> Dict[str, bool]:
+    """{column: nullable} of a table (empty if it does not exist)"""
+    inspector = inspect(engine)
+    if table_name not in inspector.get_table_names():
+        return {}
+    return {info["name"]: info["nullable"] for info in inspector.get_columns(table_name)}
+
+
+# --- Arranque: esquema compatible sin mover datos --------------------------------------
+
+def _drop_not_null_sqlite(connection, table_name: str, column_name: str) -> None:
+    """SQLite cannot alter a constraint: rebuild the table with the same columns and data"""
+    create_sql = connection.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": table_name}
+    ).scalar()
+    relaxed = re.sub(rf'(\b"?{column_name}"?\s+\w+(?:\(\d+\))?)\s+NOT NULL', r"\1", create_sql, count=1)
+    if relaxed == create_sql:
+        return
+    staging = f"_{table_name}_rebuild"
+    relaxed = re.sub(rf'^CREATE TABLE\s+"?{table_name}"?', f'CREATE TABLE "{staging}"', relaxed, count=1)
+    connection.execute(text(relaxed))
+    connection.execute(text(f'INSERT INTO "{staging}" SELECT * FROM "{table_name}"'))
+    connection.execute(text(f'DROP TABLE "{table_name}"'))
+    connection.execute(text(f'ALTER TABLE "{staging}" RENAME TO "{table_name}"'))
+    # Los índices se recrean en init_db
+
+
+def _drop_not_null(engine: Engine, table_name: str, column_name: str) -> None:
+    with engine.begin() as connection:
+        if engine.dialect.name == "sqlite":
+            _drop_not_null_sqlite(connection, table_name, column_name)
+        else:
+            connection.execute(text(f"ALTER TABLE {table_name} ALTER COLUMN {column_name} DROP NOT NULL"))
+
+
+def prepare_inline_columns(engine: Engine) -> None:
+    """
+    Make an older database usable without moving any data: add the blob
+    columns and let new rows leave the inline Base64 columns empty.
+    """
+    columns = _columns(engine, "filestorage")
+    if "file_data" in columns:
+        if "sha256" not in columns:
+            with engine.begin() as connection:
+                connection.execute(text("ALTER TABLE filestorage ADD COLUMN sha256 VARCHAR(64)"))
+        if not columns["file_data"]:
+            _drop_not_null(engine, "filestorage", "file_data")
+    columns = _columns(engine, "propertyphoto")
+    if "photo_data" in columns:
+        if "file_id" not in columns:
+            with engine.begin() as connection:
+                connection.execute(text("ALTER TABLE propertyphoto ADD COLUMN file_id INTEGER REFERENCES filestorage(id)"))
+        if not columns["photo_data"]:
+            _drop_not_null(engine, "propertyphoto", "photo_data")
+
+
+def read_inline_file(session, file_id: int) -> Optional[bytes]:
+    """Contents of a FileStorage row not migrated yet (None if there is no inline copy)"""
+    data = session.execute(select(_legacy_files.c.file_data).where(_legacy_files.c.id == file_id)).scalar()
+    return None if data is None else _decode(data)
+
+
+# --- Migración explícita ------------------------------------------------------------
+
+def require_persistent_store() -> None:
+    """Refuse to move the only copy of the files onto a disk that does not survive a redeploy"""
+    if not settings.blob_store_persistent:
+        raise BlobMigrationError(
+            "The blob store is not persistent: set BLOB_STORE_BACKEND=s3 or point BLOB_STORE_DIR "
+            "at a mounted volume before migrating the inline files"
+        )
+
+
+def _store_verified(connection, store: BlobStore, content: bytes) -> str:
+    """Write to the blob store, read it back and count the reference on the Blob table"""
+    sha256 = sha256_bytes(content)
+    if not store.exists(sha256):
+        store.put_bytes(sha256, content)
+    if sha256_bytes(store.read_bytes(sha256)) != sha256:
+        raise BlobMigrationError(f"Blob {sha256} does not match what was written")
+    blobs = Blob.__table__
+    if connection.execute(select(blobs.c.sha256).where(blobs.c.sha256 == sha256)).first() is None:
+        connection.execute(insert(blobs).values(
+            sha256=sha256, size=len(content), ref_count=1, created_at=datetime.now(timezone.utc)
+        ))
+    else:
+        connection.execute(update(blobs).where(blobs.c.sha256 == sha256).values(ref_count=blobs.c.ref_count + 1))
+    return sha256
+
+
+def _migrate_file_storage(engine: Engine, store: BlobStore) -> int:
+    moved = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                select(_legacy_files.c.id, _legacy_files.c.file_data)
+                .where(_legacy_files.c.sha256.is_(None))
+                .where(_legacy_files.c.file_data.is_not(None))
+                .order_by(_legacy_files.c.id)
+                .limit(MIGRATION_BATCH_SIZE)
+            ).all()
+            for file_id, file_data in rows:
+                content = _decode(file_data)
+                connection.execute(
+                    update(_legacy_files).where(_legacy_files.c.id == file_id)
+                    .values(sha256=_store_verified(connection, store, content), file_size=len(content))
+                )
+        if not rows:
+            return moved
+        moved += len(rows)
+
+
+def _migrate_property_photos(engine: Engine, store: BlobStore) -> Dict[str, int]:
+    files = FileStorage.__table__
+    linked = created = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                select(
+                    _legacy_photos.c.id, _legacy_photos.c.property_id,
+                    _legacy_photos.c.photo_url, _legacy_photos.c.photo_data
+                )
+                .where(_legacy_photos.c.file_id.is_(None))
+                .where(_legacy_photos.c.photo_data.is_not(None))
+                .order_by(_legacy_photos.c.id)
+                .limit(MIGRATION_BATCH_SIZE)
+            ).all()
+            for photo_id, property_id, photo_url, photo_data in rows:
+                # La subida creaba la foto duplicando el FileStorage de /files/photo/{id}
+                match = _PHOTO_URL.match(photo_url or "")
+                file_id = int(match.group(1)) if match else None
+                if file_id is not None and connection.execute(
+                    select(files.c.id).where(files.c.id == file_id).where(files.c.file_type == "photo")
+                ).first() is not None:
+                    linked += 1
+                    connection.execute(update(_legacy_photos).where(_legacy_photos.c.id == photo_id).values(file_id=file_id))
+                    continue
+                content = _decode(photo_data)
+                content_type = _image_content_type(content)
+                owner_id = connection.execute(
+                    select(Property.owner_id).where(Property.id == property_id)
+                ).scalar()
+                file_id = connection.execute(insert(files).values(
+                    filename=f"property_{property_id}_photo_{photo_id}.{content_type.split('/')[1]}",
+                    content_type=content_type,
+                    sha256=_store_verified(connection, store, content),
+                    file_size=len(content),
+                    property_id=property_id,
+                    file_type="photo",
+                    created_at=datetime.now(timezone.utc),
+                    user_id=owner_id
+                )).inserted_primary_key[0]
+                created += 1
+                connection.execute(
+                    update(_legacy_photos).where(_legacy_photos.c.id == photo_id)
+                    .values(file_id=file_id, photo_url=f"/files/photo/{file_id}")
+                )
+        if not rows:
+            return {"linked": linked, "created": created}
+
+
+def migrate_inline_blobs(engine: Engine, store: Optional[BlobStore] = None) -> Dict[str, int]:
+    """Copy inline file contents to the blob store; the inline columns are kept"""
+    require_persistent_store()
+    store = store or get_blob_store()
+    prepare_inline_columns(engine)
+    result = {"files": 0, "photos_linked": 0, "photos_created": 0}
+    if "file_data" in _columns(engine, "filestorage"):
+        result["files"] = _migrate_file_storage(engine, store)
+    if "photo_data" in _columns(engine, "propertyphoto"):
+        photos = _migrate_property_photos(engine, store)
+        result["photos_linked"], result["photos_created"] = photos["linked"], photos["created"]
+    logger.info("Inline blob migration: %s", result)
+    return result
+
+
+def verify_inline_blobs(engine: Engine, store: Optional[BlobStore] = None) -> Dict[str, int]:
+    """
+    Compare every inline copy with its blob. Returns counters; `pending`
+    (not migrated yet) and `mismatched` (blob missing or different) must
+    both be 0 before the inline columns can go.
+    """
+    store = store or get_blob_store()
+    result = {"verified": 0, "pending": 0, "mismatched": 0}
+    if "file_data" in _columns(engine, "filestorage"):
+        last_id = 0
+        while True:
+            with engine.connect() as connection:
+                rows = connection.execute(
+                    select(_legacy_files.c.id, _legacy_files.c.file_data, _legacy_files.c.sha256)
+                    .where(_legacy_files.c.id > last_id)
+                    .where(_legacy_files.c.file_data.is_not(None))
+                    .order_by(_legacy_files.c.id)
+                    .limit(MIGRATION_BATCH_SIZE)
+                ).all()
+            for file_id, file_data, sha256 in rows:
+                if sha256 is None:
+                    result["pending"] += 1
+                elif (
+                    sha256_bytes(_decode(file_data)) != sha256
+                    or not store.exists(sha256)
+                    or sha256_bytes(store.read_bytes(sha256)) != sha256
+                ):
+                    logger.error("FileStorage %s does not match blob %s", file_id, sha256)
+                    result["mismatched"] += 1
+                else:
+                    result["verified"] += 1
+            if not rows:
+                break
+            last_id = rows[-1][0]
+    if "photo_data" in _columns(engine, "propertyphoto"):
+        with engine.connect() as connection:
+            # Fotos sin enlazar a su FileStorage
+            result["pending"] += connection.execute(
+                select(func.count())
+                .select_from(_legacy_photos)
+                .where(_legacy_photos.c.file_id.is_(None))
+                .where(_legacy_photos.c.photo_data.is_not(None))
+            ).scalar()
+    return result
+
+
+def drop_inline_columns(engine: Engine, store: Optional[BlobStore] = None) -> Dict[str, int]:
+    """Drop the Base64 columns once every row verifies against the blob store"""
+    result = verify_inline_blobs(engine, store)
+    if result["pending"] or result["mismatched"]:
+        raise BlobMigrationError(f"Inline columns kept, verification failed: {result}")
+    for table_name, column_name in INLINE_COLUMNS.items():
+        if column_name in _columns(engine, table_name):
+            with engine.begin() as connection:
+                connection.execute(text(f"ALTER TABLE {table_name} DROP COLUMN {column_name}"))
+            logger.info("Dropped %s.%s", table_name, column_name)
+    return result
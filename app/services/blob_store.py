@@ -0,0 +1,250 @@
+# app/services/blob_store.py
+"""
+Content-addressed storage for uploaded files.
+
+A blob is stored once under the hex SHA-256 of its bytes; the database only
+keeps metadata (a `Blob` row with size and reference count, and the
+FileStorage rows pointing at it). Uploading the same content
+twice adds a reference instead of a copy, and the bytes are removed when the
+last reference goes away.
+
+The backend is pluggable: LocalBlobStore keeps blobs on disk under
+settings.blob_store_dir (sharded by hash prefix) and is also the stand-in
+for S3BlobStore, which talks to any S3-compatible service (requires boto3).
+"""
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import BinaryIO, Iterator, Optional
+
+from sqlalchemy import update
+from sqlmodel import Session
+
+from ..config import settings
+from ..models_files import Blob
+from .upsert import upsert
+
+logger = logging.getLogger(__name__)
+
+# Tamaño de bloque para hashear y copiar ficheros
+BLOB_CHUNK_SIZE = 1024 * 1024
+
+
+def sha256_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def sha256_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for chunk in iter(lambda: source.read(BLOB_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BlobStore(ABC):
+    """Bytes addressed by their SHA-256"""
+
+    @abstractmethod
+    def exists(self, sha256: str) -> bool:
+        """Whether the blob is stored"""
+
+    @abstractmethod
+    def put_file(self, sha256: str, source: Path) -> None:
+        """Store the file at `source` (already hashed to `sha256`); the source may be moved"""
+
+    @abstractmethod
+    def open(self, sha256: str) -> BinaryIO:
+        """Readable binary stream of the blob"""
+
+    @abstractmethod
+    def delete(self, sha256: str) -> None:
+        """Remove the blob if present"""
+
+    def local_path(self, sha256: str) -> Optional[Path]:
+        """Path on local disk, when the backend has one (lets responses use sendfile)"""
+        return None
+
+    def put_bytes(self, sha256: str, data: bytes) -> None:
+        fd, temp_path = tempfile.mkstemp(prefix="blob-")
+        try:
+            with os.fdopen(fd, "wb") as target:
+                target.write(data)
+            self.put_file(sha256, Path(temp_path))
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+
+    def read_bytes(self, sha256: str) -> bytes:
+        with self.open(sha256) as source:
+            return source.read()
+
+    def iter_chunks(self, sha256: str) -> Iterator[bytes]:
+        """Stream the blob without holding it whole in memory"""
+        with self.open(sha256) as source:
+            for chunk in iter(lambda: source.read(BLOB_CHUNK_SIZE), b""):
+                yield chunk
+
+
+class LocalBlobStore(BlobStore):
+    """Blobs as files under `root/ab/cd/<sha256>`"""
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, sha256: str) -> Path:
+        return self.root / sha256[:2] / sha256[2:4] / sha256
+
+    def exists(self, sha256: str) -> bool:
+        return self.path(sha256).is_file()
+
+    def put_file(self, sha256: str, source: Path) -> None:
+        target = self.path(sha256)
+        if target.is_file():
+            return
+        target.parent.mkdir(parents=True, exist_ok=True)
+        # Copia a un temporal del mismo directorio y rename atómico: nunca se ve un blob a medias
+        fd, temp_path = tempfile.mkstemp(dir=target.parent, prefix=".tmp-")
+        os.close(fd)
+        try:
+            try:
+                os.replace(source, temp_path)
+            except OSError:
+                # Distinto sistema de ficheros
+                shutil.copyfile(source, temp_path)
+            os.replace(temp_path, target)
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+
+    def open(self, sha256: str) -> BinaryIO:
+        return open(self.path(sha256), "rb")
+
+    def delete(self, sha256: str) -> None:
+        try:
+            self.path(sha256).unlink()
+        except FileNotFoundError:
+            pass
+
+    def local_path(self, sha256: str) -> Optional[Path]:
+        path = self.path(sha256)
+        return path if path.is_file() else None
+
+
+class S3BlobStore(BlobStore):
+    """Blobs as objects `<prefix><sha256>` in an S3-compatible bucket"""
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: Optional[str] = None):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError as exc:
+            raise RuntimeError("BLOB_STORE_BACKEND=s3 requires boto3") from exc
+        self._client = boto3.client("s3", endpoint_url=endpoint_url)
+        self._client_error = ClientError
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _key(self, sha256: str) -> str:
+        return f"{self.prefix}{sha256}"
+
+    def exists(self, sha256: str) -> bool:
+        try:
+            self._client.head_object(Bucket=self.bucket, Key=self._key(sha256))
+            return True
+        except self._client_error:
+            return False
+
+    def put_file(self, sha256: str, source: Path) -> None:
+        if not self.exists(sha256):
+            self._client.upload_file(str(source), self.bucket, self._key(sha256))
+
+    def open(self, sha256: str) -> BinaryIO:
+        return self._client.get_object(Bucket=self.bucket, Key=self._key(sha256))["Body"]
+
+    def delete(self, sha256: str) -> None:
+        self._client.delete_object(Bucket=self.bucket, Key=self._key(sha256))
+
+
+def _default_store() -> BlobStore:
+    if settings.blob_store_backend == "s3":
+        return S3BlobStore(settings.s3_bucket, settings.s3_prefix, settings.s3_endpoint_url or None)
+    return LocalBlobStore(settings.blob_store_dir)
+
+
+_store: Optional[BlobStore] = None
+
+
+def get_blob_store() -> BlobStore:
+    global _store
+    if _store is None:
+        _store = _default_store()
+    return _store
+
+
+def set_blob_store(store: BlobStore) -> None:
+    """Replace the backend (call at startup)"""
+    global _store
+    _store = store
+
+
+def add_blob_reference(session: Session, sha256: str, size: int) -> Blob:
+    """Count one more reference to a blob already written to the store"""
+    table = Blob.__table__
+    # Una sola sentencia: dos subidas simultáneas del mismo contenido nuevo no chocan en la clave
+    upsert(
+        session.connection(), table, {"sha256": sha256, "size": size, "ref_count": 1},
+        key=("sha256",), set_={"ref_count": table.c.ref_count + 1}
+    )
+    return session.get(Blob, sha256, populate_existing=True)
+
+
+def store_bytes(session: Session, data: bytes) -> Blob:
+    """Write `data` to the store (if new) and reference it"""
+    sha256 = sha256_bytes(data)
+    store = get_blob_store()
+    if not store.exists(sha256):
+        store.put_bytes(sha256, data)
+    return add_blob_reference(session, sha256, len(data))
+
+
+def store_file(session: Session, source: Path, sha256: str, size: int) -> Blob:
+    """Move an already hashed file into the store (if new) and reference it"""
+    store = get_blob_store()
+    if not store.exists(sha256):
+        store.put_file(sha256, source)
+    return add_blob_reference(session, sha256, size)
+
+
+def release_blob(session: Session, sha256: Optional[str]) -> bool:
+    """
+    Drop one reference. Returns True when it was the last one; the caller
+    then removes the bytes with `purge_blob` once the transaction commits.
+    """
+    if not sha256:
+        return False
+    blob = session.get(Blob, sha256)
+    if blob is None:
+        return False
+    session.execute(update(Blob).where(Blob.sha256 == sha256).values(ref_count=Blob.ref_count - 1))
+    session.refresh(blob, ["ref_count"])
+    if blob.ref_count > 0:
+        return False
+    session.delete(blob)
+    return True
+
+
+def purge_blob(session: Session, sha256: str) -> None:
+    """Delete the bytes of a blob whose last reference was committed away"""
+    # Una subida concurrente del mismo contenido puede haberlo vuelto a referenciar
+    if session.get(Blob, sha256) is not None:
+        return
+    try:
+        get_blob_store().delete(sha256)
+    except Exception:
+        logger.exception("Could not delete blob %s", sha256)
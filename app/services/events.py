@@ -0,0 +1,152 @@
+# app/services/events.py
+"""
+In-process publish/subscribe for pushing events to connected clients.
+
+Producers (alert evaluation, import and sync jobs) publish small JSON events
+to a per-user channel from any thread; the /events/stream endpoint
+subscribes to the caller's channel and forwards them as server-sent events.
+
+The broker is pluggable: `set_broker` swaps the default InMemoryBroker for
+any `Broker` implementation (e.g. one backed by Redis pub/sub when running
+several worker processes). Publishing is fire-and-forget and never blocks
+the producer.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Eventos pendientes por suscriptor; si un cliente no consume, se descartan los más antiguos
+SUBSCRIPTION_QUEUE_SIZE = 256
+
+_event_ids = itertools.count(1)
+
+
+def user_channel(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+class Subscription(ABC):
+    """Events of one channel for one consumer"""
+
+    @abstractmethod
+    async def get(self, timeout: float) -> Optional[Dict]:
+        """Next event, or None if nothing arrived within `timeout` seconds"""
+
+    @abstractmethod
+    def close(self) -> None:
+        """Stop receiving events"""
+
+
+class Broker(ABC):
+    """Transport between producers and the subscriptions of a channel"""
+
+    @abstractmethod
+    def publish(self, channel: str, event: Dict) -> None:
+        """Deliver `event` to the current subscribers of `channel`; thread-safe and non-blocking"""
+
+    @abstractmethod
+    def subscribe(self, channel: str) -> Subscription:
+        """Subscribe from the running event loop"""
+
+    def has_subscribers(self, channel: str) -> bool:
+        """Whether publishing to `channel` can reach anyone (lets producers skip building events)"""
+        return True
+
+
+class _QueueSubscription(Subscription):
+
+    def __init__(self, broker: "InMemoryBroker", channel: str):
+        self._broker = broker
+        self._channel = channel
+        self._loop = asyncio.get_running_loop()
+        self._queue: asyncio.Queue = asyncio.Queue(SUBSCRIPTION_QUEUE_SIZE)
+
+    def deliver(self, event: Dict) -> None:
+        """Called from any thread"""
+        self._loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event: Dict) -> None:
+        if self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait(event)
+
+    async def get(self, timeout: float) -> Optional[Dict]:
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self) -> None:
+        self._broker.unsubscribe(self._channel, self)
+
+
+class InMemoryBroker(Broker):
+    """Single-process broker: one asyncio queue per subscription"""
+
+    def __init__(self):
+        self._channels: Dict[str, Set[_QueueSubscription]] = {}
+        self._lock = threading.Lock()
+
+    def publish(self, channel: str, event: Dict) -> None:
+        with self._lock:
+            subscriptions = list(self._channels.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.deliver(event)
+            except RuntimeError:
+                # El bucle del suscriptor ya se cerró
+                self.unsubscribe(channel, subscription)
+
+    def subscribe(self, channel: str) -> Subscription:
+        subscription = _QueueSubscription(self, channel)
+        with self._lock:
+            self._channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, channel: str, subscription: _QueueSubscription) -> None:
+        with self._lock:
+            subscriptions = self._channels.get(channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._channels[channel]
+
+    def has_subscribers(self, channel: str) -> bool:
+        with self._lock:
+            return channel in self._channels
+
+
+_broker: Broker = InMemoryBroker()
+
+
+def get_broker() -> Broker:
+    return _broker
+
+
+def set_broker(broker: Broker) -> None:
+    """Replace the broker (call at startup, before clients subscribe)"""
+    global _broker
+    _broker = broker
+
+
+def publish_user_event(user_id: int, event_type: str, data: Dict) -> None:
+    """Push an event to the user's connected clients; never raises"""
+    channel = user_channel(user_id)
+    try:
+        if _broker.has_subscribers(channel):
+            _broker.publish(channel, {"id": next(_event_ids), "type": event_type, "data": data})
+    except Exception:
+        logger.exception("Could not publish %s event for user %s", event_type, user_id)
+
+
+def format_sse(event: Dict) -> str:
+    """Server-sent events wire format"""
+    data = json.dumps(event["data"], default=str)
+    event_id = f"id: {event['id']}\n" if event.get("id") is not None else ""
+    return f"{event_id}event: {event['type']}\ndata: {data}\n\n"
@@ -0,0 +1,225 @@
+# app/services/expense_stats.py
+"""
+Rolling statistics of monthly expenses per (property, category).
+
+Every expense movement is added to a monthly bucket for its category and to
+the property's total bucket ("*"). ExpenseStats keeps Welford's running mean
+and variance of the bucket totals over the last EXPENSE_STATS_MONTHS closed
+months. A write to a month already in the window updates the stats in place
+(remove the old total, add the new one). When the calendar moves on, the
+window is rolled forward on the next read with one bounded range query.
+Reading the stats of a pair is a single row, so the z-score of the current
+month costs O(1).
+"""
+import math
+from datetime import date
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import delete, func, insert, update
+from sqlmodel import select
+
+from ..models import FinancialMovement, ExpenseMonthBucket, ExpenseStats
+from .upsert import upsert
+
+# Categoría reservada para el gasto total de la propiedad
+TOTAL_CATEGORY = "*"
+# Meses cerrados que entran en la media y la desviación
+EXPENSE_STATS_MONTHS = 12
+# Meses con gasto necesarios para juzgar el mes actual
+EXPENSE_MIN_MONTHS = 3
+# Un mes es anómalo si supera la media en EXPENSE_Z_THRESHOLD desviaciones
+# y además en un EXPENSE_MIN_RATIO relativo (evita avisos por céntimos con historia casi plana)
+EXPENSE_Z_THRESHOLD = 3.0
+EXPENSE_MIN_RATIO = 1.5
+
+# (n, mean, m2)
+Stats = Tuple[int, float, float]
+# (property_id, category)
+StatsKey = Tuple[int, str]
+
+EMPTY_STATS: Stats = (0, 0.0, 0.0)
+
+
+def month_index(day: date) -> int:
+    return day.year * 12 + day.month
+
+
+def expense_category(category: Optional[str], subcategory: Optional[str]) -> str:
+    return subcategory or category
+
+
+def welford_add(stats: Stats, value: float) -> Stats:
+    n, mean, m2 = stats
+    n += 1
+    delta = value - mean
+    mean += delta / n
+    return n, mean, m2 + delta * (value - mean)
+
+
+def welford_remove(stats: Stats, value: float) -> Stats:
+    """Inverse of welford_add for a value previously added"""
+    n, mean, m2 = stats
+    if n <= 1:
+        return EMPTY_STATS
+    new_mean = (n * mean - value) / (n - 1)
+    return n - 1, new_mean, max(0.0, m2 - (value - mean) * (value - new_mean))
+
+
+def stddev(stats: Stats) -> float:
+    n, _, m2 = stats
+    return math.sqrt(m2 / (n - 1)) if n > 1 else 0.0
+
+
+def zscore(stats: Stats, value: float) -> float:
+    """Standard score of `value`; infinite above a flat (zero-variance) history"""
+    _, mean, _ = stats
+    std = stddev(stats)
+    if std > 0:
+        return (value - mean) / std
+    return math.inf if value > mean else 0.0
+
+
+def is_anomaly(stats: Stats, value: float) -> bool:
+    """Current month far above the rolling history: z-score and relative size both over threshold"""
+    n, mean, _ = stats
+    if n < EXPENSE_MIN_MONTHS or value <= mean * EXPENSE_MIN_RATIO:
+        return False
+    return zscore(stats, value) >= EXPENSE_Z_THRESHOLD
+
+
+def add_expense(connection, property_id: int, category: str, expense_date: date, amount: float, count: int) -> None:
+    """Add `amount` (positive = spent) to the category and total buckets and fold it into the stats"""
+    for bucket_category in {category, TOTAL_CATEGORY}:
+        _add_to_bucket(connection, property_id, bucket_category, expense_date, amount, count)
+
+
+def _add_to_bucket(connection, property_id: int, category: str, expense_date: date, amount: float, count: int) -> None:
+    table = ExpenseMonthBucket.__table__
+    # Una sola sentencia: dos escrituras simultáneas del mismo mes no chocan en la clave única
+    new_total, new_count = upsert(
+        connection, table,
+        {"property_id": property_id, "category": category, "year": expense_date.year, "month": expense_date.month,
+         "total": amount, "count": count},
+        key=("property_id", "category", "year", "month"),
+        set_={"total": table.c.total + amount, "count": table.c.count + count},
+        returning=(table.c.total, table.c.count)
+    )
+    _fold_bucket_change(
+        connection, property_id, category, month_index(expense_date),
+        new_total - amount, new_count - count, new_total, new_count
+    )
+
+
+def _fold_bucket_change(
+    connection, property_id: int, category: str, month: int,
+    old_total: float, old_count: int, new_total: float, new_count: int
+) -> None:
+    table = ExpenseStats.__table__
+    # Bloqueo de la fila: dos escrituras a la vez no se pisan la media
+    row = connection.execute(
+        select(table).where(table.c.property_id == property_id).where(table.c.category == category).with_for_update()
+    ).first()
+    # El mes actual y los futuros aún no están en la ventana
+    if row is None or not row.through_month - EXPENSE_STATS_MONTHS < month <= row.through_month:
+        return
+    stats = (row.n, row.mean, row.m2)
+    if old_count > 0:
+        stats = welford_remove(stats, old_total)
+    if new_count > 0:
+        stats = welford_add(stats, new_total)
+    n, mean, m2 = stats
+    connection.execute(update(table).where(table.c.id == row.id).values(n=n, mean=mean, m2=m2))
+
+
+def _window_stats(connection, property_id: int, category: str, through_month: int) -> Stats:
+    table = ExpenseMonthBucket.__table__
+    month = table.c.year * 12 + table.c.month
+    totals = connection.execute(
+        select(table.c.total)
+        .where(table.c.property_id == property_id)
+        .where(table.c.category == category)
+        .where(table.c.count > 0)
+        .where(month > through_month - EXPENSE_STATS_MONTHS)
+        .where(month <= through_month)
+    ).scalars()
+    stats = EMPTY_STATS
+    for total in totals:
+        stats = welford_add(stats, total)
+    return stats
+
+
+def load_stats(connection, keys: Iterable[StatsKey], today: date) -> Dict[StatsKey, Stats]:
+    """Stats of the months before today's for each (property, category), rolling stale windows forward"""
+    keys = set(keys)
+    if not keys:
+        return {}
+    through_month = month_index(today) - 1
+    table = ExpenseStats.__table__
+    rows = {
+        (row.property_id, row.category): row
+        for row in connection.execute(
+            select(table).where(table.c.property_id.in_({property_id for property_id, _ in keys}))
+        ).all()
+    }
+
+    result: Dict[StatsKey, Stats] = {}
+    for key in keys:
+        row = rows.get(key)
+        if row is not None and row.through_month == through_month:
+            result[key] = (row.n, row.mean, row.m2)
+            continue
+        # Ventana nueva o mes cerrado desde la última lectura: una lectura acotada de buckets
+        stats = _window_stats(connection, *key, through_month)
+        n, mean, m2 = stats
+        window = {"through_month": through_month, "n": n, "mean": mean, "m2": m2}
+        upsert(
+            connection, table, {"property_id": key[0], "category": key[1], **window},
+            key=("property_id", "category"), set_=window
+        )
+        result[key] = stats
+    return result
+
+
+def current_month_totals(connection, property_ids: Iterable[int], today: date) -> Dict[StatsKey, float]:
+    """Expense totals of today's month per (property, category), including the "*" total"""
+    table = ExpenseMonthBucket.__table__
+    rows = connection.execute(
+        select(table.c.property_id, table.c.category, table.c.total)
+        .where(table.c.property_id.in_(list(property_ids)))
+        .where(table.c.year == today.year)
+        .where(table.c.month == today.month)
+        .where(table.c.count > 0)
+    ).all()
+    return {(property_id, category): total for property_id, category, total in rows}
+
+
+def rebuild_expense_buckets(connection) -> int:
+    """Recompute every bucket from the movements (returns how many); stats are rebuilt lazily on the next read"""
+    buckets = ExpenseMonthBucket.__table__
+    connection.execute(delete(ExpenseStats.__table__))
+    connection.execute(delete(buckets))
+
+    year = func.extract("year", FinancialMovement.date)
+    month = func.extract("month", FinancialMovement.date)
+    category = func.coalesce(func.nullif(FinancialMovement.subcategory, ""), FinancialMovement.category)
+    expenses = (
+        select(FinancialMovement.property_id, category, year, month, func.sum(-FinancialMovement.amount), func.count())
+        .where(FinancialMovement.property_id.is_not(None))
+        .where(FinancialMovement.amount < 0)
+        .group_by(FinancialMovement.property_id, category, year, month)
+    )
+    totals: Dict[Tuple[int, int, int], Tuple[float, int]] = {}
+    rows = []
+    for property_id, bucket_category, y, m, total, count in connection.execute(expenses).all():
+        key = (property_id, int(y), int(m))
+        rows.append({"property_id": property_id, "category": bucket_category, "year": key[1], "month": key[2],
+                     "total": total, "count": count})
+        month_total, month_count = totals.get(key, (0.0, 0))
+        totals[key] = (month_total + total, month_count + count)
+    rows.extend(
+        {"property_id": property_id, "category": TOTAL_CATEGORY, "year": y, "month": m, "total": total, "count": count}
+        for (property_id, y, m), (total, count) in totals.items()
+    )
+    if rows:
+        connection.execute(insert(buckets), rows)
+    return len(rows)
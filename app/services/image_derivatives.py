@@ -0,0 +1,267 @@
+# app/services/image_derivatives.py
+"""
+Resized WebP/JPEG variants of uploaded photos.
+
+Each photo gets DERIVATIVE_SIZES renditions (longest edge, never upscaled)
+in every DERIVATIVE_FORMATS encoding, so property cards and galleries can
+load a few tens of KB instead of the multi-MB original. Rendering runs on a
+small thread pool right after the upload (Pillow releases the GIL while
+resizing and encoding), so the request does not wait for it; until a
+rendition exists the original is served with a short cache lifetime, so
+clients pick the rendition up once it is ready. Sources that cannot be
+decoded are remembered and never queued again.
+
+Blob photos (/files) store their renditions in the blob store and index
+them in ImageDerivative by the source content hash, so duplicates share
+them. Disk photos (/uploads) get sibling files in a derivatives directory.
+"""
+import io
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+
+from ..config import settings
+from ..models_files import Blob, ImageDerivative
+from .blob_store import get_blob_store, release_blob, store_bytes
+
+logger = logging.getLogger(__name__)
+
+# Lado mayor en píxeles de cada tamaño
+DERIVATIVE_SIZES: Dict[str, int] = {"thumb": 200, "card": 640, "full": 1600}
+# formato -> (formato Pillow, content type, extensión)
+DERIVATIVE_FORMATS: Dict[str, Tuple[str, str, str]] = {
+    "webp": ("WEBP", "image/webp", "webp"),
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+}
+DERIVATIVE_QUALITY = 80
+# Las variantes no cambian nunca para una URL dada
+DERIVATIVE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Original servido en lugar de una variante que aún no existe: la URL cambiará de contenido
+DERIVATIVE_PENDING_CACHE_CONTROL = "public, max-age=300"
+# Fuentes que no se pudieron decodificar (las más antiguas salen primero)
+MAX_UNRENDERABLE = 10000
+
+_RENDER_ERRORS = (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError)
+
+
+@dataclass
+class Rendition:
+    size: str
+    format: str
+    content: bytes
+    width: int
+    height: int
+
+    @property
+    def content_type(self) -> str:
+        return DERIVATIVE_FORMATS[self.format][1]
+
+
+def preferred_format(accept: Optional[str]) -> str:
+    """WebP for clients that announce it, JPEG otherwise"""
+    return "webp" if accept and "image/webp" in accept else "jpeg"
+
+
+def _normalized(image: Image.Image) -> Image.Image:
+    image = ImageOps.exif_transpose(image)
+    has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+    target = "RGBA" if has_alpha else "RGB"
+    return image if image.mode == target else image.convert(target)
+
+
+def _encode(image: Image.Image, image_format: str) -> bytes:
+    pil_format = DERIVATIVE_FORMATS[image_format][0]
+    buffer = io.BytesIO()
+    if pil_format == "JPEG":
+        if image.mode == "RGBA":
+            # JPEG no admite transparencia: fondo blanco
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        image.save(buffer, pil_format, quality=DERIVATIVE_QUALITY, optimize=True, progressive=True)
+    else:
+        image.save(buffer, pil_format, quality=DERIVATIVE_QUALITY, method=4)
+    return buffer.getvalue()
+
+
+def render_derivatives(content: bytes) -> List[Rendition]:
+    """Every size in every format; raises if `content` is not a readable image"""
+    with Image.open(io.BytesIO(content)) as source:
+        image = _normalized(source)
+        renditions = []
+        for size, edge in DERIVATIVE_SIZES.items():
+            variant = image.copy()
+            variant.thumbnail((edge, edge), Image.Resampling.LANCZOS)
+            for image_format in DERIVATIVE_FORMATS:
+                renditions.append(Rendition(size, image_format, _encode(variant, image_format), *variant.size))
+        return renditions
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+# Trabajos en curso, para no encolar dos veces la misma imagen
+_pending: Set[str] = set()
+# Imágenes que no se pueden decodificar: no se vuelven a encolar en cada petición con tamaño
+_unrenderable: "OrderedDict[str, None]" = OrderedDict()
+
+
+def _mark_unrenderable(key: str) -> None:
+    with _executor_lock:
+        _unrenderable[key] = None
+        _unrenderable.move_to_end(key)
+        while len(_unrenderable) > MAX_UNRENDERABLE:
+            _unrenderable.popitem(last=False)
+
+
+def _submit(key: str, fn, *args) -> Optional[Future]:
+    global _executor
+    with _executor_lock:
+        if key in _pending or key in _unrenderable:
+            return None
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max(1, settings.image_workers), thread_name_prefix="image-derivatives")
+        _pending.add(key)
+
+    def run():
+        try:
+            return fn(*args)
+        except Exception:
+            logger.exception("Could not build derivatives for %s", key)
+        finally:
+            with _executor_lock:
+                _pending.discard(key)
+
+    return _executor.submit(run)
+
+
+def shutdown_derivative_pool() -> None:
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+# --- Fotos en el almacén de blobs -------------------------------------------------
+
+def _blob_key(source_sha256: str) -> str:
+    return f"blob:{source_sha256}"
+
+
+def build_blob_derivatives(engine, source_sha256: str) -> int:
+    """Render and store the missing renditions of a blob; returns how many were added"""
+    with Session(engine) as session:
+        existing = set(session.exec(
+            select(ImageDerivative.size, ImageDerivative.format).where(ImageDerivative.source_sha256 == source_sha256)
+        ).all())
+    if len(existing) == len(DERIVATIVE_SIZES) * len(DERIVATIVE_FORMATS):
+        return 0
+    # Un fallo al leer no marca la imagen: solo lo que no se puede decodificar
+    content = get_blob_store().read_bytes(source_sha256)
+    try:
+        renditions = render_derivatives(content)
+    except _RENDER_ERRORS as exc:
+        logger.warning("Blob %s is not a renderable image: %s", source_sha256, exc)
+        _mark_unrenderable(_blob_key(source_sha256))
+        return 0
+
+    added = [rendition for rendition in renditions if (rendition.size, rendition.format) not in existing]
+    with Session(engine) as session:
+        for rendition in added:
+            blob = store_bytes(session, rendition.content)
+            session.add(ImageDerivative(
+                source_sha256=source_sha256,
+                size=rendition.size,
+                format=rendition.format,
+                sha256=blob.sha256,
+                content_type=rendition.content_type,
+                width=rendition.width,
+                height=rendition.height,
+                file_size=len(rendition.content)
+            ))
+        try:
+            session.commit()
+        except IntegrityError:
+            # Otro trabajo generó las mismas variantes a la vez
+            session.rollback()
+            return 0
+    return len(added)
+
+
+def schedule_blob_derivatives(engine, source_sha256: str) -> Optional[Future]:
+    """Queue rendition of a stored photo (no-op if already queued or known not to be an image)"""
+    return _submit(_blob_key(source_sha256), build_blob_derivatives, engine, source_sha256)
+
+
+def find_blob_derivative(session: Session, source_sha256: str, size: str, image_format: str) -> Optional[ImageDerivative]:
+    return session.exec(
+        select(ImageDerivative)
+        .where(ImageDerivative.source_sha256 == source_sha256)
+        .where(ImageDerivative.size == size)
+        .where(ImageDerivative.format == image_format)
+    ).first()
+
+
+def release_photo_blob(session: Session, source_sha256: str) -> List[str]:
+    """
+    Drop a photo's reference to its blob; with the last one its renditions
+    go too. Returns the blobs left unreferenced, to purge after the commit.
+    """
+    blob = session.get(Blob, source_sha256)
+    orphaned = []
+    if blob is not None and blob.ref_count <= 1:
+        for derivative in session.exec(select(ImageDerivative).where(ImageDerivative.source_sha256 == source_sha256)).all():
+            session.delete(derivative)
+            orphaned.append(derivative.sha256)
+        # Las filas de variantes fuera antes que los blobs a los que apuntan
+        session.flush()
+        orphaned = [sha256 for sha256 in orphaned if release_blob(session, sha256)]
+    if release_blob(session, source_sha256):
+        orphaned.append(source_sha256)
+    return orphaned
+
+
+# --- Fotos en disco (/uploads) -------------------------------------------------------
+
+def file_derivative_path(directory: Path, filename: str, size: str, image_format: str) -> Path:
+    return directory / f"{Path(filename).stem}-{size}.{DERIVATIVE_FORMATS[image_format][2]}"
+
+
+def _file_key(source: Path) -> str:
+    return f"file:{source}"
+
+
+def build_file_derivatives(source: Path, directory: Path) -> int:
+    """Render the renditions of a photo on disk next to each other in `directory`"""
+    content = source.read_bytes()
+    try:
+        renditions = render_derivatives(content)
+    except _RENDER_ERRORS as exc:
+        logger.warning("%s is not a renderable image: %s", source, exc)
+        _mark_unrenderable(_file_key(source))
+        return 0
+    directory.mkdir(parents=True, exist_ok=True)
+    for rendition in renditions:
+        target = file_derivative_path(directory, source.name, rendition.size, rendition.format)
+        temp = target.with_name(f".{target.name}.tmp")
+        temp.write_bytes(rendition.content)
+        temp.replace(target)
+    return len(renditions)
+
+
+def schedule_file_derivatives(source: Path, directory: Path) -> Optional[Future]:
+    return _submit(_file_key(source), build_file_derivatives, source, directory)
+
+
+def delete_file_derivatives(directory: Path, filename: str) -> None:
+    for size in DERIVATIVE_SIZES:
+        for image_format in DERIVATIVE_FORMATS:
+            file_derivative_path(directory, filename, size, image_format).unlink(missing_ok=True)
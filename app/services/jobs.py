@@ -0,0 +1,162 @@
+# app/services/jobs.py
+"""
+Progress of long-running import and sync jobs.
+
+A job is a list of named steps; the code doing the work moves it through
+its steps and reports row progress, and every change is pushed to the
+user's event channel (throttled while rows are being processed). Jobs are
+kept in memory: the latest ones per user back the progress endpoints.
+"""
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from .events import publish_user_event
+
+# Segundos mínimos entre dos eventos de progreso del mismo paso
+JOB_PROGRESS_INTERVAL = 0.25
+# Trabajos terminados que se conservan en memoria
+MAX_FINISHED_JOBS = 200
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+@dataclass
+class Job:
+    id: str
+    user_id: int
+    kind: str  # "excel_import", "bankinter_sync"
+    steps: List[Dict[str, str]]
+    status: str = "pending"  # pending, in_progress, completed, failed
+    current_step: Optional[str] = None
+    progress_percentage: float = 0.0
+    stats: Dict[str, object] = field(default_factory=dict)
+    error: Optional[str] = None
+    started_at: datetime = field(default_factory=_now)
+    updated_at: datetime = field(default_factory=_now)
+    finished_at: Optional[datetime] = None
+    last_published: float = 0.0
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("completed", "failed")
+
+    def estimated_completion(self) -> Optional[datetime]:
+        if self.finished or self.progress_percentage <= 0:
+            return None
+        elapsed = self.updated_at - self.started_at
+        return self.started_at + elapsed * (100 / self.progress_percentage)
+
+    def to_dict(self) -> Dict:
+        estimated = self.estimated_completion()
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress_percentage": round(self.progress_percentage, 1),
+            "current_step": self.current_step,
+            "steps": [dict(step) for step in self.steps],
+            "stats": dict(self.stats),
+            "error": self.error,
+            "started_at": self.started_at.isoformat(),
+            "updated_at": self.updated_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "estimated_completion": estimated.isoformat() if estimated else None
+        }
+
+
+class JobTracker:
+
+    def __init__(self):
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def start(self, user_id: int, kind: str, steps: List[str]) -> Job:
+        job = Job(
+            id=f"{kind}_{uuid.uuid4().hex[:12]}",
+            user_id=user_id,
+            kind=kind,
+            steps=[{"step": name, "status": "pending"} for name in steps]
+        )
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        self._publish(job)
+        return job
+
+    def step(self, job: Job, name: str) -> None:
+        """Mark `name` in progress and every step before it completed"""
+        index = self._step_index(job, name)
+        for position, step in enumerate(job.steps):
+            if position < index:
+                step["status"] = "completed"
+            elif position == index:
+                step["status"] = "in_progress"
+        job.status = "in_progress"
+        job.current_step = name
+        job.progress_percentage = 100 * index / len(job.steps)
+        self._publish(job)
+
+    def progress(self, job: Job, done: int, total: int, **stats) -> None:
+        """Row progress inside the current step"""
+        index = self._step_index(job, job.current_step) if job.current_step else 0
+        fraction = done / total if total else 1.0
+        job.progress_percentage = 100 * (index + min(fraction, 1.0)) / len(job.steps)
+        job.stats.update(stats)
+        self._publish(job, throttle=done < total)
+
+    def finish(self, job: Job, **stats) -> None:
+        for step in job.steps:
+            step["status"] = "completed"
+        job.stats.update(stats)
+        job.status = "completed"
+        job.current_step = None
+        job.progress_percentage = 100.0
+        job.finished_at = _now()
+        self._publish(job)
+
+    def fail(self, job: Job, error: str) -> None:
+        for step in job.steps:
+            if step["status"] == "in_progress":
+                step["status"] = "failed"
+        job.status = "failed"
+        job.error = error
+        job.finished_at = _now()
+        self._publish(job)
+
+    def latest(self, user_id: int, kind: Optional[str] = None) -> Optional[Job]:
+        with self._lock:
+            jobs = [job for job in self._jobs.values() if job.user_id == user_id and kind in (None, job.kind)]
+        return max(jobs, key=lambda job: job.started_at, default=None)
+
+    def active(self, user_id: int) -> List[Job]:
+        with self._lock:
+            return [job for job in self._jobs.values() if job.user_id == user_id and not job.finished]
+
+    @staticmethod
+    def _step_index(job: Job, name: str) -> int:
+        for position, step in enumerate(job.steps):
+            if step["step"] == name:
+                return position
+        raise ValueError(f"Unknown step {name!r} for job {job.kind}")
+
+    def _publish(self, job: Job, throttle: bool = False) -> None:
+        job.updated_at = _now()
+        now = time.monotonic()
+        if throttle and now - job.last_published < JOB_PROGRESS_INTERVAL:
+            return
+        job.last_published = now
+        publish_user_event(job.user_id, "job", job.to_dict())
+
+    def _prune(self) -> None:
+        finished = sorted((job for job in self._jobs.values() if job.finished), key=lambda job: job.started_at)
+        for job in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job.id]
+
+
+job_tracker = JobTracker()
@@ -1,176 +1,419 @@
 # app/services/mortgage_calculator.py
+"""
+Single mortgage engine used by every route.
+
+The schedule is planned as constant-rate segments (split at rate revisions
+and prepayments); totals, balances and the current status are computed in
+closed form per segment and rows are only expanded when requested.
+Plans are cached by the content of their inputs, so any change to the
+mortgage, its revisions or its prepayments produces a new cache key.
+"""
+from dataclasses import dataclass
 from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
-from typing import List, Dict, Optional
-import pandas as pd
-import numpy as np
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Tuple
 
 from ..models import MortgageDetails, MortgageRevision, MortgagePrepayment
+from .amortization import AnnuityLoan, BALANCE_TOLERANCE
+
+# Estrategias al amortizar anticipadamente
+REDUCE_PAYMENT = "reduce_payment"  # Mantener plazo, bajar cuota
+REDUCE_TERM = "reduce_term"        # Mantener cuota, acortar plazo
+STRATEGIES = (REDUCE_PAYMENT, REDUCE_TERM)
+
+# Euribor usado cuando no hay ningún dato en la tabla EuriborRate
+DEFAULT_EURIBOR = 3.5
+
+PLAN_CACHE_SIZE = 512
+
+
+@dataclass(frozen=True)
+class LoanInputs:
+    """Hashable snapshot of everything a schedule depends on"""
+    principal: float
+    start_month: int  # year * 12 + month - 1
+    end_month: int
+    rates: Tuple[Tuple[int, float], ...]  # (first month it applies, annual %)
+    prepayments: Tuple[Tuple[int, float], ...]  # (month, amount)
+    strategy: str = REDUCE_PAYMENT
+
+
+@dataclass(frozen=True)
+class Segment:
+    """Run of payments at a constant rate and payment"""
+    start_month: int
+    months: int
+    balance: float  # balance before the first payment
+    annual_rate: float
+    payment: float
+    prepayment: float  # applied after the last payment of the segment
+
+    def loan(self) -> AnnuityLoan:
+        return AnnuityLoan(self.balance, self.annual_rate, None, self.months, payment=self.payment)
+
+    def totals(self) -> Tuple[float, float]:
+        """(interest, principal) paid by the regular payments of the segment"""
+        loan = self.loan()
+        interest = 0.0
+        if loan.monthly_rate != 0:
+            growth = (1 + loan.monthly_rate) ** self.months
+            interest = (self.balance - self.payment / loan.monthly_rate) * (growth - 1) + self.months * self.payment
+        principal = self.balance - loan.balance_at(self.months)
+        return interest, principal
+
+
+def month_index(value: date) -> int:
+    return value.year * 12 + value.month - 1
+
+
+def month_start(index: int) -> datetime:
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def _first_month_applied(effective_date: date) -> int:
+    """A revision applies from the first month starting on or after its date"""
+    index = month_index(effective_date)
+    return index if effective_date.day == 1 else index + 1
+
+
+def build_inputs(
+    mortgage: MortgageDetails,
+    revisions: List[MortgageRevision],
+    prepayments: List[MortgagePrepayment],
+    strategy: str = REDUCE_PAYMENT
+) -> LoanInputs:
+    """Normalize ORM rows into a cache key"""
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown prepayment strategy: {strategy}")
+
+    if mortgage.mortgage_type == "Fija" or not revisions:
+        # Fixed mortgages (and variable ones without revisions) use the margin as rate
+        rates = ((month_index(mortgage.start_date), float(mortgage.margin_percentage)),)
+    else:
+        rates = tuple(
+            (_first_month_applied(rev.effective_date), float((rev.euribor_rate or 0.0) + (rev.margin_rate or 0.0)))
+            for rev in sorted(revisions, key=lambda x: x.effective_date)
+        )
+
+    prepayments_by_month: Dict[int, float] = {}
+    for prep in prepayments:
+        index = month_index(prep.payment_date)
+        prepayments_by_month[index] = prepayments_by_month.get(index, 0.0) + prep.amount
+
+    return LoanInputs(
+        principal=float(mortgage.initial_amount),
+        start_month=month_index(mortgage.start_date),
+        end_month=month_index(mortgage.end_date),
+        rates=rates,
+        prepayments=tuple(sorted(prepayments_by_month.items())),
+        strategy=strategy
+    )
+
+
+def _rate_at(rates: Tuple[Tuple[int, float], ...], month: int) -> float:
+    """Rate of the latest revision applied by `month` (the first one before any applies)"""
+    current = rates[0][1]
+    for first_month, annual_rate in rates:
+        if first_month > month:
+            break
+        current = annual_rate
+    return current
+
+
+@lru_cache(maxsize=PLAN_CACHE_SIZE)
+def build_plan(inputs: LoanInputs) -> Tuple[Segment, ...]:
+    """Split the loan into constant-rate segments, O(revisions + prepayments)"""
+    if inputs.principal <= 0:
+        return ()
+
+    start, end = inputs.start_month, inputs.end_month
+    prepayments = {month: amount for month, amount in inputs.prepayments if start <= month <= end}
+    boundaries = {start}
+    boundaries.update(month for month, _ in inputs.rates if start < month <= end)
+    boundaries.update(month + 1 for month in prepayments if month < end)
+    boundaries = sorted(boundaries)
+
+    segments: List[Segment] = []
+    balance = inputs.principal
+    term_end = end
+    annual_rate: Optional[float] = None
+    payment = 0.0
+    prepaid = False
+
+    for position, segment_start in enumerate(boundaries):
+        if balance <= BALANCE_TOLERANCE:
+            break
+        segment_end = boundaries[position + 1] - 1 if position + 1 < len(boundaries) else end
+        new_rate = _rate_at(inputs.rates, segment_start)
+
+        if prepaid and inputs.strategy == REDUCE_TERM:
+            # Keep the payment, the loan simply ends earlier
+            term_end = segment_start - 1 + AnnuityLoan(balance, annual_rate, None, 0, payment=payment).payoff_month()
+            if new_rate != annual_rate:
+                payment = AnnuityLoan.annuity_payment(balance, new_rate / 100.0 / 12.0, term_end - segment_start + 1)
+        else:
+            payment = AnnuityLoan.annuity_payment(balance, new_rate / 100.0 / 12.0, term_end - segment_start + 1)
+        annual_rate = new_rate
+
+        payoff = AnnuityLoan(balance, annual_rate, None, 0, payment=payment).payoff_month()
+        months = min(segment_end - segment_start + 1, payoff)
+        if months <= 0:
+            break
+
+        last_month = segment_start + months - 1
+        segment = Segment(segment_start, months, balance, annual_rate, payment, 0.0)
+        balance = segment.loan().balance_at(months)
+
+        prepayment = min(prepayments.get(last_month, 0.0), balance)
+        if prepayment > 0:
+            balance -= prepayment
+            segment = Segment(segment_start, months, segment.balance, annual_rate, payment, prepayment)
+        segments.append(segment)
+        prepaid = prepayment > 0
+
+        if months < segment_end - segment_start + 1:
+            break  # Paid off inside the segment
+
+    return tuple(segments)
+
+
+def plan_cache_info():
+    """Hit/miss statistics of the shared plan cache"""
+    return build_plan.cache_info()
+
+
+def clear_plan_cache() -> None:
+    build_plan.cache_clear()
+
+
+def _iter_segment_rows(segment: Segment, first: int = 0, last: Optional[int] = None) -> Iterator[Dict]:
+    """Rows `first`..`last` (0-based, inclusive) of a segment, one at a time"""
+    last = segment.months - 1 if last is None else last
+    loan = segment.loan()
+    rate = loan.monthly_rate
+    balance = loan.balance_at(first)
+    for k in range(first, last + 1):
+        payment = segment.payment
+        interest = balance * rate
+        principal = max(0.0, payment - interest)
+        if principal > balance:
+            principal = balance
+            payment = interest + principal
+        balance = max(0.0, balance - principal)
+
+        prepayment = 0.0
+        if k == segment.months - 1 and segment.prepayment > 0:
+            prepayment = min(segment.prepayment, balance)
+            balance -= prepayment
+            principal += prepayment
+            payment += prepayment
+
+        yield {
+            "month": month_start(segment.start_month + k),
+            "payment": float(payment),
+            "interest": float(interest),
+            "principal": float(principal),
+            "balance": float(balance),
+            "annual_rate": float(segment.annual_rate),
+            "prepayment": float(prepayment)
+        }
+
+
+def _segment_rows(segment: Segment, first: int = 0, last: Optional[int] = None) -> List[Dict]:
+    return list(_iter_segment_rows(segment, first, last))
+
+
+def iter_plan_rows(plan: Tuple[Segment, ...], first: int = 0, last: Optional[int] = None) -> Iterator[Dict]:
+    """Rows `first`..`last` (0-based, inclusive) of the plan, expanding only the segments they fall in"""
+    offset = 0
+    for segment in plan:
+        segment_end = offset + segment.months - 1
+        if last is not None and offset > last:
+            return
+        if segment_end >= first:
+            yield from _iter_segment_rows(
+                segment, max(first - offset, 0), segment.months - 1 if last is None else min(last, segment_end) - offset
+            )
+        offset += segment.months
+
+
+def plan_rows(plan: Tuple[Segment, ...]) -> List[Dict]:
+    return list(iter_plan_rows(plan))
+
+
+def plan_length(plan: Tuple[Segment, ...]) -> int:
+    return sum(segment.months for segment in plan)
+
+
+def plan_row_at(plan: Tuple[Segment, ...], position: int) -> Dict:
+    """Single schedule row (0-based) without expanding the others"""
+    for segment in plan:
+        if position < segment.months:
+            return _segment_rows(segment, position, position)[0]
+        position -= segment.months
+    raise IndexError("Schedule position out of range")
+
+
+def plan_tail(plan: Tuple[Segment, ...], position: int) -> Tuple[Segment, ...]:
+    """The plan from row `position` (0-based) on, splitting the segment it falls in"""
+    tail: List[Segment] = []
+    for segment in plan:
+        if position >= segment.months:
+            position -= segment.months
+            continue
+        if position > 0:
+            segment = Segment(
+                segment.start_month + position, segment.months - position, segment.loan().balance_at(position),
+                segment.annual_rate, segment.payment, segment.prepayment
+            )
+            position = 0
+        tail.append(segment)
+    return tuple(tail)
+
+
+def plan_totals(plan: Tuple[Segment, ...]) -> Dict:
+    total_interest = 0.0
+    total_principal = 0.0
+    total_prepayments = 0.0
+    for segment in plan:
+        interest, principal = segment.totals()
+        total_interest += interest
+        total_principal += principal + segment.prepayment
+        total_prepayments += segment.prepayment
+    return {
+        "total_payments": total_interest + total_principal,
+        "total_interest": total_interest,
+        "total_principal": total_principal,
+        "total_prepayments": total_prepayments,
+        "loan_term_months": plan_length(plan)
+    }
+
 
 class MortgageCalculator:
     """Service for mortgage calculations based on the original Streamlit agent logic"""
-    
+
     @staticmethod
     def calculate_monthly_payment(principal: float, monthly_rate: float, num_payments: int) -> float:
         """Calculate monthly mortgage payment using standard formula"""
-        if num_payments <= 0:
-            return principal
-        if monthly_rate <= 0:
-            return principal / num_payments
-        
-        return principal * (monthly_rate) / (1 - (1 + monthly_rate) ** (-num_payments))
-    
+        return AnnuityLoan.annuity_payment(principal, monthly_rate, num_payments)
+
+    @staticmethod
+    def plan(
+        mortgage: MortgageDetails,
+        revisions: List[MortgageRevision],
+        prepayments: List[MortgagePrepayment],
+        strategy: str = REDUCE_PAYMENT
+    ) -> Tuple[Segment, ...]:
+        """Cached segment plan for a mortgage"""
+        return build_plan(build_inputs(mortgage, revisions, prepayments, strategy))
+
     @staticmethod
     def generate_amortization_schedule(
         mortgage: MortgageDetails,
         revisions: List[MortgageRevision],
-        prepayments: List[MortgagePrepayment]
+        prepayments: List[MortgagePrepayment],
+        strategy: str = REDUCE_PAYMENT
     ) -> List[Dict]:
         """
         Generate complete amortization schedule with revisions and prepayments
         Based on the original schedule_con_revisiones_y_prepagos function
         """
-        if mortgage.initial_amount <= 0:
-            return []
-        
-        # Sort revisions by effective date
-        revisions_sorted = sorted(revisions, key=lambda x: x.effective_date)
-        
-        # Group prepayments by month
-        prepayments_by_month = {}
-        for prep in prepayments:
-            month_period = pd.Period(prep.payment_date, freq="M")
-            if month_period not in prepayments_by_month:
-                prepayments_by_month[month_period] = 0
-            prepayments_by_month[month_period] += prep.amount
-        
-        schedule = []
-        balance = float(mortgage.initial_amount)
-        current_month = pd.Period(mortgage.start_date, freq="M")
-        end_month = pd.Period(mortgage.end_date, freq="M")
-        revision_index = 0
-        
-        while current_month <= end_month and balance > 0.01:
-            months_remaining = (end_month - current_month).n + 1
-            month_date = current_month.to_timestamp().date()
-            
-            # Determine current interest rate
-            annual_rate = 0.0
-            if mortgage.mortgage_type == "Fija":
-                # For fixed mortgages, use margin as the fixed rate
-                annual_rate = mortgage.margin_percentage
-            else:
-                # For variable mortgages, find applicable revision
-                while (revision_index + 1 < len(revisions_sorted) and 
-                       revisions_sorted[revision_index + 1].effective_date <= month_date):
-                    revision_index += 1
-                
-                if revisions_sorted:
-                    current_revision = revisions_sorted[revision_index]
-                    euribor = current_revision.euribor_rate or 0.0
-                    margin = current_revision.margin_rate or 0.0
-                    annual_rate = euribor + margin
-                else:
-                    annual_rate = mortgage.margin_percentage
-            
-            monthly_rate = annual_rate / 100.0 / 12.0
-            
-            # Calculate monthly payment
-            monthly_payment = MortgageCalculator.calculate_monthly_payment(
-                balance, monthly_rate, months_remaining
-            )
-            
-            # Calculate interest and principal
-            interest_payment = balance * monthly_rate
-            principal_payment = max(0.0, monthly_payment - interest_payment)
-            
-            # Ensure we don't pay more principal than remaining balance
-            if principal_payment > balance:
-                principal_payment = balance
-                monthly_payment = interest_payment + principal_payment
-            
-            # Apply payment
-            balance = max(0.0, balance - principal_payment)
-            
-            # Apply prepayments if any for this month
-            prepayment_amount = prepayments_by_month.get(current_month, 0.0)
-            if prepayment_amount > 0:
-                if prepayment_amount > balance:
-                    prepayment_amount = balance
-                balance -= prepayment_amount
-                principal_payment += prepayment_amount
-                monthly_payment += prepayment_amount
-            
-            # Add to schedule
-            schedule.append({
-                "month": current_month.to_timestamp(),
-                "payment": float(monthly_payment),
-                "interest": float(interest_payment),
-                "principal": float(principal_payment),
-                "balance": float(balance),
-                "annual_rate": float(annual_rate),
-                "prepayment": float(prepayment_amount)
-            })
-            
-            current_month += 1
-        
-        return schedule
-    
+        return plan_rows(MortgageCalculator.plan(mortgage, revisions, prepayments, strategy))
+
     @staticmethod
     def calculate_current_payment_and_balance(
         mortgage: MortgageDetails,
         revisions: List[MortgageRevision],
         prepayments: List[MortgagePrepayment],
-        as_of_date: Optional[date] = None
+        as_of_date: Optional[date] = None,
+        strategy: str = REDUCE_PAYMENT
     ) -> Dict:
         """Calculate current monthly payment and outstanding balance"""
         if not as_of_date:
             as_of_date = date.today()
-        
-        schedule = MortgageCalculator.generate_amortization_schedule(
-            mortgage, revisions, prepayments
-        )
-        
-        if not schedule:
+
+        plan = MortgageCalculator.plan(mortgage, revisions, prepayments, strategy)
+        length = plan_length(plan)
+
+        if not length:
             return {
                 "current_payment": 0.0,
                 "current_balance": mortgage.outstanding_balance,
                 "as_of_date": as_of_date
             }
-        
-        # Find the schedule entry for the current date or closest past date
-        target_period = pd.Period(as_of_date, freq="M").to_timestamp()
-        
-        current_entry = None
-        for entry in schedule:
-            if entry["month"] <= target_period:
-                current_entry = entry
-            else:
-                break
-        
-        if not current_entry:
-            # If no past entry found, use the first one
-            current_entry = schedule[0]
-        
+
+        # Entry for the as-of month, or the closest one inside the schedule
+        position = month_index(as_of_date) - plan[0].start_month
+        current_entry = plan_row_at(plan, min(max(position, 0), length - 1))
+
         return {
             "current_payment": current_entry["payment"],
             "current_balance": current_entry["balance"],
             "annual_rate": current_entry["annual_rate"],
             "as_of_date": as_of_date
         }
-    
+
+    @staticmethod
+    def current_position(
+        mortgage: MortgageDetails,
+        revisions: List[MortgageRevision],
+        prepayments: List[MortgagePrepayment],
+        as_of_date: Optional[date] = None,
+        strategy: str = REDUCE_PAYMENT
+    ) -> Dict:
+        """
+        Where the loan stands on `as_of_date` according to the plan: payment
+        and rate of that month, balance after it (as in the summary) and the
+        months and interest still to come.
+        """
+        as_of_date = as_of_date or date.today()
+        plan = MortgageCalculator.plan(mortgage, revisions, prepayments, strategy)
+        length = plan_length(plan)
+        if not length:
+            return {
+                "payment": 0.0, "annual_rate": 0.0, "balance": 0.0,
+                "remaining_months": 0, "remaining_interest": 0.0, "end_date": as_of_date
+            }
+
+        position = min(max(month_index(as_of_date) - plan[0].start_month, 0), length - 1)
+        current_entry = plan_row_at(plan, position)
+        tail = plan_tail(plan, position + 1)
+        remaining = plan_totals(tail)
+        last = plan[-1]
+        return {
+            "payment": current_entry["payment"],
+            "annual_rate": current_entry["annual_rate"],
+            "balance": current_entry["balance"],
+            "remaining_months": remaining["loan_term_months"],
+            "remaining_interest": remaining["total_interest"],
+            "end_date": month_start(last.start_month + last.months - 1).date()
+        }
+
+    @staticmethod
+    def current_loan(position: Dict, as_of_date: Optional[date] = None, annual_rate: Optional[float] = None) -> AnnuityLoan:
+        """
+        Constant-rate projection from a `current_position`, for what-if
+        scenarios (another rate, a refinancing); by default at the rate in force.
+        """
+        if annual_rate is None:
+            return AnnuityLoan(
+                position["balance"], position["annual_rate"], as_of_date or date.today(),
+                position["remaining_months"], payment=position["payment"]
+            )
+        return AnnuityLoan(position["balance"], annual_rate, as_of_date or date.today(), position["remaining_months"])
+
     @staticmethod
     def calculate_mortgage_summary(
         mortgage: MortgageDetails,
         revisions: List[MortgageRevision],
-        prepayments: List[MortgagePrepayment]
+        prepayments: List[MortgagePrepayment],
+        strategy: str = REDUCE_PAYMENT
     ) -> Dict:
         """Calculate comprehensive mortgage summary"""
-        schedule = MortgageCalculator.generate_amortization_schedule(
-            mortgage, revisions, prepayments
-        )
-        
-        if not schedule:
+        plan = MortgageCalculator.plan(mortgage, revisions, prepayments, strategy)
+
+        if not plan:
             return {
                 "total_payments": 0.0,
                 "total_interest": 0.0,
@@ -180,28 +423,20 @@ class MortgageCalculator:
                 "current_payment": 0.0,
                 "current_balance": mortgage.outstanding_balance
             }
-        
-        total_payments = sum(entry["payment"] for entry in schedule)
-        total_interest = sum(entry["interest"] for entry in schedule)
-        total_principal = sum(entry["principal"] for entry in schedule)
-        total_prepayments = sum(entry["prepayment"] for entry in schedule)
-        
+
         # Get current status
         current_status = MortgageCalculator.calculate_current_payment_and_balance(
-            mortgage, revisions, prepayments
+            mortgage, revisions, prepayments, strategy=strategy
         )
-        
-        return {
-            "total_payments": total_payments,
-            "total_interest": total_interest,
-            "total_principal": total_principal,
-            "total_prepayments": total_prepayments,
-            "loan_term_months": len(schedule),
+
+        summary = plan_totals(plan)
+        summary.update({
             "current_payment": current_status["current_payment"],
             "current_balance": current_status["current_balance"],
             "annual_rate": current_status.get("annual_rate", 0.0)
-        }
-    
+        })
+        return summary
+
     @staticmethod
     def generate_revision_calendar(
         start_date: date,
@@ -212,59 +447,61 @@ class MortgageCalculator:
         """Generate calendar of mortgage revision dates"""
         if period_months <= 0:
             return []
-        
+
         revision_dates = []
         current_date = start_date
-        
+
         while current_date <= end_date:
             revision_dates.append(current_date.isoformat())  # Return date in ISO format (YYYY-MM-DD)
             current_date = current_date + relativedelta(months=+period_months)
-        
+
         return revision_dates
-    
+
     @staticmethod
     def calculate_prepayment_impact(
         mortgage: MortgageDetails,
         revisions: List[MortgageRevision],
         existing_prepayments: List[MortgagePrepayment],
         new_prepayment_amount: float,
-        new_prepayment_date: date
+        new_prepayment_date: date,
+        strategy: str = REDUCE_PAYMENT
     ) -> Dict:
         """Calculate the impact of a new prepayment on the mortgage"""
         # Calculate original scenario
-        original_schedule = MortgageCalculator.generate_amortization_schedule(
-            mortgage, revisions, existing_prepayments
+        original_plan = MortgageCalculator.plan(
+            mortgage, revisions, existing_prepayments, strategy
         )
-        
+
         # Calculate scenario with new prepayment
         new_prepayment = MortgagePrepayment(
             mortgage_id=mortgage.id,
             payment_date=new_prepayment_date,
             amount=new_prepayment_amount
         )
-        all_prepayments = existing_prepayments + [new_prepayment]
-        
-        new_schedule = MortgageCalculator.generate_amortization_schedule(
-            mortgage, revisions, all_prepayments
+        all_prepayments = list(existing_prepayments) + [new_prepayment]
+
+        new_plan = MortgageCalculator.plan(
+            mortgage, revisions, all_prepayments, strategy
         )
-        
-        if not original_schedule or not new_schedule:
+
+        if not original_plan or not new_plan:
             return {"error": "Could not calculate prepayment impact"}
-        
+
         # Calculate savings
-        original_total_interest = sum(entry["interest"] for entry in original_schedule)
-        new_total_interest = sum(entry["interest"] for entry in new_schedule)
-        interest_savings = original_total_interest - new_total_interest
-        
+        original = plan_totals(original_plan)
+        new = plan_totals(new_plan)
+        interest_savings = original["total_interest"] - new["total_interest"]
+
         # Calculate time savings (months)
-        time_savings_months = len(original_schedule) - len(new_schedule)
-        
+        time_savings_months = original["loan_term_months"] - new["loan_term_months"]
+
         return {
             "prepayment_amount": new_prepayment_amount,
+            "strategy": strategy,
             "interest_savings": interest_savings,
             "time_savings_months": time_savings_months,
-            "original_term_months": len(original_schedule),
-            "new_term_months": len(new_schedule),
-            "original_total_interest": original_total_interest,
-            "new_total_interest": new_total_interest
-        }
\ No newline at end of file
+            "original_term_months": original["loan_term_months"],
+            "new_term_months": new["loan_term_months"],
+            "original_total_interest": original["total_interest"],
+            "new_total_interest": new["total_interest"]
+        }
@@ -0,0 +1,228 @@
+# app/services/refinancing.py
+"""
+Refinancing comparison on top of the mortgage engine.
+
+Every scenario (keep the current loan, or refinance with an offer, each
+after prepaying a fraction of the available cash) is a constant-rate
+annuity, so all of them are evaluated at once with numpy arrays using the
+same closed forms as AnnuityLoan: payment, payoff month, balance at month
+k, present value of the payments and the month-by-month exit cost used for
+the break-even month. The exit costs are walked in blocks of months, so
+memory stays bounded however many scenarios and months there are.
+"""
+from dataclasses import dataclass
+from typing import Dict, List
+
+import numpy as np
+
+from .amortization import AnnuityLoan, BALANCE_TOLERANCE
+
+KEEP_CURRENT = "current"
+# Celdas (escenarios x meses) de coste de salida evaluadas a la vez al buscar el punto de equilibrio
+BREAK_EVEN_BLOCK_CELLS = 1 << 17
+
+
+@dataclass(frozen=True)
+class RefinanceOption:
+    """Candidate loan that would replace the current balance"""
+    name: str
+    annual_rate: float
+    term_months: int
+    fees: float = 0.0  # fixed opening costs (tasación, notaría, gestoría...)
+    fees_percentage: float = 0.0  # opening commission over the new principal
+
+
+def _annuity_payments(principal: np.ndarray, monthly_rate: np.ndarray, months: np.ndarray) -> np.ndarray:
+    """Vectorised AnnuityLoan.annuity_payment"""
+    months = np.maximum(months, 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        annuity = principal * monthly_rate / (1 - (1 + monthly_rate) ** (-months))
+    return np.where(monthly_rate == 0, principal / months, annuity)
+
+
+def _payoff_months(principal: np.ndarray, monthly_rate: np.ndarray, payment: np.ndarray) -> np.ndarray:
+    """Vectorised AnnuityLoan.payoff_month (0 when the payment does not amortize)"""
+    amortizes = (principal > BALANCE_TOLERANCE) & (payment > principal * monthly_rate)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = (payment - monthly_rate * BALANCE_TOLERANCE) / (payment - monthly_rate * principal)
+        months = np.where(
+            monthly_rate == 0,
+            (principal - BALANCE_TOLERANCE) / payment,
+            np.log(ratio) / np.log1p(monthly_rate)
+        )
+    months = np.maximum(1, np.ceil(np.nan_to_num(months) - 1e-9))
+    return np.where(amortizes, months, 0).astype(int)
+
+
+def _balances(principal, monthly_rate, payment, months) -> np.ndarray:
+    """Signed closed-form balance after `months` payments (negative = overpaid)"""
+    growth = (1 + monthly_rate) ** months
+    with np.errstate(divide="ignore", invalid="ignore"):
+        balance = principal * growth - payment * (growth - 1) / monthly_rate
+    return np.where(monthly_rate == 0, principal - payment * months, balance)
+
+
+def _present_value(payment, months, last_balance, monthly_discount: float) -> np.ndarray:
+    """PV of `months` payments, the last one reduced by the overpaid balance"""
+    if monthly_discount == 0:
+        return payment * months + np.minimum(last_balance, 0)
+    discount = (1 + monthly_discount) ** (-months)
+    return payment * (1 - discount) / monthly_discount + np.minimum(last_balance, 0) * discount
+
+
+def _exit_costs(principal, monthly_rate, payment, upfront, months, last_balance, first: int, last: int) -> np.ndarray:
+    """Exit cost (S x months first..last): paid so far plus the balance still owed at month k"""
+    grid = np.arange(first, last + 1)[None, :]
+    n = months[:, None]
+    elapsed = np.minimum(grid, n)
+    paid_so_far = payment[:, None] * elapsed + np.where(grid >= n, np.minimum(last_balance, 0)[:, None], 0.0)
+    still_owed = np.maximum(_balances(principal[:, None], monthly_rate[:, None], payment[:, None], elapsed), 0.0)
+    return upfront[:, None] + paid_so_far + still_owed
+
+
+def _break_even(principal, monthly_rate, payment, upfront, months, last_balance) -> np.ndarray:
+    """
+    First month from which each scenario is cheaper to have taken than the
+    last one (the baseline) and stays so to the end of the horizon; 0 when
+    it never does. Only the last month each scenario is still dearer is
+    kept while the months are walked block by block.
+    """
+    horizon = int(months.max()) if months.size else 0
+    block = max(1, BREAK_EVEN_BLOCK_CELLS // max(1, months.size))
+    last_dearer = np.zeros(months.size, dtype=int)
+    for first in range(1, horizon + 1, block):
+        last = min(horizon, first + block - 1)
+        exit_cost = _exit_costs(principal, monthly_rate, payment, upfront, months, last_balance, first, last)
+        dearer = exit_cost > exit_cost[-1][None, :] + 1e-6
+        latest = last - np.argmax(np.flip(dearer, axis=1), axis=1)
+        last_dearer = np.where(dearer.any(axis=1), latest, last_dearer)
+    return np.where(last_dearer < horizon, last_dearer + 1, 0)
+
+
+def evaluate_scenarios(
+    principal: np.ndarray,
+    annual_rate: np.ndarray,
+    payment: np.ndarray,
+    upfront: np.ndarray,
+    discount_rate: float
+) -> Dict[str, np.ndarray]:
+    """
+    Evaluate S annuity scenarios in one pass.
+
+    `upfront` is the cash paid at month 0 (prepayment + fees). The last
+    scenario is the baseline: "break_even" is the month from which each one
+    is cheaper than it (0 = never), comparing what it would cost to have
+    paid the loan so far and settle it at every month.
+    """
+    monthly_rate = annual_rate / 100.0 / 12.0
+    months = _payoff_months(principal, monthly_rate, payment)
+    last_balance = _balances(principal, monthly_rate, payment, months)
+    total_paid = np.where(months > 0, payment * months + np.minimum(last_balance, 0), 0.0)
+
+    return {
+        "months": months,
+        "payment": np.where(months > 0, payment, 0.0),
+        "total_interest": np.maximum(total_paid - principal, 0.0) * (months > 0),
+        "total_cost": upfront + total_paid,
+        "npv": upfront + _present_value(payment, months, last_balance, discount_rate / 100.0 / 12.0) * (months > 0),
+        "break_even": _break_even(principal, monthly_rate, payment, upfront, months, last_balance)
+    }
+
+
+def compare_refinancing(
+    current: AnnuityLoan,
+    options: List[RefinanceOption],
+    available_cash: float = 0.0,
+    discount_rate: float = 0.0,
+    cancellation_fee_percentage: float = 0.0,
+    mix_steps: int = 10
+) -> Dict:
+    """
+    Compare the current loan against each refinancing option.
+
+    For every alternative the available cash is split in `mix_steps` + 1
+    fractions used to prepay before refinancing (or, for the current loan,
+    as a prepayment that keeps the payment and shortens the term).
+    """
+    balance = current.principal
+    fractions = np.linspace(0.0, 1.0, mix_steps + 1) if available_cash > 0 else np.zeros(1)
+    prepayments = np.minimum(fractions * available_cash, balance)
+
+    names = [KEEP_CURRENT] + [option.name for option in options]
+    rates = np.array([current.annual_rate] + [option.annual_rate for option in options], dtype=float)
+    terms = np.array([current.term_months] + [option.term_months for option in options], dtype=int)
+    fixed_fees = np.array([0.0] + [option.fees for option in options])
+    fee_pct = np.array([0.0] + [option.fees_percentage for option in options])
+
+    # Scenario grid: alternatives x prepayment fractions, flattened
+    alternatives, steps = len(names), len(prepayments)
+    alt_index = np.repeat(np.arange(alternatives), steps)
+    prepay = np.tile(prepayments, alternatives)
+    refinances = alt_index > 0
+
+    principal = balance - prepay
+    monthly_rate = rates[alt_index] / 100.0 / 12.0
+    fees = np.where(
+        refinances,
+        fixed_fees[alt_index] + principal * (fee_pct[alt_index] + cancellation_fee_percentage) / 100.0,
+        0.0
+    )
+    payment = np.where(
+        refinances,
+        _annuity_payments(principal, monthly_rate, terms[alt_index]),
+        current.payment
+    )
+
+    # Baseline (no prepayment, no refinancing) goes last so it shares the pass
+    results = evaluate_scenarios(
+        np.append(principal, balance),
+        np.append(rates[alt_index], current.annual_rate),
+        np.append(payment, current.payment),
+        np.append(prepay + fees, 0.0),
+        discount_rate
+    )
+    break_even = [int(month) or None for month in results["break_even"]]
+    baseline_npv = float(results["npv"][-1])
+    baseline_cost = float(results["total_cost"][-1])
+
+    scenarios = [
+        {
+            "option": names[alt_index[i]],
+            "prepayment": round(float(prepay[i]), 2),
+            "refinanced_amount": round(float(principal[i]), 2) if refinances[i] else 0.0,
+            "fees": round(float(fees[i]), 2),
+            "monthly_payment": round(float(results["payment"][i]), 2),
+            "months": int(results["months"][i]),
+            "total_interest": round(float(results["total_interest"][i]), 2),
+            "total_cost": round(float(results["total_cost"][i]), 2),
+            "npv": round(float(results["npv"][i]), 2),
+            "npv_savings": round(baseline_npv - float(results["npv"][i]), 2),
+            "total_savings": round(baseline_cost - float(results["total_cost"][i]), 2),
+            "break_even_month": break_even[i]
+        }
+        for i in range(len(alt_index))
+    ]
+
+    by_option = []
+    for position, name in enumerate(names):
+        rows = scenarios[position * steps:(position + 1) * steps]
+        by_option.append({
+            **rows[0],
+            "annual_rate": float(rates[position]),
+            "term_months": int(terms[position]),
+            "best_mix": max(rows, key=lambda row: row["npv_savings"])
+        })
+
+    return {
+        "baseline": {
+            "balance": round(balance, 2),
+            "annual_rate": current.annual_rate,
+            "monthly_payment": round(current.payment, 2),
+            "months": int(results["months"][-1]),
+            "total_cost": round(baseline_cost, 2),
+            "npv": round(baseline_npv, 2)
+        },
+        "options": by_option,
+        "optimal": max(scenarios, key=lambda row: row["npv_savings"]),
+        "scenarios_evaluated": len(scenarios)
+    }
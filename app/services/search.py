@@ -0,0 +1,448 @@
+# app/services/search.py
+"""
+Full-text search over movements, contracts and documents.
+
+Indexed per owner:
+  - movement: FinancialMovement concept, tenant name and category
+  - contract: RentalContract tenant name, email, phone, DNI, address, job
+  - document: TenantDocument name, type and description
+  - file:     FileStorage documents (name)
+
+The index lives in the database: an FTS5 virtual table on SQLite and a
+table with a weighted tsvector column and a GIN index on PostgreSQL. Each
+entry's rowid packs (ref_id, kind), so replacing or deleting an entry is a
+primary-key operation. Writes to the indexed models update the index in the
+same transaction (after_flush), only when an indexed field changed; the
+whole index is built once when it is first created.
+
+Queries are split into words and every word must match as a prefix
+("biz carl" finds "Bizum Carlos"), accent-insensitively. Results are ranked
+with bm25 (SQLite) or ts_rank_cd (PostgreSQL), title matches weighing more.
+"""
+import re
+import unicodedata
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from sqlalchemy import event, inspect, select, text
+from sqlmodel import Session
+
+from ..models import FinancialMovement, Property, RentalContract, TenantDocument
+from ..models_files import FileStorage
+
+# Tipos de resultado, con su código dentro del rowid
+SEARCH_KINDS: Dict[str, int] = {"movement": 1, "contract": 2, "document": 3, "file": 4}
+_ROWID_STRIDE = 8
+# Palabras de la consulta que se tienen en cuenta
+MAX_QUERY_TERMS = 8
+# Tipos de FileStorage que son documentos (las fotos no se indexan)
+DOCUMENT_FILE_TYPES = ("document", "tenant-document")
+# Filas por lote al reconstruir el índice
+SEARCH_REBUILD_BATCH = 1000
+
+_SESSION_KEY = "search_changes"
+
+
+@dataclass
+class SearchEntry:
+    kind: str
+    ref_id: int
+    owner_id: int
+    title: str
+    body: str
+
+    @property
+    def rowid(self) -> int:
+        return search_rowid(self.kind, self.ref_id)
+
+
+@dataclass
+class SearchHit:
+    kind: str
+    id: int
+    title: str
+    snippet: str
+    score: float
+
+
+def search_rowid(kind: str, ref_id: int) -> int:
+    return ref_id * _ROWID_STRIDE + SEARCH_KINDS[kind]
+
+
+def normalize_text(value: Optional[str]) -> str:
+    """Lowercase without diacritics ("Peña" -> "pena")"""
+    if not value:
+        return ""
+    decomposed = unicodedata.normalize("NFKD", value)
+    return "".join(char for char in decomposed if not unicodedata.combining(char)).lower()
+
+
+def query_terms(query: str) -> List[str]:
+    return re.findall(r"\w+", normalize_text(query))[:MAX_QUERY_TERMS]
+
+
+def _join(*parts: Optional[str]) -> str:
+    return " ".join(part for part in parts if part)
+
+
+# ---------------------------------------------------------------------------
+# Backends
+# ---------------------------------------------------------------------------
+
+class SearchBackend(ABC):
+
+    @abstractmethod
+    def ensure(self, connection) -> bool:
+        """Create the index if missing; True when it was just created"""
+
+    @abstractmethod
+    def upsert(self, connection, entries: Sequence[SearchEntry]) -> None:
+        """Insert or replace entries"""
+
+    @abstractmethod
+    def delete(self, connection, rowids: Iterable[int]) -> None:
+        """Remove entries"""
+
+    @abstractmethod
+    def clear(self, connection) -> None:
+        """Remove every entry"""
+
+    @abstractmethod
+    def search(
+        self, connection, owner_id: int, terms: List[str], kinds: Sequence[str], limit: int, offset: int
+    ) -> List[SearchHit]:
+        """Ranked hits of the owner matching every term as a prefix"""
+
+
+class SqliteSearchBackend(SearchBackend):
+    """FTS5 virtual table; title/body are matched, the rest is stored only"""
+
+    def ensure(self, connection) -> bool:
+        exists = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'search_fts'")
+        ).first()
+        if exists:
+            return False
+        connection.execute(text(
+            "CREATE VIRTUAL TABLE search_fts USING fts5("
+            "title, body, kind UNINDEXED, ref_id UNINDEXED, owner_id UNINDEXED, "
+            "tokenize = 'unicode61 remove_diacritics 2')"
+        ))
+        return True
+
+    def upsert(self, connection, entries: Sequence[SearchEntry]) -> None:
+        if not entries:
+            return
+        self.delete(connection, [entry.rowid for entry in entries])
+        connection.execute(
+            text(
+                "INSERT INTO search_fts (rowid, title, body, kind, ref_id, owner_id) "
+                "VALUES (:rowid, :title, :body, :kind, :ref_id, :owner_id)"
+            ),
+            [{"rowid": entry.rowid, **entry.__dict__} for entry in entries]
+        )
+
+    def delete(self, connection, rowids: Iterable[int]) -> None:
+        rowids = list(rowids)
+        if rowids:
+            connection.execute(text("DELETE FROM search_fts WHERE rowid = :rowid"), [{"rowid": rowid} for rowid in rowids])
+
+    def clear(self, connection) -> None:
+        connection.execute(text("DELETE FROM search_fts"))
+
+    def search(self, connection, owner_id, terms, kinds, limit, offset) -> List[SearchHit]:
+        # Cada término entre comillas (sin sintaxis FTS del usuario) y como prefijo; espacio = AND
+        match = " ".join(f'"{term}"*' for term in terms)
+        kind_filter = " AND kind IN (" + ", ".join(f":kind{i}" for i in range(len(kinds))) + ")"
+        rows = connection.execute(
+            text(
+                "SELECT kind, ref_id, title, snippet(search_fts, -1, '[', ']', '…', 12), "
+                "bm25(search_fts, 10.0, 1.0) AS rank "
+                "FROM search_fts WHERE search_fts MATCH :match AND owner_id = :owner_id"
+                + kind_filter +
+                " ORDER BY rank, rowid LIMIT :limit OFFSET :offset"
+            ),
+            {"match": match, "owner_id": owner_id, "limit": limit, "offset": offset,
+             **{f"kind{i}": kind for i, kind in enumerate(kinds)}}
+        ).all()
+        # bm25 es negativo y menor = mejor; se devuelve positivo y mayor = mejor
+        return [SearchHit(kind, int(ref_id), title, snippet, -rank) for kind, ref_id, title, snippet, rank in rows]
+
+
+class PostgresSearchBackend(SearchBackend):
+    """Table with a weighted tsvector (title A, body B) and a GIN index"""
+
+    # 'simple' no aplica stemming: nombres y conceptos bancarios se buscan tal cual
+    CONFIG = "simple"
+
+    def ensure(self, connection) -> bool:
+        exists = connection.execute(text("SELECT to_regclass('search_document')")).scalar()
+        if exists:
+            return False
+        connection.execute(text(
+            "CREATE TABLE search_document ("
+            "rowid BIGINT PRIMARY KEY, kind VARCHAR(16) NOT NULL, ref_id INTEGER NOT NULL, "
+            "owner_id INTEGER NOT NULL, title TEXT NOT NULL, body TEXT NOT NULL, tsv TSVECTOR NOT NULL)"
+        ))
+        connection.execute(text("CREATE INDEX ix_search_document_tsv ON search_document USING GIN (tsv)"))
+        connection.execute(text("CREATE INDEX ix_search_document_owner ON search_document (owner_id, kind)"))
+        return True
+
+    def upsert(self, connection, entries: Sequence[SearchEntry]) -> None:
+        if not entries:
+            return
+        connection.execute(
+            text(
+                "INSERT INTO search_document (rowid, kind, ref_id, owner_id, title, body, tsv) "
+                "VALUES (:rowid, :kind, :ref_id, :owner_id, :title, :body, "
+                f"setweight(to_tsvector('{self.CONFIG}', :title_norm), 'A') || "
+                f"setweight(to_tsvector('{self.CONFIG}', :body_norm), 'B')) "
+                "ON CONFLICT (rowid) DO UPDATE SET owner_id = EXCLUDED.owner_id, title = EXCLUDED.title, "
+                "body = EXCLUDED.body, tsv = EXCLUDED.tsv"
+            ),
+            [
+                {"rowid": entry.rowid, **entry.__dict__,
+                 "title_norm": normalize_text(entry.title), "body_norm": normalize_text(entry.body)}
+                for entry in entries
+            ]
+        )
+
+    def delete(self, connection, rowids: Iterable[int]) -> None:
+        rowids = list(rowids)
+        if rowids:
+            connection.execute(text("DELETE FROM search_document WHERE rowid = ANY(:rowids)"), {"rowids": rowids})
+
+    def clear(self, connection) -> None:
+        connection.execute(text("TRUNCATE search_document"))
+
+    def search(self, connection, owner_id, terms, kinds, limit, offset) -> List[SearchHit]:
+        # Los términos solo tienen caracteres de palabra: no hace falta escapar la sintaxis de tsquery
+        tsquery = " & ".join(f"{term}:*" for term in terms)
+        rows = connection.execute(
+            text(
+                f"WITH hits AS ("
+                f"  SELECT kind, ref_id, title, body, rowid, ts_rank_cd(tsv, query) AS rank, query"
+                f"  FROM search_document, to_tsquery('{self.CONFIG}', :tsquery) AS query"
+                f"  WHERE owner_id = :owner_id AND kind = ANY(:kinds) AND tsv @@ query"
+                f"  ORDER BY rank DESC, rowid LIMIT :limit OFFSET :offset"
+                f") "
+                # El extracto solo se calcula para la página devuelta
+                f"SELECT kind, ref_id, title, ts_headline('{self.CONFIG}', title || ' ' || body, query, "
+                f"'StartSel=[, StopSel=], MaxWords=20, MinWords=5'), rank FROM hits ORDER BY rank DESC, rowid"
+            ),
+            {"tsquery": tsquery, "owner_id": owner_id, "kinds": list(kinds), "limit": limit, "offset": offset}
+        ).all()
+        return [SearchHit(kind, ref_id, title, snippet, float(rank)) for kind, ref_id, title, snippet, rank in rows]
+
+
+_BACKENDS: Dict[str, SearchBackend] = {
+    "sqlite": SqliteSearchBackend(),
+    "postgresql": PostgresSearchBackend(),
+}
+# Dialectos cuyo índice existe (ensure_search_index); el resto no indexa
+_ready: Set[str] = set()
+
+
+def get_search_backend(connection) -> Optional[SearchBackend]:
+    name = connection.dialect.name
+    return _BACKENDS.get(name) if name in _ready else None
+
+
+# ---------------------------------------------------------------------------
+# Entradas
+# ---------------------------------------------------------------------------
+
+def movement_entry(movement, owner_id: int) -> SearchEntry:
+    return SearchEntry(
+        "movement", movement.id, owner_id, movement.concept or "",
+        _join(movement.tenant_name, movement.category, movement.subcategory)
+    )
+
+
+def contract_entry(contract, owner_id: int) -> SearchEntry:
+    return SearchEntry(
+        "contract", contract.id, owner_id, contract.tenant_name or "",
+        _join(contract.tenant_email, contract.tenant_phone, contract.tenant_dni, contract.tenant_address,
+              contract.job_position, contract.employer_name)
+    )
+
+
+def document_entry(document, owner_id: int) -> SearchEntry:
+    return SearchEntry(
+        "document", document.id, owner_id, document.document_name or "",
+        _join(document.document_type, document.description)
+    )
+
+
+def file_entry(file_record, owner_id: int) -> SearchEntry:
+    return SearchEntry("file", file_record.id, owner_id, file_record.filename or "", file_record.file_type)
+
+
+# modelo -> (tipo, campos indexados o que deciden el propietario)
+_INDEXED: Dict[type, Tuple[str, Tuple[str, ...]]] = {
+    FinancialMovement: ("movement", ("concept", "tenant_name", "category", "subcategory", "user_id")),
+    RentalContract: ("contract", ("tenant_name", "tenant_email", "tenant_phone", "tenant_dni", "tenant_address",
+                                  "job_position", "employer_name", "property_id")),
+    TenantDocument: ("document", ("document_name", "document_type", "description", "rental_contract_id")),
+    FileStorage: ("file", ("filename", "file_type", "user_id")),
+}
+
+
+def _property_owners(connection, property_ids: Set[int]) -> Dict[int, int]:
+    if not property_ids:
+        return {}
+    return dict(connection.execute(
+        select(Property.id, Property.owner_id).where(Property.id.in_(property_ids))
+    ).all())
+
+
+def _contract_owners(connection, contract_ids: Set[int]) -> Dict[int, int]:
+    if not contract_ids:
+        return {}
+    return dict(connection.execute(
+        select(RentalContract.id, Property.owner_id)
+        .join(Property, Property.id == RentalContract.property_id)
+        .where(RentalContract.id.in_(contract_ids))
+    ).all())
+
+
+def entries_for(connection, objects: Sequence) -> Tuple[List[SearchEntry], List[int]]:
+    """Entries of ORM objects (one query per owner lookup), and rowids of those no longer indexed"""
+    property_owners = _property_owners(
+        connection, {obj.property_id for obj in objects if isinstance(obj, RentalContract)}
+    )
+    contract_owners = _contract_owners(
+        connection, {obj.rental_contract_id for obj in objects if isinstance(obj, TenantDocument)}
+    )
+    entries, removed = [], []
+    for obj in objects:
+        if isinstance(obj, FinancialMovement):
+            entries.append(movement_entry(obj, obj.user_id))
+        elif isinstance(obj, RentalContract) and obj.property_id in property_owners:
+            entries.append(contract_entry(obj, property_owners[obj.property_id]))
+        elif isinstance(obj, TenantDocument) and obj.rental_contract_id in contract_owners:
+            entries.append(document_entry(obj, contract_owners[obj.rental_contract_id]))
+        elif isinstance(obj, FileStorage) and obj.file_type in DOCUMENT_FILE_TYPES and obj.user_id is not None:
+            entries.append(file_entry(obj, obj.user_id))
+        else:
+            removed.append(search_rowid(_INDEXED[type(obj)][0], obj.id))
+    return entries, removed
+
+
+# ---------------------------------------------------------------------------
+# Actualización incremental
+# ---------------------------------------------------------------------------
+
+def _collect_changes(session, flush_context, instances) -> None:
+    changes = session.info.setdefault(_SESSION_KEY, {"upsert": [], "delete": []})
+    for obj in session.new:
+        if type(obj) in _INDEXED:
+            changes["upsert"].append(obj)
+    for obj in session.dirty:
+        indexed = _INDEXED.get(type(obj))
+        if indexed is None:
+            continue
+        state = inspect(obj)
+        if any(state.attrs[field].history.has_changes() for field in indexed[1]):
+            changes["upsert"].append(obj)
+    for obj in session.deleted:
+        indexed = _INDEXED.get(type(obj))
+        if indexed is not None and obj.id is not None:
+            changes["delete"].append(search_rowid(indexed[0], obj.id))
+
+
+def _apply_changes(session, flush_context) -> None:
+    changes = session.info.pop(_SESSION_KEY, None)
+    if not changes or not (changes["upsert"] or changes["delete"]):
+        return
+    connection = session.connection()
+    backend = get_search_backend(connection)
+    if backend is None:
+        return
+    entries, removed = entries_for(connection, changes["upsert"])
+    backend.delete(connection, removed + changes["delete"])
+    backend.upsert(connection, entries)
+
+
+event.listen(Session, "before_flush", _collect_changes)
+event.listen(Session, "after_flush", _apply_changes)
+
+
+# ---------------------------------------------------------------------------
+# Construcción y consulta
+# ---------------------------------------------------------------------------
+
+def _batched(connection, statement, build) -> Iterable[List[SearchEntry]]:
+    batch = []
+    for row in connection.execution_options(yield_per=SEARCH_REBUILD_BATCH).execute(statement):
+        batch.append(build(row))
+        if len(batch) >= SEARCH_REBUILD_BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def rebuild_search_index(connection) -> int:
+    """Index every row from scratch; returns the number of entries"""
+    backend = _BACKENDS[connection.dialect.name]
+    backend.clear(connection)
+    # Solo las columnas indexadas, leídas por lotes
+    sources = [
+        (
+            select(FinancialMovement.id, FinancialMovement.user_id, FinancialMovement.concept,
+                   FinancialMovement.tenant_name, FinancialMovement.category, FinancialMovement.subcategory),
+            lambda row: movement_entry(row, row.user_id)
+        ),
+        (
+            select(RentalContract.id, Property.owner_id, RentalContract.tenant_name, RentalContract.tenant_email,
+                   RentalContract.tenant_phone, RentalContract.tenant_dni, RentalContract.tenant_address,
+                   RentalContract.job_position, RentalContract.employer_name)
+            .join(Property, Property.id == RentalContract.property_id),
+            lambda row: contract_entry(row, row.owner_id)
+        ),
+        (
+            select(TenantDocument.id, Property.owner_id, TenantDocument.document_name,
+                   TenantDocument.document_type, TenantDocument.description)
+            .join(RentalContract, RentalContract.id == TenantDocument.rental_contract_id)
+            .join(Property, Property.id == RentalContract.property_id),
+            lambda row: document_entry(row, row.owner_id)
+        ),
+        (
+            select(FileStorage.id, FileStorage.user_id, FileStorage.filename, FileStorage.file_type)
+            .where(FileStorage.file_type.in_(DOCUMENT_FILE_TYPES))
+            .where(FileStorage.user_id.is_not(None)),
+            lambda row: file_entry(row, row.user_id)
+        ),
+    ]
+    total = 0
+    for statement, build in sources:
+        for batch in _batched(connection, statement, build):
+            backend.upsert(connection, batch)
+            total += len(batch)
+    return total
+
+
+def ensure_search_index(engine) -> None:
+    """Create the index (building it from the existing rows) if this database has none"""
+    dialect = engine.dialect.name
+    backend = _BACKENDS.get(dialect)
+    if backend is None:
+        return
+    with engine.begin() as connection:
+        if backend.ensure(connection):
+            rebuild_search_index(connection)
+    _ready.add(dialect)
+
+
+def search(session: Session, owner_id: int, query: str, kinds: Optional[Sequence[str]] = None,
+           limit: int = 20, offset: int = 0) -> List[SearchHit]:
+    terms = query_terms(query)
+    if not terms:
+        return []
+    connection = session.connection()
+    backend = get_search_backend(connection)
+    if backend is None:
+        return []
+    return backend.search(connection, owner_id, terms, list(kinds or SEARCH_KINDS), limit, offset)
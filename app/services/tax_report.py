@@ -0,0 +1,286 @@
+# app/services/tax_report.py
+"""
+Aggregates behind the tax assistant endpoints.
+
+Movements for the caller's properties are summed in a single grouped
+query and contracts read in another one; expense concepts go through a
+precompiled keyword matcher that is memoised per distinct concept.
+"""
+import re
+from collections import defaultdict
+from datetime import date
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import case, func
+from sqlmodel import Session, select
+
+from ..models import Property, FinancialMovement, RentalContract
+
+# Cubos de gasto deducible, en el orden en que se presentan
+DEDUCTION_BUCKETS = ("IBI", "Comunidad", "Seguros", "Reparaciones", "Hipoteca", "Gestión", "Suministros", "Otros")
+
+# Palabras clave por cubo, en orden de prioridad (la primera que aparezca en el concepto gana)
+CONCEPT_KEYWORDS = (
+    ("IBI", ("IBI",)),
+    ("Comunidad", ("COMUNIDAD",)),
+    ("Seguros", ("SEGURO",)),
+    ("Reparaciones", ("REPARACION", "MANTENIMIENTO")),
+    ("Hipoteca", ("HIPOTECA", "INTERES")),
+    ("Gestión", ("GESTION", "ADMINISTRACION")),
+    ("Suministros", ("LUZ", "AGUA", "GAS", "INTERNET")),
+)
+
+_KEYWORD_PRIORITY = {
+    keyword: priority
+    for priority, (_, keywords) in enumerate(CONCEPT_KEYWORDS)
+    for keyword in keywords
+}
+# Zero-width lookahead so overlapping keywords are all seen in one scan;
+# alternatives go in priority order so ties at the same position resolve the same way
+_CONCEPT_PATTERN = re.compile(
+    "(?=(" + "|".join(re.escape(k) for k in sorted(_KEYWORD_PRIORITY, key=_KEYWORD_PRIORITY.get)) + "))"
+)
+
+CONCEPT_CACHE_SIZE = 4096
+
+# Partidas de mayor importe guardadas por categoría de deducción
+DEDUCTION_ITEMS_PREVIEW = 5
+
+# Filas que se traen de la base de datos por lote al exportar partidas
+EXPORT_BATCH_SIZE = 500
+
+
+@lru_cache(maxsize=CONCEPT_CACHE_SIZE)
+def classify_concept(concept: Optional[str]) -> str:
+    """Deduction bucket for a movement concept ("Otros" when no keyword matches)"""
+    if not concept:
+        return "Otros"
+    priorities = [_KEYWORD_PRIORITY[match] for match in _CONCEPT_PATTERN.findall(concept.upper())]
+    return CONCEPT_KEYWORDS[min(priorities)][0] if priorities else "Otros"
+
+
+def deduction_bucket(subcategory: Optional[str], category: str, concept: Optional[str]) -> str:
+    """Bucket for an expense: its (sub)category if it is one, otherwise by concept"""
+    label = subcategory or category
+    if label in DEDUCTION_BUCKETS:
+        return label
+    return classify_concept(concept)
+
+
+def building_amortization(purchase_price: Optional[float]) -> float:
+    """3% anual sobre el valor de construcción (70% del precio de compra)"""
+    if not purchase_price:
+        return 0
+    return purchase_price * 0.7 * 0.03
+
+
+def months_rented_by_property(
+    session: Session,
+    property_ids: Iterable[int],
+    year: int
+) -> Dict[int, int]:
+    """Months each property was rented in `year`, from a single contract query"""
+    property_ids = list(property_ids)
+    start_year = date(year, 1, 1)
+    end_year = date(year, 12, 31)
+    total_days: Dict[int, int] = defaultdict(int)
+
+    if property_ids:
+        contracts = session.exec(
+            select(RentalContract.property_id, RentalContract.start_date, RentalContract.end_date)
+            .where(RentalContract.property_id.in_(property_ids))
+            .where(RentalContract.start_date <= end_year)
+        ).all()
+        for property_id, start_date, end_date in contracts:
+            # Solape del contrato con el año
+            contract_start = max(start_date, start_year)
+            contract_end = min(end_date or end_year, end_year)
+            if contract_start <= contract_end:
+                total_days[property_id] += (contract_end - contract_start).days + 1
+
+    return {pid: min(12, total_days[pid] // 30) for pid in property_ids}
+
+
+def _expense_label():
+    """SQL equivalent of `movement.subcategory or movement.category`"""
+    return func.coalesce(func.nullif(FinancialMovement.subcategory, ""), FinancialMovement.category)
+
+
+def _year_expenses(property_ids, year: int):
+    """Filter for the year's expenses of the given properties (list or subquery)"""
+    return (
+        FinancialMovement.property_id.in_(property_ids),
+        FinancialMovement.date >= date(year, 1, 1),
+        FinancialMovement.date <= date(year, 12, 31),
+        FinancialMovement.amount < 0
+    )
+
+
+def top_deduction_items(session: Session, property_ids, year: int, limit: int) -> Dict[str, List[Dict]]:
+    """
+    The `limit` largest expenses of each deduction category, ranked in SQL
+    with ROW_NUMBER() so only those rows leave the database.
+    """
+    if limit <= 0:
+        return {}
+
+    ranked = (
+        select(
+            _expense_label().label("label"),
+            FinancialMovement.property_id,
+            FinancialMovement.date,
+            FinancialMovement.concept,
+            FinancialMovement.amount,
+            func.row_number().over(
+                partition_by=_expense_label(),
+                order_by=(FinancialMovement.amount, FinancialMovement.date, FinancialMovement.id)
+            ).label("position")
+        )
+        .where(*_year_expenses(property_ids, year))
+        .subquery()
+    )
+    rows = session.exec(
+        select(ranked.c.label, Property.address, ranked.c.date, ranked.c.concept, ranked.c.amount)
+        .join(Property, Property.id == ranked.c.property_id)
+        .where(ranked.c.position <= limit)
+        .order_by(ranked.c.label, ranked.c.position)
+    ).all()
+
+    items: Dict[str, List[Dict]] = defaultdict(list)
+    for category, address, movement_date, concept, amount in rows:
+        items[category].append({
+            "property_address": address,
+            "date": movement_date.isoformat(),
+            "concept": concept,
+            "amount": abs(amount)
+        })
+    return items
+
+
+def iter_deduction_items(
+    session: Session,
+    property_ids,
+    year: int,
+    category: Optional[str] = None
+) -> Iterator[Tuple]:
+    """
+    Every expense of the year as (date, address, category, bucket, concept, amount),
+    fetched in batches so the full list is never held in memory.
+    """
+    label = _expense_label()
+    statement = (
+        select(
+            FinancialMovement.date,
+            Property.address,
+            label,
+            FinancialMovement.category,
+            FinancialMovement.subcategory,
+            FinancialMovement.concept,
+            FinancialMovement.amount
+        )
+        .join(Property, Property.id == FinancialMovement.property_id)
+        .where(*_year_expenses(property_ids, year))
+        .order_by(FinancialMovement.date, FinancialMovement.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    if category:
+        statement = statement.where(label == category)
+
+    for movement_date, address, expense_label, raw_category, subcategory, concept, amount in session.exec(statement):
+        yield (
+            movement_date,
+            address,
+            expense_label,
+            deduction_bucket(subcategory, raw_category, concept),
+            concept,
+            abs(amount)
+        )
+
+
+def build_tax_year(session: Session, properties: List[Property], year: int) -> Dict:
+    """
+    Every aggregate the tax endpoints need for one year from a single grouped
+    query: per-property report, yearly totals, quarterly income/expenses and
+    expenses by category with their largest items.
+
+    Movements are summed in SQL per (property, month, category, subcategory,
+    concept); the concept classifier then runs once per group, not per row.
+    """
+    property_ids = [prop.id for prop in properties]
+    groups = []
+    if property_ids:
+        month = func.extract("month", FinancialMovement.date)
+        is_income = (FinancialMovement.category == "Renta") & (FinancialMovement.amount > 0)
+        groups = session.exec(
+            select(
+                FinancialMovement.property_id,
+                month,
+                FinancialMovement.category,
+                FinancialMovement.subcategory,
+                FinancialMovement.concept,
+                func.sum(case((is_income, FinancialMovement.amount), else_=0)),
+                func.sum(case((FinancialMovement.amount < 0, -FinancialMovement.amount), else_=0))
+            )
+            .where(FinancialMovement.property_id.in_(property_ids))
+            .where(FinancialMovement.date >= date(year, 1, 1))
+            .where(FinancialMovement.date <= date(year, 12, 31))
+            .group_by(
+                FinancialMovement.property_id,
+                month,
+                FinancialMovement.category,
+                FinancialMovement.subcategory,
+                FinancialMovement.concept
+            )
+        ).all()
+
+    rental_income: Dict[int, float] = defaultdict(int)
+    expenses: Dict[int, Dict[str, float]] = {pid: dict.fromkeys(DEDUCTION_BUCKETS, 0) for pid in property_ids}
+    quarters = [{"income": 0, "expenses": 0} for _ in range(4)]
+    categories: Dict[str, Dict] = {}
+
+    for property_id, month_number, category, subcategory, concept, income, expense in groups:
+        quarter = quarters[(int(month_number) - 1) // 3]
+        if income:
+            rental_income[property_id] += income
+            quarter["income"] += income
+        if expense:  # Gastos del grupo
+            expenses[property_id][deduction_bucket(subcategory, category, concept)] += expense
+            quarter["expenses"] += expense
+
+            label = subcategory or category
+            entry = categories.setdefault(label, {"category": label, "total": 0, "items": []})
+            entry["total"] += expense
+
+    # Solo las partidas mayores de cada categoría, ya ordenadas por SQL
+    if categories:
+        for label, items in top_deduction_items(session, property_ids, year, DEDUCTION_ITEMS_PREVIEW).items():
+            if label in categories:
+                categories[label]["items"] = items
+
+    months_rented = months_rented_by_property(session, property_ids, year)
+
+    reports = []
+    for prop in properties:
+        deductible_expenses = expenses[prop.id]
+        total_expenses = sum(deductible_expenses.values())
+        amortization = building_amortization(prop.purchase_price)
+        reports.append({
+            "property_id": prop.id,
+            "address": prop.address,
+            "rental_income": rental_income[prop.id],
+            "deductible_expenses": deductible_expenses,
+            "total_expenses": total_expenses,
+            "amortization": amortization,
+            "taxable_income": rental_income[prop.id] - total_expenses - amortization,
+            "months_rented": months_rented[prop.id]
+        })
+
+    return {
+        "year": year,
+        "properties": reports,
+        "rental_income": sum(report["rental_income"] for report in reports),
+        "expenses": sum(report["total_expenses"] for report in reports),
+        "quarters": quarters,
+        "deductions": list(categories.values())
+    }
@@ -0,0 +1,202 @@
+# app/services/tax_snapshot.py
+"""
+Persisted per-(user, year) tax aggregates.
+
+The four yearly tax endpoints read a TaxYearSnapshot instead of rescanning
+movements. Writes to movements, contracts or properties mark the affected
+(user, year) snapshots stale, and the next read recomputes only that year.
+Closed fiscal years (past the filing deadline) are no different: they
+rarely change, but a back-dated import or correction into one invalidates
+its snapshot like any other.
+
+Invalidation hangs on ORM events: the flush (session.add/delete) and
+ORM-enabled bulk statements run through `session.execute` (insert, update
+or delete of FinancialMovement). Core statements executed on a Connection
+bypass both: any bulk SQL that writes movements must call
+`invalidate_tax_years` in the same transaction.
+"""
+import json
+from datetime import date, datetime, timezone
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from sqlalchemy import event, extract, inspect, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+
+from ..models import Property, FinancialMovement, RentalContract, TaxYearSnapshot
+from .tax_report import build_tax_year
+
+# Campos de un movimiento que alteran los agregados fiscales
+MOVEMENT_TAX_FIELDS = ("user_id", "property_id", "date", "amount", "category", "subcategory", "concept")
+CONTRACT_TAX_FIELDS = ("property_id", "start_date", "end_date")
+PROPERTY_TAX_FIELDS = ("owner_id", "address", "purchase_price")
+
+_PENDING_KEY = "tax_snapshot_invalidations"
+
+# ("user", user_id, year) | ("property", property_id, first_year) | ("owner", owner_id, None) | ("all", 0, None)
+Invalidation = Tuple[str, int, Optional[int]]
+
+
+def is_closed_year(year: int, today: Optional[date] = None) -> bool:
+    """A fiscal year is closed once its income tax filing deadline (30/06 of the next year) has passed"""
+    return (today or date.today()) > date(year + 1, 6, 30)
+
+
+def _values(obj, field: str) -> list:
+    """Current and previous values of an attribute in this flush"""
+    history = inspect(obj).attrs[field].history
+    values = [*history.added, *history.unchanged, *history.deleted]
+    if not values:
+        # Expired attribute (e.g. object deleted after a commit): load it
+        values = [getattr(obj, field)]
+    return [value for value in values if value is not None]
+
+
+def _changed(obj, fields) -> bool:
+    state = inspect(obj)
+    return any(state.attrs[field].history.has_changes() for field in fields)
+
+
+def _collect_invalidations(session, flush_context, instances) -> None:
+    pending: Set[Invalidation] = session.info.setdefault(_PENDING_KEY, set())
+    dirty = [obj for obj in session.dirty if session.is_modified(obj)]
+
+    for obj in (*session.new, *dirty, *session.deleted):
+        is_dirty = obj not in session.new and obj not in session.deleted
+        if isinstance(obj, FinancialMovement):
+            if is_dirty and not _changed(obj, MOVEMENT_TAX_FIELDS):
+                continue
+            for user_id in _values(obj, "user_id"):
+                for movement_date in _values(obj, "date"):
+                    pending.add(("user", user_id, movement_date.year))
+        elif isinstance(obj, RentalContract):
+            if is_dirty and not _changed(obj, CONTRACT_TAX_FIELDS):
+                continue
+            starts = _values(obj, "start_date")
+            first_year = min(start.year for start in starts) if starts else None
+            for property_id in _values(obj, "property_id"):
+                pending.add(("property", property_id, first_year))
+        elif isinstance(obj, Property):
+            if is_dirty and not _changed(obj, PROPERTY_TAX_FIELDS):
+                continue
+            for owner_id in _values(obj, "owner_id"):
+                pending.add(("owner", owner_id, None))
+
+
+def _invalidation_statement(kind: str, key: int, year: Optional[int]):
+    table = TaxYearSnapshot.__table__
+    statement = update(table).where(table.c.is_stale == False).values(is_stale=True)
+    if kind == "user":
+        return statement.where(table.c.user_id == key, table.c.year == year)
+    if kind == "property":
+        owner = select(Property.owner_id).where(Property.id == key).scalar_subquery()
+        statement = statement.where(table.c.user_id == owner)
+        if year is not None:
+            statement = statement.where(table.c.year >= year)
+        return statement
+    if kind == "owner":
+        return statement.where(table.c.user_id == key)
+    return statement
+
+
+def _apply_pending(connection, pending: Iterable[Invalidation]) -> None:
+    for kind, key, year in pending:
+        connection.execute(_invalidation_statement(kind, key, year))
+
+
+def invalidate_tax_years(connection, user_id: int, years: Optional[Iterable[int]] = None) -> None:
+    """
+    Mark the snapshots of `user_id` stale for `years` (every year when None),
+    closed years included. Call it from any Core/bulk SQL that writes
+    movements outside the ORM.
+    """
+    if years is None:
+        _apply_pending(connection, [("owner", user_id, None)])
+    else:
+        _apply_pending(connection, [("user", user_id, year) for year in set(years)])
+
+
+def _apply_invalidations(session, flush_context) -> None:
+    pending: Set[Invalidation] = session.info.pop(_PENDING_KEY, set())
+    if pending:
+        _apply_pending(session.connection(), pending)
+
+
+def _invalidate_bulk_statement(orm_execute_state) -> None:
+    """ORM-enabled insert/update/delete of movements through session.execute (no flush involved)"""
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or mapper.class_ is not FinancialMovement:
+        return
+    connection = orm_execute_state.session.connection()
+    parameters = orm_execute_state.parameters
+    rows = parameters if isinstance(parameters, list) else [parameters] if parameters else []
+
+    if orm_execute_state.is_insert:
+        # insert(...).values(...) lleva los valores en la sentencia, no en los parámetros
+        rows = rows or [orm_execute_state.statement.compile().params]
+        pending = {
+            ("user", row["user_id"], row["date"].year)
+            for row in rows if row.get("user_id") is not None and isinstance(row.get("date"), date)
+        }
+        # Sin valores legibles (p.ej. insert ... from select) no se sabe qué años cambian: todos
+        _apply_pending(connection, pending or [("all", 0, None)])
+        return
+
+    statement = orm_execute_state.statement
+    affected = select(FinancialMovement.user_id, extract("year", FinancialMovement.date)).distinct()
+    if rows and all("id" in row for row in rows):
+        # Actualización masiva por clave primaria (lista de dicts)
+        affected = affected.where(FinancialMovement.id.in_([row["id"] for row in rows]))
+    elif statement.whereclause is not None:
+        affected = affected.where(statement.whereclause)
+    pairs = connection.execute(affected).all()
+    if orm_execute_state.is_delete:
+        _apply_pending(connection, {("user", user_id, int(year)) for user_id, year in pairs if user_id is not None})
+    else:
+        # Un update puede mover fecha o usuario: todos los años de los usuarios afectados
+        _apply_pending(connection, {("owner", user_id, None) for user_id, _ in pairs if user_id is not None})
+
+
+event.listen(Session, "before_flush", _collect_invalidations)
+event.listen(Session, "after_flush", _apply_invalidations)
+event.listen(Session, "do_orm_execute", _invalidate_bulk_statement)
+
+
+def get_tax_year(session: Session, user_id: int, year: int, refresh: bool = False) -> Dict:
+    """Aggregates for (user, year), from the snapshot or recomputed if missing/stale"""
+    snapshot = session.exec(
+        select(TaxYearSnapshot)
+        .where(TaxYearSnapshot.user_id == user_id)
+        .where(TaxYearSnapshot.year == year)
+    ).first()
+    closed = is_closed_year(year)
+
+    if snapshot and not refresh and not snapshot.is_stale:
+        if closed and not snapshot.is_closed:
+            # Primer acceso tras el cierre del ejercicio
+            snapshot.is_closed = True
+            session.add(snapshot)
+            session.commit()
+            session.refresh(snapshot)
+        return json.loads(snapshot.data)
+
+    properties = session.exec(
+        select(Property).where(Property.owner_id == user_id).order_by(Property.id)
+    ).all()
+    data = build_tax_year(session, properties, year)
+
+    if snapshot is None:
+        snapshot = TaxYearSnapshot(user_id=user_id, year=year, data="")
+    snapshot.data = json.dumps(data)
+    snapshot.is_closed = closed
+    snapshot.is_stale = False
+    snapshot.computed_at = datetime.now(timezone.utc)
+    session.add(snapshot)
+    try:
+        session.commit()
+    except IntegrityError:
+        # Another request stored the same (user, year) first; its data is equivalent
+        session.rollback()
+    return data
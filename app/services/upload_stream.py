@@ -0,0 +1,86 @@
+# app/services/upload_stream.py
+"""
+Streaming reception of uploaded files.
+
+Endpoints used to `await file.read()` the whole body, check the size and
+then write it out, holding every upload (sometimes twice) in memory. Here
+the upload is copied in fixed-size chunks to a temporary file while its
+SHA-256 is computed, and the copy stops with a 400 as soon as the size
+limit is passed. The caller then moves the temporary file atomically to its
+final place (a path on disk or the blob store), so memory per upload stays
+at one chunk whatever the file size.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Optional
+
+from fastapi import HTTPException, UploadFile
+from starlette.concurrency import run_in_threadpool
+
+# Tamaño de cada lectura del cuerpo subido
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+@dataclass
+class SpooledUpload:
+    """A received upload in a temporary file; removed on exit unless moved"""
+    path: Path
+    size: int
+    sha256: str
+
+    def move_to(self, target: Path) -> Path:
+        """Atomically place the file at `target` (a reader never sees it half written)"""
+        target = Path(target)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.replace(self.path, target)
+        except OSError:
+            # Distinto sistema de ficheros: copiar junto al destino y renombrar
+            fd, temp_path = tempfile.mkstemp(dir=target.parent, prefix=".upload-")
+            os.close(fd)
+            try:
+                shutil.copyfile(self.path, temp_path)
+                os.replace(temp_path, target)
+            finally:
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+            os.unlink(self.path)
+        return target
+
+    def discard(self) -> None:
+        if self.path.exists():
+            self.path.unlink()
+
+    def __enter__(self) -> "SpooledUpload":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.discard()
+
+
+def spool_upload(source: BinaryIO, max_size: int, too_large_detail: str, temp_dir: Optional[str] = None) -> SpooledUpload:
+    """Copy `source` to a temporary file, hashing it; HTTP 400 once it exceeds `max_size` bytes"""
+    digest = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(prefix="upload-", dir=temp_dir)
+    try:
+        with os.fdopen(fd, "wb") as target:
+            for chunk in iter(lambda: source.read(UPLOAD_CHUNK_SIZE), b""):
+                size += len(chunk)
+                if size > max_size:
+                    raise HTTPException(status_code=400, detail=too_large_detail)
+                digest.update(chunk)
+                target.write(chunk)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return SpooledUpload(Path(temp_path), size, digest.hexdigest())
+
+
+async def receive_upload(file: UploadFile, max_size: int, too_large_detail: str) -> SpooledUpload:
+    """`spool_upload` for async endpoints, run off the event loop"""
+    return await run_in_threadpool(spool_upload, file.file, max_size, too_large_detail)
@@ -0,0 +1,68 @@
+# app/services/upsert.py
+"""
+Insert-or-update against a unique key, safe under concurrent writers.
+
+Select-then-insert loses when two transactions write the same key at once:
+both miss the row, both insert and the second one fails on the unique
+constraint, taking its whole transaction down. SQLite and PostgreSQL settle
+it in one statement with INSERT ... ON CONFLICT; other backends insert
+inside a SAVEPOINT and fall back to the update when the key is taken.
+"""
+from typing import Dict, Optional, Sequence
+
+from sqlalchemy import Table, and_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+_DIALECT_INSERTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+
+
+def _key_clause(table: Table, values: Dict, key: Sequence[str]):
+    return and_(*(table.c[column] == values[column] for column in key))
+
+
+def upsert(
+    connection, table: Table, values: Dict, key: Sequence[str], set_: Dict,
+    where=None, returning: Sequence = ()
+) -> Optional[tuple]:
+    """
+    Insert `values`, or apply `set_` to the row that already holds the same
+    `key` columns (a unique constraint), only where `where` holds. `set_` and
+    `where` may refer to the existing row (`table.c.total + amount`).
+    Returns the `returning` columns of the row written, None when nothing was.
+    """
+    dialect_insert = _DIALECT_INSERTS.get(connection.dialect.name)
+    if dialect_insert is not None:
+        statement = dialect_insert(table).values(**values).on_conflict_do_update(
+            index_elements=list(key), set_=set_, where=where
+        )
+        if returning:
+            return connection.execute(statement.returning(*returning)).first()
+        connection.execute(statement)
+        return None
+
+    try:
+        with connection.begin_nested():
+            connection.execute(table.insert().values(**values))
+    except IntegrityError:
+        statement = update(table).where(_key_clause(table, values, key)).values(**set_)
+        if where is not None:
+            statement = statement.where(where)
+        connection.execute(statement)
+    if returning:
+        return connection.execute(select(*returning).where(_key_clause(table, values, key))).first()
+    return None
+
+
+def insert_if_absent(connection, table: Table, values: Dict, key: Sequence[str]) -> bool:
+    """Insert `values` unless a row with the same `key` exists; True if this call inserted it"""
+    dialect_insert = _DIALECT_INSERTS.get(connection.dialect.name)
+    if dialect_insert is not None:
+        statement = dialect_insert(table).values(**values).on_conflict_do_nothing(index_elements=list(key))
+        return connection.execute(statement).rowcount == 1
+    try:
+        with connection.begin_nested():
+            connection.execute(table.insert().values(**values))
+    except IntegrityError:
+        return False
+    return True
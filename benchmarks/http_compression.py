@@ -0,0 +1,163 @@
+# benchmarks/http_compression.py
+"""
+Wire bytes and latency of the heaviest JSON endpoints, uncompressed vs gzip/Brotli.
+
+Seeds a throwaway SQLite database with a few properties, years of movements
+and a mortgage, then calls each endpoint in-process with
+`Accept-Encoding: identity` (before) and with gzip and br (after). Latency is
+server time including compression; `transfer` adds the time those bytes take
+at --mbps, which is where compression pays off on real links.
+
+    python -m benchmarks.http_compression [--movements 20000] [--repeat 7] [--mbps 20]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date
+
+from dateutil.relativedelta import relativedelta
+
+CATEGORIES = [
+    ("Renta", "Alquiler", 650.0),
+    ("Gasto", "Comunidad", -85.0),
+    ("Gasto", "IBI", -420.0),
+    ("Gasto", "Seguros", -210.0),
+    ("Gasto", "Suministros", -60.0),
+    ("Gasto", "Reparaciones", -150.0),
+]
+
+
+def seed(engine, user_id: int, movements: int, rng: random.Random) -> dict:
+    from sqlmodel import Session
+
+    from app.models import EuriborRate, FinancialMovement, MortgageDetails, MortgageRevision, Property
+
+    with Session(engine) as session:
+        properties = [
+            Property(owner_id=user_id, address=f"Calle Mayor {n}, Madrid", purchase_price=rng.uniform(120_000, 400_000))
+            for n in range(1, 6)
+        ]
+        session.add_all(properties)
+        session.commit()
+        property_ids = [p.id for p in properties]
+
+        start = date(2015, 1, 1)
+        for n in range(movements):
+            category, subcategory, amount = rng.choice(CATEGORIES)
+            session.add(FinancialMovement(
+                property_id=rng.choice(property_ids),
+                user_id=user_id,
+                date=start + relativedelta(days=n * 3650 // movements),
+                concept=f"{subcategory} {rng.randint(1, 12):02d}/{rng.randint(2015, 2025)}",
+                amount=round(amount * rng.uniform(0.8, 1.2), 2),
+                category=category,
+                subcategory=subcategory,
+                is_classified=True
+            ))
+        mortgage = MortgageDetails(
+            property_id=property_ids[0],
+            mortgage_type="Variable",
+            initial_amount=250_000,
+            outstanding_balance=200_000,
+            margin_percentage=0.9,
+            start_date=date(2010, 1, 1),
+            end_date=date(2045, 1, 1),
+            review_period_months=12
+        )
+        session.add(mortgage)
+        session.commit()
+        for year in range(2010, 2045):
+            session.add(MortgageRevision(
+                mortgage_id=mortgage.id,
+                effective_date=date(year, 1, 1),
+                euribor_rate=rng.uniform(-0.5, 4.0),
+                margin_rate=0.9,
+                period_months=12
+            ))
+        for month in range(240):
+            session.add(EuriborRate(date=date(2005, 1, 1) + relativedelta(months=month), rate_12m=rng.uniform(-0.5, 4.0)))
+        session.commit()
+        return {"property_id": property_ids[0], "mortgage_id": mortgage.id}
+
+
+def measure(client, url: str, headers: dict, encoding: str, repeat: int):
+    """(wire bytes, median latency in seconds)"""
+    request_headers = {**headers, "Accept-Encoding": encoding}
+    timings = []
+    wire = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        with client.stream("GET", url, headers=request_headers) as response:
+            wire = sum(len(chunk) for chunk in response.iter_raw())
+        timings.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            raise SystemExit(f"{url}: HTTP {response.status_code}")
+    return wire, statistics.median(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--movements", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--mbps", type=float, default=20.0, help="link speed for the transfer estimate")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    # Base de datos desechable: la app lee la configuración al importarse
+    data_dir = tempfile.mkdtemp(prefix="bench-compression-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{data_dir}/bench.db"
+    os.environ["APP_DATA_DIR"] = data_dir
+    from fastapi.testclient import TestClient
+    from sqlmodel import Session
+
+    from app.auth import create_access_token
+    from app.compression import brotli
+    from app.db import engine, init_db
+    from app.main import app
+    from app.models import User
+
+    init_db()
+    with Session(engine) as session:
+        user = User(email="bench@example.com", hashed_password="x")
+        session.add(user)
+        session.commit()
+        user_id = user.id
+    ids = seed(engine, user_id, args.movements, random.Random(args.seed))
+    headers = {"Authorization": f"Bearer {create_access_token(str(user_id))}"}
+
+    endpoints = [
+        "/financial-movements/",
+        "/financial-movements/?format=columnar",
+        f"/mortgage-details/{ids['mortgage_id']}/calculate-schedule",
+        f"/mortgage-details/{ids['mortgage_id']}/calculate-schedule?format=columnar",
+        "/euribor-rates/",
+        "/analytics/portfolio-summary?year=2024",
+        "/tax-assistant/deduction-analysis/2024/items?format=ndjson",
+    ]
+    encodings = ["identity", "gzip"] + (["br"] if brotli is not None else [])
+    if brotli is None:
+        print("brotli not installed: measuring gzip only", file=sys.stderr)
+    bytes_per_second = args.mbps * 1e6 / 8
+
+    print(f"{args.movements} movements, median of {args.repeat}, transfer at {args.mbps:g} Mbit/s\n")
+    print(f"{'endpoint':<60} {'enc':<8} {'bytes':>10} {'ratio':>6} {'server':>9} {'+transfer':>10}")
+    with TestClient(app) as client:
+        for url in endpoints:
+            baseline = None
+            for encoding in encodings:
+                wire, latency = measure(client, url, headers, encoding, args.repeat)
+                baseline = baseline or wire
+                total = latency + wire / bytes_per_second
+                print(
+                    f"{url[:60]:<60} {encoding:<8} {wire:>10,} {baseline / wire:>5.1f}x "
+                    f"{latency * 1e3:>7.1f}ms {total * 1e3:>8.1f}ms"
+                )
+            print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+# benchmarks/mortgage_engine.py
+"""
+Micro-benchmark for the unified mortgage engine.
+
+Compares a month-by-month reference loop (what the routers used to do)
+against the segment plan: full schedule rows, closed-form summary with a
+cold cache, and the same summary served from the plan cache.
+
+    python -m benchmarks.mortgage_engine [--mortgages 200] [--repeat 5]
+"""
+import argparse
+import random
+import time
+from datetime import date
+
+from dateutil.relativedelta import relativedelta
+
+from app.models import MortgageDetails, MortgagePrepayment, MortgageRevision
+from app.services.mortgage_calculator import (
+    REDUCE_PAYMENT, REDUCE_TERM, MortgageCalculator, clear_plan_cache, plan_cache_info
+)
+
+
+def make_mortgage(rng: random.Random):
+    """Unsaved mortgage with yearly revisions and a couple of prepayments"""
+    start = date(rng.randint(2005, 2022), rng.randint(1, 12), 1)
+    years = rng.randint(15, 35)
+    amount = rng.uniform(80_000, 400_000)
+    mortgage = MortgageDetails(
+        property_id=0,
+        mortgage_type="Variable",
+        initial_amount=amount,
+        outstanding_balance=amount,
+        margin_percentage=rng.uniform(0.5, 1.5),
+        start_date=start,
+        end_date=start + relativedelta(years=years),
+        review_period_months=12
+    )
+    revisions = [
+        MortgageRevision(
+            mortgage_id=0,
+            effective_date=start + relativedelta(years=y),
+            euribor_rate=rng.uniform(-0.5, 4.0),
+            margin_rate=mortgage.margin_percentage,
+            period_months=12
+        )
+        for y in range(years)
+    ]
+    prepayments = [
+        MortgagePrepayment(
+            mortgage_id=0,
+            payment_date=start + relativedelta(months=rng.randint(12, years * 12 - 12)),
+            amount=rng.uniform(1_000, 20_000)
+        )
+        for _ in range(rng.randint(0, 3))
+    ]
+    return mortgage, revisions, prepayments
+
+
+def reference_loop(mortgage, revisions, prepayments) -> float:
+    """Month-by-month recurrence with per-month revision/prepayment lookups"""
+    balance = mortgage.initial_amount
+    current = mortgage.start_date
+    total_interest = 0.0
+    while current < mortgage.end_date and balance > 0.01:
+        rate = mortgage.margin_percentage
+        for revision in revisions:
+            if revision.effective_date <= current:
+                rate = (revision.euribor_rate or 0) + (revision.margin_rate or 0)
+        remaining = (mortgage.end_date.year - current.year) * 12 + mortgage.end_date.month - current.month
+        monthly_rate = rate / 100 / 12
+        if monthly_rate == 0:
+            payment = balance / max(remaining, 1)
+        else:
+            payment = balance * monthly_rate / (1 - (1 + monthly_rate) ** -max(remaining, 1))
+        interest = balance * monthly_rate
+        balance -= payment - interest
+        for prepayment in prepayments:
+            if (prepayment.payment_date.year, prepayment.payment_date.month) == (current.year, current.month):
+                balance -= prepayment.amount
+        total_interest += interest
+        current += relativedelta(months=1)
+    return total_interest
+
+
+def timed(label: str, fn, loans, repeat: int) -> None:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for loan in loans:
+            fn(*loan)
+        best = min(best, time.perf_counter() - started)
+    per_loan = best / len(loans) * 1e6
+    print(f"{label:<34} {best * 1e3:9.2f} ms   {per_loan:9.1f} us/mortgage")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--mortgages", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    loans = [make_mortgage(rng) for _ in range(args.mortgages)]
+    print(f"{args.mortgages} mortgages, best of {args.repeat}\n")
+
+    timed("reference month loop", reference_loop, loans, args.repeat)
+
+    def rows(m, r, p):
+        clear_plan_cache()
+        MortgageCalculator.generate_amortization_schedule(m, r, p)
+
+    def summary_cold(m, r, p):
+        clear_plan_cache()
+        MortgageCalculator.calculate_mortgage_summary(m, r, p)
+
+    def summary_reduce_term(m, r, p):
+        clear_plan_cache()
+        MortgageCalculator.calculate_mortgage_summary(m, r, p, REDUCE_TERM)
+
+    timed("engine: full schedule rows", rows, loans, args.repeat)
+    timed("engine: summary (cold cache)", summary_cold, loans, args.repeat)
+    timed("engine: summary reduce_term", summary_reduce_term, loans, args.repeat)
+
+    clear_plan_cache()
+    for loan in loans:
+        MortgageCalculator.plan(*loan, REDUCE_PAYMENT)
+    timed(
+        "engine: summary (warm cache)",
+        lambda m, r, p: MortgageCalculator.calculate_mortgage_summary(m, r, p),
+        loans,
+        args.repeat
+    )
+    print(f"\nplan cache: {plan_cache_info()}")
+
+
+if __name__ == "__main__":
+    main()
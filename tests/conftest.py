@@ -0,0 +1,8 @@
+# tests/conftest.py
+import os
+import tempfile
+
+# La configuración se lee al importar app: base de datos y almacén de blobs temporales
+_data_dir = tempfile.mkdtemp(prefix="inmuebles-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_data_dir}/test.db")
+os.environ.setdefault("APP_DATA_DIR", _data_dir)
@@ -0,0 +1,100 @@
+# tests/test_file_listing.py
+"""Listing files and gallery photos reads metadata only, never the contents"""
+import base64
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event, text
+from sqlmodel import Session
+
+from app.auth import create_access_token
+from app.db import async_engine, engine, init_db
+from app.main import app
+from app.models import Property, User
+from app.models_files import FileStorage, PropertyPhoto
+from app.services.blob_store import store_bytes
+
+PAYLOAD_SIZE = 2 * 1024 * 1024
+# Columnas que pueden devolver los listados
+LIST_COLUMNS = {"id", "filename", "file_size", "created_at", "photo_url", "is_primary"}
+# Lo que cuesta autenticar al usuario en la misma petición
+USER_COLUMNS = set(User.__table__.columns.keys())
+
+
+@pytest.fixture(scope="module")
+def seeded():
+    init_db()
+    with engine.begin() as connection:
+        # Columnas Base64 de una base sin migrar: un SELECT * se las traería
+        connection.execute(text("ALTER TABLE filestorage ADD COLUMN file_data TEXT"))
+        connection.execute(text("ALTER TABLE propertyphoto ADD COLUMN photo_data TEXT"))
+
+    with Session(engine) as session:
+        user = User(email="listing@example.com", hashed_password="x")
+        session.add(user)
+        session.flush()
+        prop = Property(owner_id=user.id, address="Calle Listado 1", purchase_price=100000)
+        session.add(prop)
+        session.flush()
+        for index in range(3):
+            content = os.urandom(PAYLOAD_SIZE)
+            blob = store_bytes(session, content)
+            record = FileStorage(
+                filename=f"photo-{index}.jpg", content_type="image/jpeg", sha256=blob.sha256,
+                file_size=len(content), property_id=prop.id, file_type="photo", user_id=user.id
+            )
+            session.add(record)
+            session.flush()
+            session.add(PropertyPhoto(property_id=prop.id, file_id=record.id, photo_url=f"/files/photo/{record.id}"))
+        session.commit()
+        user_id, property_id = user.id, prop.id
+
+    inline = base64.b64encode(os.urandom(PAYLOAD_SIZE)).decode()
+    with engine.begin() as connection:
+        connection.execute(text("UPDATE filestorage SET file_data = :data"), {"data": inline})
+        connection.execute(text("UPDATE propertyphoto SET photo_data = :data"), {"data": inline})
+    return {"Authorization": f"Bearer {create_access_token(str(user_id))}"}, property_id
+
+
+@pytest.fixture
+def selected_columns():
+    """Column names of every result set read by the sync and async engines"""
+    columns = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if cursor.description:
+            columns.append({column[0] for column in cursor.description})
+
+    targets = (engine, async_engine.sync_engine)
+    for target in targets:
+        event.listen(target, "after_cursor_execute", record)
+    yield columns
+    for target in targets:
+        event.remove(target, "after_cursor_execute", record)
+
+
+def _assert_metadata_only(columns, response):
+    assert columns
+    for names in columns:
+        assert names <= LIST_COLUMNS or names == USER_COLUMNS, names
+    # Tres ficheros de 2 MB: el listado se queda en unos cientos de bytes
+    assert len(response.content) < 4096
+
+
+def test_list_files_reads_metadata_only(seeded, selected_columns):
+    headers, _ = seeded
+    response = TestClient(app).get("/files/list/photo", headers=headers)
+
+    assert response.status_code == 200
+    assert [item["size"] for item in response.json()] == [PAYLOAD_SIZE] * 3
+    _assert_metadata_only(selected_columns, response)
+
+
+def test_property_photos_read_metadata_only(seeded, selected_columns):
+    _, property_id = seeded
+    response = TestClient(app).get(f"/files/property/{property_id}/photos")
+
+    assert response.status_code == 200
+    assert len(response.json()) == 3
+    _assert_metadata_only(selected_columns, response)